@@ -1,18 +1,123 @@
 import { defineStore } from 'pinia'
 import { ref } from 'vue'
+import repository from '@/api/repository'
+import { useAuthStore } from './auth.store'
 
 export const useWebmailStore = defineStore('webmail', () => {
   const selection = ref([])
   const listingKey = ref(0)
+  // Mailbox counters pushed by the server (mailbox name -> counters)
+  const counters = ref({})
+  const newMessage = ref(null)
+  const eventsConnected = ref(false)
+
+  let eventsController = null
+  let retryDelay = 5000
+
+  function handleEvent(name, data) {
+    if (name === 'status') {
+      counters.value[data.mailbox] = data
+    } else if (name === 'new_message') {
+      newMessage.value = { mailbox: data.mailbox, date: Date.now() }
+    }
+  }
+
+  function parseEvents(buffer) {
+    // Events are separated by an empty line
+    const chunks = buffer.split('\n\n')
+    for (const chunk of chunks.slice(0, -1)) {
+      let name = 'message'
+      let data = ''
+      for (const line of chunk.split('\n')) {
+        if (line.startsWith('event: ')) {
+          name = line.slice(7)
+        } else if (line.startsWith('data: ')) {
+          data += line.slice(6)
+        } else if (line.startsWith('retry: ')) {
+          retryDelay = parseInt(line.slice(7))
+        }
+      }
+      if (data) {
+        handleEvent(name, JSON.parse(data))
+      }
+    }
+    return chunks[chunks.length - 1]
+  }
+
+  async function readEvents(controller) {
+    const authStore = useAuthStore()
+    const token = await authStore.getAccessToken()
+    const resp = await fetch(`${repository.defaults.baseURL}webmail/events/`, {
+      headers: { Authorization: `Bearer ${token}` },
+      signal: controller.signal,
+    })
+    if (resp.status === 204) {
+      // Server is not able to stream (no ASGI): keep polling
+      return false
+    }
+    if (!resp.ok) {
+      throw new Error(`Event stream not available (${resp.status})`)
+    }
+    eventsConnected.value = true
+    const reader = resp.body.pipeThrough(new TextDecoderStream()).getReader()
+    let buffer = ''
+    while (true) {
+      const { value, done } = await reader.read()
+      if (done) {
+        break
+      }
+      buffer = parseEvents(buffer + value)
+    }
+    return true
+  }
+
+  async function startEvents() {
+    if (eventsController) {
+      return
+    }
+    const controller = new AbortController()
+    eventsController = controller
+    while (!controller.signal.aborted) {
+      try {
+        if (!(await readEvents(controller))) {
+          break
+        }
+      } catch (error) {
+        if (controller.signal.aborted) {
+          break
+        }
+        console.log(error)
+      }
+      // Counters are polled by components while disconnected
+      eventsConnected.value = false
+      await new Promise((resolve) => setTimeout(resolve, retryDelay))
+    }
+  }
+
+  function stopEvents() {
+    if (eventsController) {
+      eventsController.abort()
+      eventsController = null
+    }
+    eventsConnected.value = false
+  }
 
   const $reset = async () => {
+    stopEvents()
     selection.value = []
     listingKey.value = 0
+    counters.value = {}
+    newMessage.value = null
   }
 
   return {
     selection,
     listingKey,
+    counters,
+    newMessage,
+    eventsConnected,
+    startEvents,
+    stopEvents,
     $reset,
   }
 })
@@ -1,3 +1,7 @@
+# Models of the amavis application stored in modoboa's database
+DEFAULT_DB_MODELS = ["quarantinecounter"]
+
+
 class AmavisRouter:
     """A router to control all database operations on models in
     the amavis application"""
@@ -5,12 +9,16 @@ class AmavisRouter:
     def db_for_read(self, model, **hints):
         """Point all operations on amavis models to 'amavis'."""
         if model._meta.app_label == "amavis":
+            if model._meta.model_name in DEFAULT_DB_MODELS:
+                return "default"
             return "amavis"
         return None
 
     def db_for_write(self, model, **hints):
         """Point all operations on amavis models to 'amavis'."""
         if model._meta.app_label == "amavis":
+            if model._meta.model_name in DEFAULT_DB_MODELS:
+                return "default"
             return "amavis"
         return None
 
@@ -26,6 +34,8 @@ class AmavisRouter:
         database.
         """
         if app_label == "amavis":
+            if hints.get("model_name") in DEFAULT_DB_MODELS:
+                return db == "default"
             # modoboa_amavis migrations should be created in the amavis
             # database.
             return db == "amavis"
@@ -2,6 +2,8 @@
 
 from django.core.management import call_command
 
+from .sql_connector import SQLconnector
+
 
 def amnotify(*args, **options):
     call_command("amnotify", *args, **options)
@@ -9,3 +11,7 @@ def amnotify(*args, **options):
 
 def qcleanup(*args, **options):
     call_command("qcleanup", *args, **options)
+
+
+def update_quarantine_counters():
+    SQLconnector().refresh_quarantine_counters()
@@ -1,7 +1,9 @@
+import mailbox
 import os
 import re
 import socket
 import struct
+import tempfile
 from email.utils import parseaddr
 
 import idna
@@ -44,15 +46,32 @@ class SelfServiceAuthentication(authentication.BaseAuthentication):
         return (None, "selfservice")
 
 
+PDP_RESPONSE_END_RE = re.compile(rb"\r?\n\r?\n")
+
+
 class AMrelease:
+    """Client for amavis' policy delegation protocol (AM.PDP).
+
+    A single connection is used: release requests are sent by
+    batches (pipelined), and the framed responses (attribute lines
+    ended by an empty line) are read back in the same order.
+    """
+
+    # Number of requests sent before reading the responses
+    BATCH_SIZE = 50
+    TIMEOUT = 30
+
     def __init__(self):
         conf = dict(param_tools.get_global_parameters("amavis"))
+        self.buffer = b""
         try:
             if conf["am_pdp_mode"] == "inet":
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.settimeout(self.TIMEOUT)
                 self.sock.connect((conf["am_pdp_host"], conf["am_pdp_port"]))
             else:
                 self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.TIMEOUT)
                 self.sock.connect(conf["am_pdp_socket"])
         except OSError as err:
             raise InternalError(
@@ -65,30 +84,139 @@ class AMrelease:
 
         return re.sub(rb"%([0-9a-fA-F]{2})", repl, answer)
 
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __del__(self):
         self.sock.close()
 
-    def sendreq(self, mailid, secretid, recipient, *others):
-        self.sock.send(
-            smart_bytes(
-                f"""request=release
+    def build_request(self, mailid, secretid, recipient) -> bytes:
+        return smart_bytes(
+            f"""request=release
 mail_id={smart_str(mailid)}
 secret_id={smart_str(secretid)}
 quar_type=Q
 recipient={smart_str(recipient)}
 
 """
+        )
+
+    def read_response(self) -> dict:
+        """Read a response and return its (decoded) attributes."""
+        while True:
+            match = PDP_RESPONSE_END_RE.search(self.buffer)
+            if match:
+                break
+            try:
+                data = self.sock.recv(4096)
+            except OSError as err:
+                raise InternalError(
+                    _("Communication with amavis failed: %s") % str(err)
+                ) from None
+            if not data:
+                raise InternalError(_("Connection closed by amavis"))
+            self.buffer += data
+        response = self.buffer[: match.start()]
+        self.buffer = self.buffer[match.end() :]
+        result = {}
+        for line in response.splitlines():
+            name, _sep, value = line.partition(b"=")
+            result.setdefault(smart_str(name.strip()), []).append(
+                smart_str(self.decode(value.strip()))
             )
+        return result
+
+    def is_success(self, response: dict) -> bool:
+        return any(
+            re.match(r"250 [\d\.]+ Ok", reply) for reply in response.get("setreply", [])
         )
-        answer = self.sock.recv(1024)
-        answer = self.decode(answer)
-        if re.search(rb"250 [\d\.]+ Ok", answer):
-            return True
-        return False
+
+    def release(self, messages: list[tuple]) -> list[tuple[bool, str]]:
+        """Release a list of messages.
+
+        :param messages: a list of (mail_id, secret_id, recipient) tuples
+        :return: a (released, reply) tuple for each message
+        """
+        results = []
+        for start in range(0, len(messages), self.BATCH_SIZE):
+            batch = messages[start : start + self.BATCH_SIZE]
+            try:
+                self.sock.sendall(
+                    b"".join(self.build_request(*message) for message in batch)
+                )
+            except OSError as err:
+                raise InternalError(
+                    _("Communication with amavis failed: %s") % str(err)
+                ) from None
+            for _message in batch:
+                response = self.read_response()
+                replies = response.get("setreply", [])
+                results.append((self.is_success(response), " ".join(replies)))
+        return results
+
+
+class SpamdClient:
+    """Client for the spamd TELL command, used to learn remote messages.
+
+    spamd handles a single request per connection, so each message is
+    sent over a new connection but no process is spawned. spamd must be
+    started with the ``--allow-tell`` option.
+    """
+
+    TIMEOUT = 30
+    RESPONSE_RE = re.compile(rb"^SPAMD/[\d\.]+ (\d+) (.*?)\r?$", re.MULTILINE)
+
+    def __init__(self, address: str, port: int):
+        self.address = address
+        self.port = port
+
+    def build_request(self, msg: bytes, mtype: str, username: str) -> bytes:
+        headers = [
+            "TELL SPAMC/1.5",
+            f"Message-class: {mtype}",
+            "Set: local",
+            f"User: {username}",
+            f"Content-length: {len(msg)}",
+        ]
+        return ("\r\n".join(headers) + "\r\n\r\n").encode() + msg
+
+    def tell(self, msg: bytes, mtype: str, username: str) -> tuple[bool, str]:
+        """Send a message to learn, return (success, error)."""
+        try:
+            with socket.create_connection(
+                (self.address, self.port), timeout=self.TIMEOUT
+            ) as sock:
+                sock.sendall(self.build_request(msg, mtype, username))
+                sock.shutdown(socket.SHUT_WR)
+                response = b""
+                while True:
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    response += data
+        except OSError as err:
+            return False, _("Connection to spamd failed: %s") % str(err)
+        match = self.RESPONSE_RE.search(response)
+        if match is None:
+            return False, _("Invalid response from spamd: %s") % smart_str(response)
+        if match.group(1) != b"0":
+            return False, smart_str(match.group(2))
+        return True, ""
 
 
 class SpamassassinClient:
-    """A stupid spamassassin client."""
+    """A stupid spamassassin client.
+
+    Local messages are queued and learned by batches (one sa-learn
+    call per username and message type) when :meth:`done` is called.
+    Remote messages are sent to spamd right away.
+    """
 
     def __init__(self, user, recipient_db):
         """Constructor."""
@@ -98,56 +226,48 @@ class SpamassassinClient:
         self._recipient_db = recipient_db
         self._setup_cache = {}
         self._username_cache = []
+        self._binaries = {}
+        self._pending = {}
         if user.role == "SimpleUsers":
             if self.conf["user_level_learning"]:
                 self._username = user.email
         else:
             self._username = None
         self.error = None
-        if self._sa_is_local:
-            self._learn_cmd_kwargs = {}
-            self._expected_exit_codes = [0]
-        else:
-            self._learn_cmd_kwargs = {}
-            self._expected_exit_codes = [5, 6]
+        if not self._sa_is_local:
+            self._spamd = SpamdClient(
+                self.conf["spamd_address"], self.conf["spamd_port"]
+            )
 
     def _find_binary(self, name: str) -> str:
         """Find path to binary."""
+        if name in self._binaries:
+            return self._binaries[name]
         code, output = exec_cmd(["which", name])
         if not code:
-            return smart_str(output).strip()
+            self._binaries[name] = smart_str(output).strip()
+            return self._binaries[name]
         known_paths = getattr(settings, "SA_LOOKUP_PATH", ("/usr/bin",))
         for path in known_paths:
             bpath = os.path.join(path, name)
             if os.path.isfile(bpath) and os.access(bpath, os.X_OK):
+                self._binaries[name] = bpath
                 return bpath
         raise InternalError(_("Failed to find {} binary").format(name))
 
-    def get_learn_cmd(self, mtype: str, username: str) -> list[str]:
-        result = []
-        if self._sa_is_local:
-            result += [self._find_binary("sa-learn")]
-            result += [f"--{mtype}", "--no-sync", "-u", username]
-        else:
-            result += [self._find_binary("spamc")]
-            result += [
-                "-d",
-                self.conf["spamd_address"],
-                "-p",
-                str(self.conf["spamd_port"]),
-                "-L",
-                mtype,
-                "-u",
-                username,
-            ]
-        return result
+    def get_learn_cmd(self, mtype: str, username: str, mbox_path: str) -> list[str]:
+        return [
+            self._find_binary("sa-learn"),
+            f"--{mtype}",
+            "--no-sync",
+            "-u",
+            username,
+            "--mbox",
+            mbox_path,
+        ]
 
     def get_sync_cmd(self, username: str) -> list[str]:
-        result = []
-        if self._sa_is_local:
-            result += [self._find_binary("sa-learn")]
-            result += ["-u", username, "--sync"]
-        return result
+        return [self._find_binary("sa-learn"), "-u", username, "--sync"]
 
     def _get_mailbox_from_rcpt(self, rcpt):
         """Retrieve a mailbox from a recipient address."""
@@ -216,12 +336,33 @@ class SpamassassinClient:
                     self._setup_cache[username] = True
         if username not in self._username_cache:
             self._username_cache.append(username)
-        cmd = self.get_learn_cmd(mtype, username)
-        code, output = exec_cmd(cmd, pinput=smart_bytes(msg), **self._learn_cmd_kwargs)
-        if code in self._expected_exit_codes:
+        if self._sa_is_local:
+            self._pending.setdefault((username, mtype), []).append(smart_bytes(msg))
             return True
-        self.error = smart_str(output)
-        return False
+        result, error = self._spamd.tell(smart_bytes(msg), mtype, username)
+        if not result:
+            self.error = error
+        return result
+
+    def _learn_batch(self, username: str, mtype: str, messages: list[bytes]) -> bool:
+        """Learn a list of messages with a single sa-learn call."""
+        fd, path = tempfile.mkstemp(suffix=".mbox")
+        os.close(fd)
+        try:
+            mbox = mailbox.mbox(path)
+            try:
+                for msg in messages:
+                    mbox.add(msg)
+                mbox.flush()
+            finally:
+                mbox.close()
+            code, output = exec_cmd(self.get_learn_cmd(mtype, username, path))
+        finally:
+            os.unlink(path)
+        if code:
+            self.error = smart_str(output)
+            return False
+        return True
 
     def learn_spam(self, rcpt, msg):
         """Learn new spam."""
@@ -231,12 +372,24 @@ class SpamassassinClient:
         """Learn new ham."""
         return self._learn(rcpt, msg, "ham")
 
-    def done(self):
-        """Call this method at the end of the processing."""
-        if self._sa_is_local:
-            for username in self._username_cache:
-                cmd = self.get_sync_cmd(username)
-                exec_cmd(cmd, **self._learn_cmd_kwargs)
+    def done(self) -> bool:
+        """Call this method at the end of the processing.
+
+        Learn queued messages and synchronize the bayes databases.
+        Return False if a batch failed (see :attr:`error`).
+        """
+        if not self._sa_is_local:
+            return True
+        result = True
+        while self._pending:
+            (username, mtype), messages = self._pending.popitem()
+            if not self._learn_batch(username, mtype, messages):
+                result = False
+                break
+        self._pending = {}
+        for username in self._username_cache:
+            exec_cmd(self.get_sync_cmd(username))
+        return result
 
 
 def create_user_and_policy(name, priority=7):
@@ -1,13 +1,14 @@
 from django.contrib.sites import models as sites_models
 from django.core import mail
 from django.core.management.base import BaseCommand
+from django.db.models import Sum
 from django.template.loader import render_to_string
 from django.utils.translation import gettext as _
 
 from modoboa.admin.models import Domain
 from modoboa.core.models import User
 from modoboa.parameters import tools as param_tools
-from ...models import Msgrcpt
+from ...models import Msgrcpt, QuarantineCounter
 from ...sql_connector import SQLconnector
 
 
@@ -67,24 +68,25 @@ class Command(BaseCommand):
         self.baseurl = f"https://{sites_models.Site.objects.get_current().domain}"
         self.listingurl = f"{self.baseurl}/user/quarantine?requests=1"
         messages = []
+        SQLconnector().refresh_quarantine_counters()
         # Check domain administators first.
         for da in User.objects.filter(groups__name="DomainAdmins"):
             if not hasattr(da, "mailbox"):
                 continue
+            total = SQLconnector(user=da).get_pending_requests()
+            if not total:
+                continue
             rcpt = da.mailbox.full_address
             reqs = SQLconnector().get_domains_pending_requests(
                 Domain.objects.get_for_admin(da).values_list("name", flat=True)
-            )
-            total = reqs.count()
-            reqs = reqs.all()[:10]
+            )[:10]
             if reqs.count():
                 messages.append(self._build_message(rcpt, total, reqs))
 
         # Then super administators.
-        reqs = Msgrcpt.objects.filter(rs="p")
-        total = reqs.count()
+        total = QuarantineCounter.objects.aggregate(total=Sum("pending"))["total"]
         if total:
-            reqs = reqs.all()[:10]
+            reqs = Msgrcpt.objects.filter(rs="p")[:10]
             for su in User.objects.filter(is_superuser=True):
                 if not hasattr(su, "mailbox"):
                     continue
@@ -0,0 +1,40 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("admin", "0024_domain_last_dns_check_execution"),
+        ("amavis", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="QuarantineCounter",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("content", models.CharField(max_length=3)),
+                ("total", models.PositiveIntegerField(default=0)),
+                ("pending", models.PositiveIntegerField(default=0)),
+                (
+                    "domain",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="admin.domain",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("domain", "content")},
+            },
+        ),
+    ]
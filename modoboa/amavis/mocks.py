@@ -0,0 +1,106 @@
+"""Mock objects."""
+
+import socketserver
+import threading
+from urllib.parse import quote
+
+
+class FakePDPServer:
+    """Fake amavis policy server (AM.PDP), answering release requests.
+
+    Requests are read by blocks (attribute lines ended by an empty
+    line). Releases of mail ids listed in ``failures`` are refused.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = failures or []
+        self.requests = []
+        self.connections = 0
+        self.server = None
+
+    def start(self) -> int:
+        """Start listening (in a thread) and return the port."""
+        pdp = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                pdp.connections += 1
+                request = {}
+                for line in self.rfile:
+                    line = line.decode().strip()
+                    if line:
+                        name, value = line.split("=", 1)
+                        request[name] = value
+                        continue
+                    pdp.requests.append(request)
+                    self.wfile.write(pdp.get_response(request))
+                    request = {}
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_response(self, request: dict) -> bytes:
+        if request.get("mail_id") in self.failures:
+            reply = "450 4.5.0 Failure: message not found"
+        else:
+            reply = (
+                f"250 2.0.0 Ok, id=rel-{request.get('mail_id')}, "
+                "from MTA([127.0.0.1]:10025): 250 2.0.0 Ok: queued as 42"
+            )
+        return (
+            f"setreply={quote(reply, safe='')}\n"
+            f"return_value=0\n"
+            f"exit_code=EX_OK\n\n"
+        ).encode()
+
+
+class FakeSpamdServer:
+    """Fake spamd server, answering TELL requests.
+
+    Learnt messages are stored in ``messages`` as (username, class,
+    content) tuples. Requests for users listed in ``failures`` are
+    refused.
+    """
+
+    def __init__(self, failures=None):
+        self.failures = failures or []
+        self.messages = []
+        self.server = None
+
+    def start(self) -> int:
+        """Start listening (in a thread) and return the port."""
+        spamd = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                headers = {}
+                self.rfile.readline()
+                for line in self.rfile:
+                    line = line.decode().strip()
+                    if not line:
+                        break
+                    name, value = line.split(": ", 1)
+                    headers[name] = value
+                content = self.rfile.read(int(headers["Content-length"]))
+                self.wfile.write(spamd.get_response(headers, content))
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_response(self, headers: dict, content: bytes) -> bytes:
+        if headers["User"] in self.failures:
+            return b"SPAMD/1.1 69 Bad header line: (TELL not enabled)\r\n"
+        self.messages.append((headers["User"], headers["Message-class"], content))
+        return b"SPAMD/1.1 0 EX_OK\r\nDidSet: local\r\n\r\n"
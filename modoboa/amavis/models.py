@@ -224,3 +224,20 @@ class Wblist(models.Model):
         db_table = "wblist"
         managed = False
         unique_together = [("rid", "sid")]
+
+
+class QuarantineCounter(models.Model):
+    """Number of quarantined messages per domain and content type.
+
+    Unlike the other models of this module, it lives in modoboa's
+    database. It is refreshed periodically so that dashboards and
+    notifications don't have to scan the msgrcpt table.
+    """
+
+    domain = models.ForeignKey("admin.Domain", on_delete=models.CASCADE)
+    content = models.CharField(max_length=3)
+    total = models.PositiveIntegerField(default=0)
+    pending = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [("domain", "content")]
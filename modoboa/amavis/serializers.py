@@ -104,6 +104,7 @@ class PaginatedMessageListSerializer(serializers.Serializer):
     last_index = serializers.IntegerField()
     prev_page = serializers.IntegerField()
     next_page = serializers.IntegerField()
+    next_cursor = serializers.CharField(allow_null=True)
     results = CompactMessageSerializer(many=True)
 
 
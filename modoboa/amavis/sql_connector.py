@@ -2,14 +2,20 @@
 
 import datetime
 
-from django.db.models import Q
+from django.db import router, transaction
+from django.db.models import Count, Q, Sum, Value
+from django.utils.translation import gettext as _
 
 from modoboa.admin.models import Domain
 from modoboa.lib.email_utils import decode
+from modoboa.lib.exceptions import BadRequest
 
 from .lib import cleanup_email_address, make_query_args
-from .models import Maddr, Msgrcpt, Quarantine
-from .utils import ConvertFrom, fix_utf8_encoding, smart_bytes, smart_str
+from .models import Maddr, Msgrcpt, Quarantine, QuarantineCounter
+from .utils import ConvertFrom, ConvertTo, fix_utf8_encoding, smart_bytes, smart_str
+
+# Placeholder for the extension part of an address
+EXTENSION_WILDCARD = "\0"
 
 
 def reverse_domain_names(domains):
@@ -38,8 +44,15 @@ class SQLconnector:
         "mail__subject",
         "mail__mail_id",
         "mail__time_num",
+        "rseqnum",
     ]
 
+    # Recipient states (rs field) of the messages shown in quarantine
+    QUARANTINE_STATES = [" ", "V", "R", "p", "S", "H"]
+
+    # Columns used for keyset pagination, the last ones are tie-breakers
+    KEYSET_FIELDS = ["mail__time_num", "mail__mail_id", "rseqnum"]
+
     def __init__(self, user=None, ordering: str | None = None) -> None:
         """Constructor."""
         self.user = user
@@ -61,21 +74,50 @@ class SQLconnector:
             cursor = connections["amavis"].cursor()
             cursor.execute(query, args)
 
-    def _apply_msgrcpt_simpleuser_filter(self, flt):
-        """Apply specific filter for simple users."""
-        if "str_email" not in self._annotations:
-            self._annotations["str_email"] = ConvertFrom("rid__email")
+    def _get_user_maddr_ids(self) -> list[int]:
+        """Return the ids of the Maddr records matching user's addresses.
 
+        Addresses (and aliases) are matched exactly, or with any
+        extension (ie. user+foo@domain.com). Lookups compare the raw
+        email column so amavis' unique index can be used.
+        """
         rcpts = [self.user.email]
         if hasattr(self.user, "mailbox"):
             rcpts += self.user.mailbox.alias_addresses
 
-        query_rcpts = []
+        flt = Q()
+        addresses = set()
+        patterns = []
         for rcpt in rcpts:
-            query_rcpts += make_query_args(rcpt, exact_extension=False, wildcard=".*")
+            for arg in make_query_args(
+                rcpt, exact_extension=False, wildcard=EXTENSION_WILDCARD
+            ):
+                if EXTENSION_WILDCARD not in arg:
+                    addresses.add(arg)
+                    flt |= Q(email=ConvertTo(Value(arg)))
+                    continue
+                # Addresses starting with "<local part><delimiter>" are
+                # selected with a range, the domain is checked below
+                prefix, suffix = arg.split(EXTENSION_WILDCARD)
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                patterns.append((prefix, suffix))
+                flt |= Q(
+                    email__gte=ConvertTo(Value(prefix)),
+                    email__lt=ConvertTo(Value(upper)),
+                )
+        result = []
+        for maddr_id, email in Maddr.objects.filter(flt).values_list("id", "email"):
+            email = smart_str(email)
+            if email in addresses or any(
+                email.startswith(prefix) and email.endswith(suffix)
+                for prefix, suffix in patterns
+            ):
+                result.append(maddr_id)
+        return result
 
-        re = f"({'|'.join(query_rcpts)})"
-        return flt & Q(str_email__regex=re)
+    def _apply_msgrcpt_simpleuser_filter(self, flt):
+        """Apply specific filter for simple users."""
+        return flt & Q(rid__in=self._get_user_maddr_ids())
 
     def _apply_msgrcpt_filters(self, flt):
         """Apply filters based on user's role."""
@@ -94,7 +136,7 @@ class SQLconnector:
         Filters: rs, rid, content
         """
         flt = (
-            Q(rs__in=[" ", "V", "R", "p", "S", "H"])
+            Q(rs__in=self.QUARANTINE_STATES)
             if request.GET.get("viewrequests", "0") != "1"
             else Q(rs="p")
         )
@@ -132,36 +174,92 @@ class SQLconnector:
             .filter(flt)
         )
 
+    def _get_ordering(self) -> tuple[str, str] | None:
+        """Return the (sign, field) couple to order the listing by."""
+        order = self.ordering or "-datetime"
+        sign = ""
+        if order[0] == "-":
+            sign = "-"
+            order = order[1:]
+        order = self.ORDER_TRANSLATION_TABLE.get(order)
+        if not order:
+            return None
+        return sign, order
+
+    def _uses_keyset(self) -> bool:
+        """Tell if the listing can be paginated with a cursor."""
+        ordering = self._get_ordering()
+        return ordering is not None and ordering[1] == self.KEYSET_FIELDS[0]
+
     def messages_count(self, request) -> int:
         """
         Return the total number of messages living in the quarantine.
 
-        We also store the built queryset for a later use.
+        The count is computed by the database. We also store the built
+        queryset for a later use.
         """
         if self.user is None:
             return None
         if self._messages_count is None:
-            self.messages = self._get_quarantine_content(request)
-            self.messages = self.messages.values(*self.QUARANTINE_FIELDS)
-
-            order = self.ordering
-            if order is not None:
-                sign = ""
-                if order[0] == "-":
-                    sign = "-"
-                    order = order[1:]
-                order = self.ORDER_TRANSLATION_TABLE.get(order)
-                if order:
+            queryset = self._get_quarantine_content(request)
+            self._messages_count = queryset.count()
+            self.messages = queryset.values(*self.QUARANTINE_FIELDS)
+            ordering = self._get_ordering()
+            if ordering is not None:
+                sign, order = ordering
+                if self._uses_keyset():
+                    self.messages = self.messages.order_by(
+                        *[sign + field for field in self.KEYSET_FIELDS]
+                    )
+                else:
                     self.messages = self.messages.order_by(sign + order)
 
-            self._messages_count = len(self.messages)
-
         return self._messages_count
 
-    def fetch(self, start=None, stop=None):
-        """Fetch a range of messages from the internal cache."""
+    def get_cursor(self, qm: dict) -> str | None:
+        """Return the cursor pointing after the given message."""
+        if not self._uses_keyset():
+            return None
+        return "{}:{}:{}".format(
+            qm["mail__time_num"],
+            smart_bytes(qm["mail__mail_id"]).hex(),
+            qm["rseqnum"],
+        )
+
+    def _apply_cursor(self, queryset, cursor: str):
+        """Only keep messages located after the given cursor."""
+        try:
+            time_num, mail_id, rseqnum = cursor.split(":")
+            values = [int(time_num), bytes.fromhex(mail_id), int(rseqnum)]
+        except ValueError:
+            raise BadRequest(_("Invalid cursor")) from None
+        lookup = "lt" if self._get_ordering()[0] == "-" else "gt"
+        flt = None
+        for pos, field in enumerate(self.KEYSET_FIELDS):
+            nfilter = Q(**{f"{field}__{lookup}": values[pos]})
+            for prev, value in zip(self.KEYSET_FIELDS[:pos], values[:pos], strict=True):
+                nfilter &= Q(**{prev: value})
+            flt = nfilter if flt is None else flt | nfilter
+        return queryset.filter(flt)
+
+    def fetch(self, start=None, stop=None, cursor=None):
+        """Fetch a range of messages.
+
+        When a cursor (as returned by ``get_cursor`` for the last
+        message of the previous page) is given, the page is retrieved
+        with an indexed seek instead of an offset.
+
+        :return: a list of messages and the cursor of the next page
+        """
+        queryset = self.messages
+        if cursor and self._uses_keyset():
+            queryset = self._apply_cursor(queryset, cursor)[: stop - start + 1]
+        else:
+            queryset = queryset[start - 1 : stop]
         emails = []
-        for qm in self.messages[start - 1 : stop]:
+        last = None
+        for qm in queryset:
+            last = qm
             if qm["rs"] == "D":
                 continue
             m = {
@@ -181,14 +279,17 @@ class SQLconnector:
             elif qm["rs"] == "p":
                 m["style"] = "pending"
             emails.append(m)
-        return emails
+        next_cursor = self.get_cursor(last) if last is not None else None
+        return emails, next_cursor
 
     def get_recipient_message(self, address, mailid):
         """Retrieve a message for a given recipient."""
         assert isinstance(address, str), "address should be of type str"
 
-        return Msgrcpt.objects.annotate(str_email=ConvertFrom("rid__email")).get(
-            mail=mailid.encode("ascii"), str_email=address
+        return (
+            Msgrcpt.objects.select_related("rid")
+            .annotate(str_email=ConvertFrom("rid__email"))
+            .get(mail=mailid.encode("ascii"), str_email=address)
         )
 
     def set_msgrcpt_status(self, address, mailid: str, status):
@@ -212,19 +313,47 @@ class SQLconnector:
         )
 
     def get_pending_requests(self):
-        """Return the number of requests currently pending."""
-        rq = Q(rs="p")
+        """Return the number of requests currently pending.
+
+        The value is read from the counters refreshed by
+        ``refresh_quarantine_counters``.
+        """
+        counters = QuarantineCounter.objects.all()
         if not self.user.is_superuser:
-            doms = Domain.objects.get_for_admin(self.user)
-            if not doms.exists():
-                return 0
-            doms_q = Q(
-                rid__domain__in=reverse_domain_names(
-                    doms.values_list("name", flat=True)
-                )
+            counters = counters.filter(
+                domain__in=Domain.objects.get_for_admin(self.user)
             )
-            rq &= doms_q
-        return Msgrcpt.objects.filter(rq).count()
+        return counters.aggregate(total=Sum("pending"))["total"] or 0
+
+    def refresh_quarantine_counters(self):
+        """Count quarantined messages per domain and content type."""
+        domains = dict(Domain.objects.values_list("name", "pk"))
+        rows = (
+            Msgrcpt.objects.filter(rs__in=self.QUARANTINE_STATES)
+            .values("rid__domain", "content")
+            .annotate(total=Count("rid"), pending=Count("rid", filter=Q(rs="p")))
+            .order_by()
+        )
+        counters = {}
+        for row in rows:
+            name = reverse_domain_names([smart_str(row["rid__domain"])])[0]
+            if name not in domains:
+                continue
+            key = (domains[name], row["content"])
+            counter = counters.get(key)
+            if counter is None:
+                counters[key] = QuarantineCounter(
+                    domain_id=key[0],
+                    content=key[1],
+                    total=row["total"],
+                    pending=row["pending"],
+                )
+            else:
+                counter.total += row["total"]
+                counter.pending += row["pending"]
+        with transaction.atomic(using=router.db_for_write(QuarantineCounter)):
+            QuarantineCounter.objects.all().delete()
+            QuarantineCounter.objects.bulk_create(counters.values())
 
     def get_mail_content(self, mailid) -> str:
         """Retrieve the content of a message."""
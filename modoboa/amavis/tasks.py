@@ -13,6 +13,7 @@ def manual_learning(user_pk: int, mtype: str, selection: list[dict], recipient_d
     user = core_models.User.objects.get(pk=user_pk)
     connector = SQLconnector()
     saclient = SpamassassinClient(user, recipient_db)
+    learned = []
     for item in selection:
         content = connector.get_mail_content(item["mailid"].encode("ascii"))
         result = (
@@ -22,9 +23,12 @@ def manual_learning(user_pk: int, mtype: str, selection: list[dict], recipient_d
         )
         if not result:
             break
+        learned.append(item)
+    # Local messages are only learned now, by batches
+    if not saclient.done():
+        return
+    for item in learned:
         connector.set_msgrcpt_status(item["rcpt"], item["mailid"], mtype[0].upper())
-    if saclient.error is None:
-        saclient.done()
 
     #     message = ngettext("%(count)d message processed successfully",
     #                        "%(count)d messages processed successfully",
@@ -1,8 +1,11 @@
 """Tests cases for RQ jobs."""
 
+from modoboa.admin import factories as admin_factories, models as admin_models
+from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoTestCase
 
 from modoboa.amavis import factories, jobs, models
+from modoboa.amavis.sql_connector import SQLconnector
 
 
 class JobsTestCase(ModoTestCase):
@@ -16,3 +19,35 @@ class JobsTestCase(ModoTestCase):
         self.assertEqual(models.Msgs.objects.count(), 0)
         self.assertEqual(models.Maddr.objects.count(), 0)
         self.assertEqual(models.Msgrcpt.objects.count(), 0)
+
+    def test_update_quarantine_counters(self):
+        admin_factories.populate_database()
+        factories.create_spam("user@test.com")
+        factories.create_spam("user@test.com", rs="p")
+        factories.create_spam("user@test.com", rs="D")
+        factories.create_virus("user@test.com", rs="p")
+        msgrcpt = factories.create_spam("user@test2.com", rs="p")
+        msgrcpt.rid.domain = "com.test2"
+        msgrcpt.rid.save()
+        msgrcpt = factories.create_spam("user@unknown.com", rs="p")
+        msgrcpt.rid.domain = "com.unknown"
+        msgrcpt.rid.save()
+
+        jobs.update_quarantine_counters()
+        domain = admin_models.Domain.objects.get(name="test.com")
+        counters = {
+            counter.content: (counter.total, counter.pending)
+            for counter in models.QuarantineCounter.objects.filter(domain=domain)
+        }
+        self.assertEqual(counters, {"S": (2, 1), "V": (1, 1)})
+        self.assertEqual(models.QuarantineCounter.objects.count(), 3)
+
+        superadmin = core_models.User.objects.get(username="admin")
+        self.assertEqual(SQLconnector(user=superadmin).get_pending_requests(), 3)
+        domainadmin = core_models.User.objects.get(username="admin@test.com")
+        self.assertEqual(SQLconnector(user=domainadmin).get_pending_requests(), 2)
+
+        # Counters are replaced on each run
+        models.Msgrcpt.objects.filter(rs="p").update(rs="R")
+        jobs.update_quarantine_counters()
+        self.assertEqual(SQLconnector(user=superadmin).get_pending_requests(), 0)
@@ -1,7 +1,18 @@
-from django.test import SimpleTestCase
+import mailbox
+import os
+from unittest import mock
 
+from django.test import SimpleTestCase, override_settings
+
+from modoboa.lib.exceptions import InternalError
 from modoboa.lib.tests import ModoTestCase
-from modoboa.amavis.lib import cleanup_email_address, make_query_args
+from modoboa.amavis.lib import (
+    AMrelease,
+    SpamassassinClient,
+    cleanup_email_address,
+    make_query_args,
+)
+from modoboa.amavis.mocks import FakePDPServer, FakeSpamdServer
 
 
 class MakeQueryArgsTests(ModoTestCase):
@@ -88,3 +99,115 @@ class FixUTF8EncodingTests(SimpleTestCase):
         expected_output = "john.smith@example.com"
         output = cleanup_email_address(value)
         self.assertEqual(output, expected_output)
+
+
+class AMreleaseTests(ModoTestCase):
+    """Tests for modoboa_amavis.lib.AMrelease."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = FakePDPServer(failures=["mailid2"])
+        port = self.server.start()
+        self.addCleanup(self.server.stop)
+        self.set_global_parameters(
+            {"am_pdp_mode": "inet", "am_pdp_host": "127.0.0.1", "am_pdp_port": port}
+        )
+
+    def test_release(self):
+        with AMrelease() as amr:
+            self.assertTrue(
+                amr.release([("mailid1", "secret1", "user@test.com")])[0][0]
+            )
+            results = amr.release(
+                [
+                    ("mailid2", "secret2", "user@test.com"),
+                    ("mailid3", "secret3", "user@test.com"),
+                ]
+            )
+        self.assertEqual(results[0], (False, "450 4.5.0 Failure: message not found"))
+        self.assertTrue(results[1][0])
+        self.assertIn("queued as 42", results[1][1])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            self.server.requests[0],
+            {
+                "request": "release",
+                "mail_id": "mailid1",
+                "secret_id": "secret1",
+                "quar_type": "Q",
+                "recipient": "user@test.com",
+            },
+        )
+
+    @mock.patch("socket.socket")
+    def test_read_response(self, mock_socket):
+        mock_socket.return_value.recv.side_effect = [
+            b"setreply=250%202.0.0",
+            b" Ok\r\nexit_code=EX_OK\r\n",
+            b"\r\nsetreply=450",
+            b"",
+        ]
+        amr = AMrelease()
+        self.assertEqual(
+            amr.read_response(),
+            {"setreply": ["250 2.0.0 Ok"], "exit_code": ["EX_OK"]},
+        )
+        # Connection closed in the middle of a response
+        with self.assertRaises(InternalError):
+            amr.read_response()
+
+
+@override_settings(SA_LOOKUP_PATH=(os.path.dirname(__file__),))
+class SpamassassinClientTests(ModoTestCase):
+    """Tests for modoboa_amavis.lib.SpamassassinClient."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = mock.Mock(role="SuperAdmins")
+        self.commands = []
+        self.learnt = []
+
+    def exec_cmd(self, cmd, **kwargs):
+        self.commands.append(cmd)
+        if cmd[0] == "which":
+            return 1, b""
+        if "--mbox" in cmd:
+            mbox = mailbox.mbox(cmd[cmd.index("--mbox") + 1])
+            self.learnt.append([msg["Subject"] for msg in mbox])
+            mbox.close()
+        return 0, b""
+
+    def test_local_learning(self):
+        self.set_global_parameter("sa_is_local", True)
+        saclient = SpamassassinClient(self.user, "global")
+        with mock.patch("modoboa.amavis.lib.exec_cmd", side_effect=self.exec_cmd):
+            for i in range(3):
+                self.assertTrue(
+                    saclient.learn_spam(
+                        "user@test.com", f"Subject: spam {i}\n\nFrom here\n"
+                    )
+                )
+            self.assertEqual(self.commands, [])
+            self.assertTrue(saclient.done())
+        # One learning call and one sync, the binary is looked up once
+        self.assertEqual(len(self.commands), 3)
+        self.assertEqual(self.commands[0], ["which", "sa-learn"])
+        self.assertEqual(self.commands[1][1:5], ["--spam", "--no-sync", "-u", "amavis"])
+        self.assertEqual(self.commands[2][2:], ["amavis", "--sync"])
+        self.assertEqual(self.learnt, [["spam 0", "spam 1", "spam 2"]])
+
+    def test_remote_learning(self):
+        spamd = FakeSpamdServer(failures=["other"])
+        port = spamd.start()
+        self.addCleanup(spamd.stop)
+        self.set_global_parameters(
+            {"sa_is_local": False, "spamd_address": "127.0.0.1", "spamd_port": port}
+        )
+        saclient = SpamassassinClient(self.user, "global")
+        self.assertTrue(saclient.learn_ham("user@test.com", "Subject: ham\n\nHi\n"))
+        self.assertTrue(saclient.done())
+        self.assertEqual(spamd.messages, [("amavis", "ham", b"Subject: ham\n\nHi\n")])
+
+        saclient._default_username = "other"
+        self.assertFalse(saclient.learn_ham("user@test.com", "Subject: ham\n\n"))
+        self.assertEqual(saclient.error, "Bad header line: (TELL not enabled)")
@@ -11,6 +11,8 @@ import django_rq
 
 from modoboa.admin import factories as admin_factories, models as admin_models
 from modoboa.amavis import factories, jobs, models
+from modoboa.amavis.lib import AMrelease
+from modoboa.amavis.mocks import FakePDPServer, FakeSpamdServer
 from modoboa.amavis.utils import smart_str
 from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoAPITestCase
@@ -78,6 +80,58 @@ class QuarantineViewSetTestCase(TestDataMixin, ModoAPITestCase):
         content = resp.json()
         self.assertEqual(content["count"], 1)
 
+    def test_list_simple_user(self):
+        self.set_global_parameter("recipient_delimiter", "+")
+        for rcpt in [
+            "user+tag@test.com",
+            "user+tag@test.com.evil",
+            "xuser@test.com",
+            "user2@test.com",
+        ]:
+            factories.create_spam(rcpt)
+        user = core_models.User.objects.get(username="user@test.com")
+        self.client.force_authenticate(user)
+        url = reverse("v2:amavis-quarantine-list")
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            sorted(msg["to_address"] for msg in resp.json()["results"]),
+            ["user+tag@test.com", "user@test.com"],
+        )
+
+    def test_list_pagination(self):
+        for time_num in [1000, 2000, 2000]:
+            msgrcpt = factories.create_spam("user@test.com")
+            msgrcpt.mail.time_num = time_num
+            msgrcpt.mail.save(update_fields=["time_num"])
+        url = reverse("v2:amavis-quarantine-list")
+        resp = self.client.get(f"{url}?page_size=2")
+        self.assertEqual(resp.status_code, 200)
+        content = resp.json()
+        self.assertEqual(content["count"], 4)
+        self.assertEqual(content["next_page"], 2)
+        cursor = content["next_cursor"]
+        self.assertIsNotNone(cursor)
+        seen = [msg["mailid"] for msg in content["results"]]
+
+        expected = self.client.get(f"{url}?page_size=2&page=2").json()["results"]
+        resp = self.client.get(f"{url}?page_size=2&page=2&cursor={cursor}")
+        content = resp.json()
+        self.assertEqual(content["results"], expected)
+        self.assertIsNone(content["next_cursor"])
+        seen += [msg["mailid"] for msg in content["results"]]
+        self.assertEqual(len(set(seen)), 4)
+
+        # Cursors are ignored when the listing is not sorted by date
+        resp = self.client.get(
+            f"{url}?page_size=2&page=2&ordering=subject&cursor={cursor}"
+        )
+        self.assertEqual(len(resp.json()["results"]), 2)
+        self.assertIsNone(resp.json()["next_cursor"])
+
+        resp = self.client.get(f"{url}?page_size=2&page=2&cursor=pouet")
+        self.assertEqual(resp.status_code, 400)
+
     def test_retrieve(self):
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
         rcpt = smart_str(self.msgrcpt.rid.email)
@@ -262,7 +316,7 @@ class QuarantineViewSetTestCase(TestDataMixin, ModoAPITestCase):
     @mock.patch("socket.socket")
     def test_release_denied_cross_domain(self, mock_socket):
         """A domain admin cannot release a message for a domain they don't manage."""
-        mock_socket.return_value.recv.return_value = b"250 1234 Ok\r\n"
+        mock_socket.return_value.recv.return_value = b"setreply=250 1234 Ok\r\n\r\n"
         admin2 = core_models.User.objects.get(username="admin@test2.com")
         self.client.force_authenticate(admin2)
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
@@ -292,7 +346,7 @@ class QuarantineViewSetTestCase(TestDataMixin, ModoAPITestCase):
 
     @mock.patch("socket.socket")
     def test_release(self, mock_socket):
-        mock_socket.return_value.recv.return_value = b"250 1234 Ok\r\n"
+        mock_socket.return_value.recv.return_value = b"setreply=250 1234 Ok\r\n\r\n"
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
         url = reverse("v2:amavis-quarantine-release", args=[mail_id])
         data = {"mailid": mail_id, "rcpt": smart_str(self.msgrcpt.rid.email)}
@@ -304,7 +358,7 @@ class QuarantineViewSetTestCase(TestDataMixin, ModoAPITestCase):
     @mock.patch("socket.socket")
     def test_release_selfservice(self, mock_socket):
         """Test release view."""
-        mock_socket.return_value.recv.return_value = b"250 1234 Ok\r\n"
+        mock_socket.return_value.recv.return_value = b"setreply=250 1234 Ok\r\n\r\n"
         self.client.logout()
         mail_id = smart_str(self.msgrcpt.mail.mail_id)
         url = reverse("v2:amavis-quarantine-release", args=[mail_id])
@@ -330,6 +384,48 @@ class QuarantineViewSetTestCase(TestDataMixin, ModoAPITestCase):
         self.msgrcpt.refresh_from_db()
         self.assertEqual(self.msgrcpt.rs, "R")
 
+    @mock.patch.object(AMrelease, "BATCH_SIZE", 2)
+    def test_release_selection(self):
+        msgrcpts = [self.msgrcpt] + [
+            factories.create_spam("user@test.com") for i in range(4)
+        ]
+        failed = smart_str(msgrcpts[3].mail.mail_id)
+        server = FakePDPServer(failures=[failed])
+        port = server.start()
+        self.addCleanup(server.stop)
+        self.set_global_parameters(
+            {"am_pdp_mode": "inet", "am_pdp_host": "127.0.0.1", "am_pdp_port": port}
+        )
+        url = reverse("v2:amavis-quarantine-release-selection")
+        data = {
+            "selection": [
+                {
+                    "mailid": smart_str(msgrcpt.mail.mail_id),
+                    "rcpt": smart_str(msgrcpt.rid.email),
+                }
+                for msgrcpt in msgrcpts
+            ]
+        }
+        response = self.client.post(url, data, format="json")
+        self.assertEqual(response.status_code, 200)
+        content = response.json()
+        self.assertEqual(content["status"], "error")
+        self.assertEqual(len(content["errors"]), 1)
+        self.assertEqual(content["errors"][0]["mailid"], failed)
+        self.assertEqual(
+            content["errors"][0]["reply"], "450 4.5.0 Failure: message not found"
+        )
+        # All requests are sent over a single connection
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(
+            [request["mail_id"] for request in server.requests],
+            [item["mailid"] for item in data["selection"]],
+        )
+        for msgrcpt in msgrcpts:
+            msgrcpt.refresh_from_db()
+            expected = " " if smart_str(msgrcpt.mail.mail_id) == failed else "R"
+            self.assertEqual(msgrcpt.rs, expected)
+
     def test_release_request(self):
         """Test release request mode."""
         user = core_models.User.objects.get(username="user@test.com")
@@ -367,12 +463,19 @@ class QuarantineViewSetTestCase(TestDataMixin, ModoAPITestCase):
 
         self.msgrcpt.rs = " "
         self.msgrcpt.save(update_fields=["rs"])
-        self.set_global_parameter("sa_is_local", False)
+        spamd = FakeSpamdServer()
+        port = spamd.start()
+        self.addCleanup(spamd.stop)
+        self.set_global_parameters(
+            {"sa_is_local": False, "spamd_address": "127.0.0.1", "spamd_port": port}
+        )
         response = self.client.post(url, data, format="json")
         self.assertEqual(response.status_code, 204)
         worker.work(burst=True)
         self.msgrcpt.refresh_from_db()
         self.assertEqual(self.msgrcpt.rs, status)
+        self.assertEqual(len(spamd.messages), 1)
+        self.assertEqual(spamd.messages[0][1], action)
 
     def test_mark_as_ham(self):
         """Test mark_as_ham view."""
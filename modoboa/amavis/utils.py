@@ -104,3 +104,41 @@ class ConvertFrom(Func):
             template="%(expressions)s",
             arity=1,
         )
+
+
+class ConvertTo(Func):
+    """Convert a string to a binary value.
+
+    The opposite of ConvertFrom: comparing a binary column to the
+    result leaves the column untouched, so its indexes can be used.
+    """
+
+    """PostgreSQL implementation.
+    See https://www.postgresql.org/docs/9.3/static/functions-string.html#FUNCTIONS-STRING-OTHER"""  # NOQA:E501
+    function = "convert_to"
+    arity = 1
+    template = (
+        f"%(function)s(%(expressions)s, '{settings.AMAVIS_DEFAULT_DATABASE_ENCODING}')"
+    )
+
+    def as_mysql(self, compiler, connection):
+        """MySQL implementation.
+        See https://dev.mysql.com/doc/refman/5.5/en/cast-functions.html#function_convert
+        """  # NOQA:E501
+        return super().as_sql(
+            compiler,
+            connection,
+            function="CONVERT",
+            template="%(function)s(%(expressions)s USING binary)",
+            arity=1,
+        )
+
+    def as_sqlite(self, compiler, connection):
+        """SQLite implementation.
+        SQLite has no equivilant function, just return the field."""
+        return super().as_sql(
+            compiler,
+            connection,
+            template="%(expressions)s",
+            arity=1,
+        )
@@ -151,11 +151,14 @@ class QuarantineViewSet(viewsets.GenericViewSet):
                     "last_index": 0,
                     "prev_page": None,
                     "next_page": None,
+                    "next_cursor": None,
                     "results": [],
                 }
             )
             return response.Response(serializer.data)
-        email_list = connector.fetch(page.id_start, page.id_stop)
+        email_list, next_cursor = connector.fetch(
+            page.id_start, page.id_stop, request.GET.get("cursor")
+        )
         serializer = self.get_serializer(
             {
                 "count": total,
@@ -163,6 +166,7 @@ class QuarantineViewSet(viewsets.GenericViewSet):
                 "last_index": (page_num * page_size) + len(email_list),
                 "prev_page": page.previous_page_number if page.has_previous else None,
                 "next_page": page.next_page_number if page.has_next else None,
+                "next_cursor": next_cursor if page.has_next else None,
                 "results": email_list,
             }
         )
@@ -212,21 +216,28 @@ class QuarantineViewSet(viewsets.GenericViewSet):
                 connector.set_msgrcpt_status(smart_str(msgrcpt.rid.email), i, "p")
             return response.Response({"status": "pending"})
 
-        amr = AMrelease()
-        error = None
-        for mid, rcpt in msgrcpts:
-            # we can't use the .mail relation on rcpt because it leads to
-            # an error on Postgres (memoryview pickle error).
-            mail = models.Msgs.objects.get(pk=mid.encode("ascii"))
-            result = amr.sendreq(mid, mail.secret_id, rcpt.rid.email)
-            if result:
-                connector.set_msgrcpt_status(smart_str(rcpt.rid.email), mid, "R")
+        # we can't use the .mail relation on rcpt because it leads to
+        # an error on Postgres (memoryview pickle error).
+        secret_ids = {
+            smart_str(mail_id): secret_id
+            for mail_id, secret_id in models.Msgs.objects.filter(
+                pk__in=[mid.encode("ascii") for mid, rcpt in msgrcpts]
+            ).values_list("mail_id", "secret_id")
+        }
+        with AMrelease() as amr:
+            results = amr.release(
+                [(mid, secret_ids[mid], rcpt.rid.email) for mid, rcpt in msgrcpts]
+            )
+        errors = []
+        for (mid, rcpt), (released, reply) in zip(msgrcpts, results, strict=True):
+            rcpt_email = smart_str(rcpt.rid.email)
+            if released:
+                connector.set_msgrcpt_status(rcpt_email, mid, "R")
             else:
-                error = result
-                break
+                errors.append({"mailid": mid, "rcpt": rcpt_email, "reply": reply})
 
-        if error:
-            return response.Response({"status": error})
+        if errors:
+            return response.Response({"status": "error", "errors": errors})
 
         return response.Response({"status": "released"})
 
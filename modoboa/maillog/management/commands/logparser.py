@@ -16,20 +16,26 @@ Predefined events are:
 
 """
 
+import concurrent.futures
+import copy
 from datetime import datetime
+import glob
+import json
+import multiprocessing
 import os
 import re
+import signal
 import sys
 import time
 
 import rrdtool
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
 from django.utils import timezone
 
-from modoboa.admin.models import Domain
+from modoboa.admin.models import Domain, DomainAlias
 from modoboa.parameters import tools as param_tools
 from modoboa.lib import sysutils
 from modoboa.lib.email_utils import split_mailbox
@@ -41,6 +47,17 @@ from ... import models
 rrdstep = 60
 xpoints = 540
 points_per_sample = 3
+DEFAULT_BATCH_SIZE = 1000
+# Programs we have a parser for (see LogParser._parse_<program>)
+parsed_programs = ["postfix", "amavis", "rmilter"]
+# Postfix daemons which never log anything we are interested in
+ignored_postfix_programs = ["anvil", "master", "pickup", "scache", "tlsmgr"]
+# Delay (in seconds) between two reads of the log file in follow mode
+FOLLOW_POLL_INTERVAL = 1
+# Messages not completed after this delay (in seconds) are forgotten
+# (Postfix's default maximal_queue_lifetime is 5 days)
+WORKDICT_TTL = 5 * 86400
+WORKDICT_MAX_SIZE = 200000
 variables = [
     "sent",
     "recv",
@@ -51,13 +68,23 @@ variables = [
     "size_sent",
     "size_recv",
 ]
+# Parser inherited by worker processes (see LogParser._parse_logfiles_in_parallel)
+_worker_parser = None
 
 
 class LogParser:
 
     def __init__(self, options, workdir, year=None, greylist=False):
         """Constructor."""
-        self.logfile = options["logfile"]
+        logfiles = options["logfile"]
+        if isinstance(logfiles, str):
+            logfiles = [logfiles]
+        self.logfiles = []
+        for pattern in logfiles:
+            # Unmatched patterns are kept so errors are reported
+            self.logfiles += sorted(glob.glob(pattern)) or [pattern]
+        self.logfile = self.logfiles[0]
+        self.jobs = options.get("jobs") or os.cpu_count() or 1
         self.debug = options["debug"]
         self.verbose = options["verbose"]
         self.workdir = workdir
@@ -69,12 +96,20 @@ class LogParser:
             self.__year = curtime.tm_year
         self.curmonth = curtime.tm_mon
 
+        self.batch_size = options.get("batch_size") or DEFAULT_BATCH_SIZE
+
         self.data = {"global": {}}
-        self.domains = []
+        self.domains = set()
+        self.domain_ids = {}
         self._load_domain_list()
+        self.maillogs = []
+        self.skip_recorded = True
+        self._load_last_maillog()
 
         self.workdict = {}
         self.lupdates = {}
+        self.parsed_lines = 0
+        self.orig_ts = 0
 
         # set up regular expression
         self._date_expressions = [
@@ -114,23 +149,69 @@ class LogParser:
             variables.insert(4, "greylist")
             self._dprint("[settings] greylisting enabled")
 
-        self._prev_se = -1
-        self._prev_mi = -1
-        self._prev_ho = -1
+        self._minute_key = None
+        self._minute_ts = 0
         self.cur_t = 0
 
+        # Lines not produced by one of those programs (or produced by
+        # an ignored postfix daemon) are dropped before any parsing
+        self._parsers = {
+            prog: getattr(self, f"_parse_{prog}") for prog in parsed_programs
+        }
+        ignored = "|".join(ignored_postfix_programs)
+        others = "|".join(prog for prog in parsed_programs if prog != "postfix")
+        self.prefilter = re.compile(
+            rf"\s(?:postfix(?:/(?!(?:{ignored})\[)\w+)?|{others})\[\d+\]:\s"
+            r"(?!(?:dis)?connect from )"
+        )
+
     def _load_domain_list(self):
-        """Load the list of allowed domains."""
-        for dom in Domain.objects.all():
-            domname = str(dom.name)
-            self.domains += [domname]
+        """Load the list of allowed domains.
+
+        We also build a name to id map (alias domains point to their
+        target domain) used to fill Maillog records.
+        """
+        self.domain_ids.update(Domain.objects.values_list("name", "pk"))
+        # Also add alias domains
+        self.domain_ids.update(DomainAlias.objects.values_list("name", "target_id"))
+        for domname in self.domain_ids:
+            self.domains.add(domname)
             self.data[domname] = {}
 
-            # Also add alias domains
-            for alias in dom.domainalias_set.all():
-                aliasname = str(alias.name)
-                self.domains += [aliasname]
-                self.data[aliasname] = {}
+    def _load_last_maillog(self):
+        """Load information about the most recent Maillog record.
+
+        It is used to avoid recording the same delivery twice.
+        """
+        self.last_maillog_date = (
+            models.Maillog.objects.order_by("date")
+            .values_list("date", flat=True)
+            .last()
+        )
+        self.last_maillog_queue_ids = set()
+        if self.last_maillog_date is not None:
+            self.last_maillog_queue_ids = set(
+                models.Maillog.objects.filter(
+                    date=self.last_maillog_date
+                ).values_list("queue_id", flat=True)
+            )
+
+    def _add_maillog(self, **kwargs):
+        """Add a new Maillog record to the insertion buffer."""
+        self.maillogs.append(models.Maillog(**kwargs))
+        if len(self.maillogs) >= self.batch_size:
+            self._flush_maillogs()
+
+    def _flush_maillogs(self):
+        """Insert buffered Maillog records into database."""
+        if not self.maillogs:
+            return
+        with transaction.atomic():
+            models.Maillog.objects.bulk_create(
+                self.maillogs, batch_size=self.batch_size
+            )
+        self._dprint(f"[db] inserted {len(self.maillogs)} maillog records")
+        self.maillogs = []
 
     def _dprint(self, msg):
         """Print a debug message if required.
@@ -162,26 +243,20 @@ class LogParser:
             match = self.date_expr.match(line)
         if match is None:
             return None
-        ho = match.group("hour")
-        mi = match.group("min")
-        se = match.group("sec")
-        mo = match.group("month")
-        da = match.group("day")
-        try:
-            ye = match.group("year")
-        except IndexError:
-            ye = self.year(mo)
+        ye = match.group("year") if "year" in match.re.groupindex else None
+        key = (ye, match.group("month"), match.group("day"))
+        key += (match.group("hour"), match.group("min"))
+        if key != self._minute_key:
+            # Timestamps are only computed once per minute
+            ye, mo, da, ho, mi = key
+            if ye is None:
+                ye = self.year(mo)
+            self._minute_ts = lib.date_to_timestamp([ye, mo, da, ho, mi, "0"])
+            # Now get the current period (based on rrdstep)
+            self.cur_t = self._minute_ts - self._minute_ts % rrdstep
+            self._minute_key = key
         # Keep original timestamp
-        self.orig_ts = lib.date_to_timestamp([ye, mo, da, ho, mi, se])
-
-        # Now get the current period (based on rrdstep)
-        se = int(int(se) / rrdstep)  # rrd step is one-minute => se = 0
-        if self._prev_se != se or self._prev_mi != mi or self._prev_ho != ho:
-            self.cur_t = lib.date_to_timestamp([ye, mo, da, ho, mi, se])
-            self.cur_t = self.cur_t - self.cur_t % rrdstep
-            self._prev_mi = mi
-            self._prev_ho = ho
-            self._prev_se = se
+        self.orig_ts = self._minute_ts + int(match.group("sec"))
         return match.group("eol")
 
     def init_rrd(self, fname, m):
@@ -227,72 +302,66 @@ class LogParser:
         rrdtool.tune(fname, ds_def)
         self._dprint(f"[rrd] added DS {dsname} to {fname}")
 
-    def add_point_to_rrd(self, fname, tpl, values, ts=None):
-        """Try to add a new point to RRD file."""
-        if ts:
-            values = f"{ts}:{values}"
+    def add_points_to_rrd(self, fname, tpl, values):
+        """Try to add new points to RRD file, using a single update.
+
+        :param str fname: path of the RRD file
+        :param str tpl: template (list of data sources)
+        :param list values: list of "timestamp:value1:value2:..." points
+        """
         if self.verbose:
-            print(f"[rrd] VERBOSE update -t {tpl} {values}")
+            print(f"[rrd] VERBOSE update -t {tpl} {' '.join(values)}")
         try:
-            rrdtool.update(str(fname), "-t", tpl, values)
+            rrdtool.update(str(fname), "-t", tpl, *values)
         except rrdtool.OperationalError as e:
             op_match = re.match(r"unknown DS name '(\w+)'", str(e))
             if op_match is None:
                 raise
             self.add_datasource_to_rrd(str(fname), op_match.group(1))
-            rrdtool.update(str(fname), "-t", tpl, values)
+            rrdtool.update(str(fname), "-t", tpl, *values)
 
-    def update_rrd(self, dom, t):
+    def update_rrd(self, dom, points):
         """update_rrd
 
-        Update RRD with records at t time.
+        Update RRD with records at given times. Missing steps are
+        filled with zeros and everything is written using a single
+        rrdtool call.
 
-        True  : if data are up-to-date for current minute
-        False : syslog may have probably been already recorded
-        or something wrong
+        :param str dom: domain name
+        :param list points: sorted list of timestamps
+        :return: True if some points have been written, False if
+                 all were probably already recorded
         """
         fname = f"{self.workdir}/{dom}.rrd"
-        m = t - (t % rrdstep)
 
         self._dprint(f"[rrd] updating {fname}")
         if not os.path.exists(fname):
-            self.lupdates[fname] = self.init_rrd(fname, m)
+            first = points[0] - points[0] % rrdstep
+            self.lupdates[fname] = self.init_rrd(fname, first - rrdstep)
             self._dprint(f"[rrd] create new RRD file {fname}")
         else:
             if fname not in self.lupdates:
                 self.lupdates[fname] = rrdtool.last(str(fname))
 
-        if m <= self.lupdates[fname]:
-            if self.verbose:
-                print(f"[rrd] VERBOSE events at {m} already recorded in RRD")
+        tpl = ":".join(variables)
+        zeros = ":".join("0" for v in variables)
+        last = self.lupdates[fname]
+        values = []
+        for t in points:
+            m = t - (t % rrdstep)
+            if m <= last:
+                if self.verbose:
+                    print(f"[rrd] VERBOSE events at {m} already recorded in RRD")
+                continue
+            # Missing some RRD steps
+            values += [f"{p}:{zeros}" for p in range(last + rrdstep, m, rrdstep)]
+            counters = self.data[dom][t]
+            values.append(":".join([str(m)] + [str(counters[v]) for v in variables]))
+            last = m
+        if not values:
             return False
-
-        tpl = ""
-        for v in variables:
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        # Missing some RRD steps
-        # Est ce vraiment nécessaire... ?
-        if m > self.lupdates[fname] + rrdstep:
-            values = ""
-            for _v in variables:
-                if values != "":
-                    values += ":"
-                values += "0"
-            for p in range(self.lupdates[fname] + rrdstep, m, rrdstep):
-                self.add_point_to_rrd(fname, tpl, values, ts=p)
-
-        values = f"{m}"
-        tpl = ""
-        for v in variables:
-            values += ":"
-            values += str(self.data[dom][m][v])
-            if tpl != "":
-                tpl += ":"
-            tpl += v
-        self.add_point_to_rrd(fname, tpl, values)
-        self.lupdates[fname] = m
+        self.add_points_to_rrd(fname, tpl, values)
+        self.lupdates[fname] = last
         return True
 
     def initcounters(self, dom):
@@ -362,6 +431,37 @@ class LogParser:
         else:
             return mail_address
 
+    def _set_work_entry(self, key, **values):
+        """Store information about a message being processed.
+
+        Entries are stamped with the date of the log line so they can
+        expire if the message never completes.
+        """
+        self.workdict.pop(key, None)
+        self.workdict[key] = dict(values, ts=self.orig_ts)
+
+    def _expire_workdict(self):
+        """Remove old or exceeding entries from workdict.
+
+        Entries are removed when they are older than the maximum queue
+        lifetime or, starting with the oldest ones, when there are too
+        many of them.
+        """
+        limit = self.orig_ts - WORKDICT_TTL
+        expired = [
+            key for key, entry in self.workdict.items() if entry.get("ts", 0) < limit
+        ]
+        exceeding = len(self.workdict) - len(expired) - WORKDICT_MAX_SIZE
+        if exceeding > 0:
+            expired_keys = set(expired)
+            expired += [key for key in self.workdict if key not in expired_keys][
+                :exceeding
+            ]
+        for key in expired:
+            del self.workdict[key]
+        if expired:
+            self._dprint(f"[parser] {len(expired)} workdict entries expired")
+
     def _parse_amavis(self, log, host, pid, subprog):
         """Parse an Amavis log entry.
 
@@ -400,18 +500,18 @@ class LogParser:
         # Virus check must come before spam check due to pattern similarity.
         m = self._regex["rmilter_virus"].match(msg)
         if m is not None:
-            self.workdict[workdict_key] = {"action": "virus"}
+            self._set_work_entry(workdict_key, action="virus")
             return True
         m = self._regex["rmilter_spam"].match(msg)
         if m is not None:
-            self.workdict[workdict_key] = {"action": "spam"}
+            self._set_work_entry(workdict_key, action="spam")
             return True
 
         # Greylisting
         if self.greylist:
             m = self._regex["rmilter_greylist"].search(msg)
             if m is not None:
-                self.workdict[workdict_key] = {"action": "greylist"}
+                self._set_work_entry(workdict_key, action="greylist")
                 return True
 
         # Gather information about message sender and queue ID
@@ -458,23 +558,23 @@ class LogParser:
         # Message acknowledged.
         m = self._regex["message-id"].search(msg)
         if m is not None:
-            self.workdict[queue_id] = {"from": m.group(1), "size": 0}
+            self._set_work_entry(queue_id, **{"from": m.group(1), "size": 0})
             return True
 
         # Message enqueued.
         m = self._regex["from+size"].search(msg)
         if m is not None:
-            self.workdict[queue_id] = {
-                "from": self.reverse_srs(m.group(1)),
-                "size": int(m.group(2)),
-            }
+            self._set_work_entry(
+                queue_id,
+                **{"from": self.reverse_srs(m.group(1)), "size": int(m.group(2))},
+            )
             return True
 
         # Message disposition.
         m = self._regex["to+status"].search(msg)
         if m is None:
             return False
-        (msg_to, msg_status) = m.groups()
+        msg_to, msg_status = m.groups()
         if queue_id not in self.workdict:
             self._dprint(f"[parser] inconsistent mail ({queue_id}: {msg_to}), skipping")
             return True
@@ -506,35 +606,24 @@ class LogParser:
         else:
             self.inc_counter(to_domain, msg_status)
 
-        last_message = models.Maillog.objects.last()
         cur_dt = datetime.fromtimestamp(self.orig_ts)
         tz = timezone.get_current_timezone()
         cur_dt = cur_dt.replace(tzinfo=tz)
-        condition = last_message and (
-            cur_dt < last_message.date
-            or (
-                cur_dt == last_message.date
-                and models.Maillog.objects.filter(
-                    date=cur_dt, queue_id=queue_id
-                ).exists()
+        condition = (
+            self.skip_recorded
+            and self.last_maillog_date is not None
+            and (
+                cur_dt < self.last_maillog_date
+                or (
+                    cur_dt == self.last_maillog_date
+                    and queue_id in self.last_maillog_queue_ids
+                )
             )
         )
         if not condition:
-            if from_domain in self.domains:
-                from_domain = Domain.objects.filter(
-                    Q(name=from_domain) | Q(domainalias__name=from_domain)
-                ).first()
-            else:
-                from_domain = None
-            if to_domain in self.domains:
-                to_domain = Domain.objects.filter(
-                    Q(name=to_domain) | Q(domainalias__name=to_domain)
-                ).first()
-            else:
-                to_domain = None
-            if msg_status == "sent" and to_domain:
+            if msg_status == "sent" and to_domain in self.domain_ids:
                 msg_status = "received"
-            models.Maillog.objects.create(
+            self._add_maillog(
                 queue_id=queue_id,
                 date=cur_dt,
                 sender=self.workdict[queue_id]["from"],
@@ -542,8 +631,8 @@ class LogParser:
                 original_rcpt=msg_orig_to,
                 size=self.workdict[queue_id]["size"],
                 status=msg_status,
-                from_domain=from_domain,
-                to_domain=to_domain,
+                from_domain_id=self.domain_ids.get(from_domain),
+                to_domain_id=self.domain_ids.get(to_domain),
             )
 
         return True
@@ -553,6 +642,8 @@ class LogParser:
 
         :param str line: log line
         """
+        if self.prefilter is not None and self.prefilter.search(line) is None:
+            return
         line = self._parse_date(line)
         if line is None:
             return
@@ -561,31 +652,244 @@ class LogParser:
             return
         host, prog, subprog, pid, log = m.groups()
 
-        try:
-            parser = getattr(self, f"_parse_{prog}")
-            if not parser(log, host, pid, subprog):
-                self._dprint(f"[parser] ignoring {prog!r} log: {log!r}")
-        except AttributeError:
+        parser = self._parsers.get(prog)
+        if parser is None:
             self._dprint(f'[parser] no log handler for "{prog}": {log}')
+        elif not parser(log, host, pid, subprog):
+            self._dprint(f"[parser] ignoring {prog!r} log: {log!r}")
+
+    def _get_state_path(self):
+        """Return the path of the file used to store parsing state."""
+        return os.path.join(self.workdir, "logparser.state")
+
+    def _load_state(self):
+        """Load parsing state saved by previous runs.
+
+        :return: a dict indexed by log file path
+        """
+        try:
+            with open(self._get_state_path()) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, states):
+        """Save parsing state for next runs."""
+        path = self._get_state_path()
+        with open(f"{path}.tmp", "w") as fp:
+            json.dump(states, fp)
+        os.replace(f"{path}.tmp", path)
+
+    def _find_rotated_file(self, inode):
+        """Look for the file a rotated log file has been renamed to.
+
+        :param int inode: inode of the log file before rotation
+        :return: a path or None
+        """
+        dirname, basename = os.path.split(os.path.abspath(self.logfile))
+        for entry in os.scandir(dirname):
+            if entry.name == basename or not entry.name.startswith(basename):
+                continue
+            if entry.is_file() and entry.inode() == inode:
+                return entry.path
+        return None
+
+    def _parse_file(self, path, offset=0):
+        """Parse the given file, starting at offset.
+
+        An incomplete last line is left for the next run.
+
+        :param str path: path of the file to parse
+        :param int offset: position (in bytes) to start from
+        :return: position (in bytes) of the first line not parsed
+        """
+        with open(path, "rb") as fp:
+            fp.seek(offset)
+            for line in fp:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                self.parsed_lines += 1
+                self._parse_line(line.decode("utf-8", errors="ignore"))
+        return offset
+
+    def _parse_new_lines(self, state):
+        """Parse lines added to log file since last run.
+
+        Rotations (file renamed or truncated) are detected using the
+        inode and the position saved during last run.
+
+        :param dict state: state saved by last run (can be empty)
+        :return: the new state
+        """
+        stat = os.stat(self.logfile)
+        offset = 0
+        # Without saved state, lines might have been recorded by a
+        # previous version which did not save its position
+        self.skip_recorded = not state
+        if state.get("inode") == stat.st_ino:
+            if state["offset"] <= stat.st_size:
+                offset = state["offset"]
+            else:
+                self._dprint("[parser] log file truncated, parsing it from the start")
+        elif state:
+            rotated = self._find_rotated_file(state["inode"])
+            if rotated is not None and state["offset"] <= os.path.getsize(rotated):
+                self._dprint(f"[parser] log file rotated, finishing {rotated}")
+                self._parse_file(rotated, state["offset"])
+        offset = self._parse_file(self.logfile, offset)
+        return {"inode": stat.st_ino, "offset": offset, "workdict": self.workdict}
+
+    def _flush_rrd(self, until=None):
+        """Write collected counters to RRD files.
+
+        :param int until: only write points older than this timestamp
+        """
+        for dom, data in self.data.items():
+            points = sorted(t for t in data if until is None or t < until)
+            if not points:
+                continue
+            self._dprint(f"[rrd] dealing with domain {dom}")
+            self.update_rrd(dom, points)
+            for t in points:
+                del data[t]
+
+    def _merge_data(self, data):
+        """Add counters collected by another parser to ours."""
+        for dom, points in data.items():
+            current = self.data.setdefault(dom, {})
+            for t, counters in points.items():
+                if t not in current:
+                    current[t] = dict(counters)
+                    continue
+                for v, value in counters.items():
+                    current[t][v] = current[t].get(v, 0) + value
+
+    def _parse_logfiles_in_parallel(self, states):
+        """Parse log files using a pool of processes.
+
+        Each worker inserts its own Maillog records and returns its
+        counters, merged in log file order so the result does not
+        depend on scheduling.
+        """
+        global _worker_parser
+
+        # Workers inherit the parser through fork, nothing is pickled
+        _worker_parser = self
+        # A connection shared with a worker would be closed by it:
+        # workers open their own connections. Connections used by an
+        # atomic block (ie. in tests) are left alone, closing them
+        # would roll the transaction back.
+        for connection in connections.all(initialized_only=True):
+            if not connection.in_atomic_block:
+                connection.close()
+        context = multiprocessing.get_context("fork")
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(self.jobs, len(self.logfiles)), mp_context=context
+            ) as executor:
+                results = executor.map(
+                    parse_logfile,
+                    self.logfiles,
+                    [states.get(logfile, {}) for logfile in self.logfiles],
+                )
+                for logfile, (state, data) in zip(self.logfiles, results, strict=True):
+                    states[logfile] = state
+                    self._merge_data(data)
+        finally:
+            _worker_parser = None
 
     def process(self):
-        """Process the log file.
+        """Process the log files.
 
-        We parse it and then generate standard graphics (day, week,
-        month).
+        We only parse lines added since last run (and not yet parsed
+        lines of the rotated file if any) and then update RRD files.
+        When several log files are given, they are parsed in parallel.
         """
+        states = self._load_state()
         try:
-            with open(self.logfile, encoding="utf-8", errors="ignore") as fp:
-                for line in fp:
-                    self._parse_line(line)
+            if self.jobs > 1 and len(self.logfiles) > 1:
+                self._parse_logfiles_in_parallel(states)
+            else:
+                for logfile in self.logfiles:
+                    self.logfile = logfile
+                    state = states.get(logfile, {})
+                    self.workdict = state.get("workdict", {})
+                    states[logfile] = self._parse_new_lines(state)
+                    self._expire_workdict()
         except OSError as errno:
             self._dprint(f"{errno}")
             sys.exit(1)
+        self._flush_maillogs()
+        self._flush_rrd()
+        self._save_state(states)
 
-        for dom, data in self.data.items():
-            self._dprint(f"[rrd] dealing with domain {dom}")
-            for t in sorted(data.keys()):
-                self.update_rrd(dom, t)
+    def stop(self):
+        """Ask follow mode to stop."""
+        self.running = False
+
+    def follow(self, flush_interval, flush_lines):
+        """Follow the log file (like tail -F) and record events.
+
+        Results are flushed every flush_interval seconds or every
+        flush_lines lines. Points of the current minute are kept in
+        memory until the minute is over.
+
+        :param int flush_interval: maximum delay (in seconds) between flushes
+        :param int flush_lines: maximum number of lines between flushes
+        """
+        states = self._load_state()
+        state = states.get(self.logfile, {})
+        self.workdict = state.get("workdict", {})
+        last_flush = time.monotonic()
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    state = self._parse_new_lines(state)
+                except FileNotFoundError:
+                    # Log file is being rotated
+                    pass
+                elapsed = time.monotonic() - last_flush
+                if elapsed >= flush_interval or self.parsed_lines >= flush_lines:
+                    now = int(time.time())
+                    self._flush_maillogs()
+                    self._flush_rrd(max(self.cur_t, now - now % rrdstep - rrdstep))
+                    self._expire_workdict()
+                    states[self.logfile] = state
+                    self._save_state(states)
+                    last_flush = time.monotonic()
+                    self.parsed_lines = 0
+                else:
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+        finally:
+            self._flush_maillogs()
+            self._flush_rrd()
+            states[self.logfile] = state
+            self._save_state(states)
+
+
+def parse_logfile(logfile, state):
+    """Parse new lines of a log file in a worker process.
+
+    Maillog records are inserted by batches, like in the main process.
+
+    :param str logfile: path of the log file to parse
+    :param dict state: state saved by last run for this file
+    :return: a (state, counters) tuple
+    """
+    parser = copy.copy(_worker_parser)
+    parser._parsers = {
+        prog: getattr(parser, f"_parse_{prog}") for prog in parser._parsers
+    }
+    parser.logfile = logfile
+    parser.data = {dom: {} for dom in _worker_parser.data}
+    parser.maillogs = []
+    parser.workdict = state.get("workdict", {})
+    state = parser._parse_new_lines(state)
+    parser._expire_workdict()
+    parser._flush_maillogs()
+    return state, parser.data
 
 
 class Command(BaseCommand):
@@ -596,8 +900,18 @@ class Command(BaseCommand):
         parser.add_argument(
             "--logfile",
             default=None,
-            help="postfix log in syslog format",
+            help=(
+                "postfix log in syslog format (several files or glob "
+                "patterns can be given, one per MX host)"
+            ),
             metavar="FILE",
+            nargs="+",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=None,
+            help="Number of processes used to parse several log files",
         )
         parser.add_argument(
             "--post-cmd",
@@ -606,6 +920,30 @@ class Command(BaseCommand):
             metavar="ARG",
             nargs="+",
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="Number of message logs inserted at once into database",
+        )
+        parser.add_argument(
+            "--follow",
+            default=False,
+            action="store_true",
+            help="Keep running and parse new lines as they are written",
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=int,
+            default=60,
+            help="In follow mode, maximum delay (in seconds) between two flushes",
+        )
+        parser.add_argument(
+            "--flush-lines",
+            type=int,
+            default=10000,
+            help="In follow mode, maximum number of lines parsed between two flushes",
+        )
         parser.add_argument(
             "--verbose",
             default=False,
@@ -646,6 +984,15 @@ class Command(BaseCommand):
         p = LogParser(
             options, param_tools.get_global_parameter("rrd_rootdir"), None, greylist
         )
-        p.process()
+        if options["follow"]:
+            if len(p.logfiles) > 1:
+                raise CommandError("Follow mode only supports a single log file")
+            signal.signal(signal.SIGTERM, lambda signum, frame: p.stop())
+            try:
+                p.follow(options["flush_interval"], options["flush_lines"])
+            except KeyboardInterrupt:
+                pass
+        else:
+            p.process()
         if options["post_cmd"] is not None:
             sysutils.exec_cmd(options["post_cmd"])
@@ -0,0 +1,89 @@
+"""Measure log parser throughput on a synthetic corpus."""
+
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from .logparser import LogParser
+
+MESSAGE_TEMPLATE = [
+    "postfix/smtpd[{pid}]: connect from mx.example.org[192.0.2.1]",
+    "postfix/smtpd[{pid}]: {qid}: client=mx.example.org[192.0.2.1]",
+    "postfix/cleanup[{pid}]: {qid}: message-id=<{qid}@example.org>",
+    "postfix/qmgr[{pid}]: {qid}: from=<sender@example.org>, size={size}, nrcpt=1 (queue active)",  # noqa
+    "amavis[{pid}]: ({pid}-01) Passed CLEAN {{RelayedInbound}}, [192.0.2.1]:54810 <sender@example.org> -> <user@{domain}>, Hits: -1.481, size: {size}, queued_as: {qid}, 1017 ms",  # noqa
+    "postfix/smtpd[{pid}]: disconnect from mx.example.org[192.0.2.1] ehlo=1 mail=1 rcpt=1 data=1 quit=1 commands=5",  # noqa
+    "postfix/lmtp[{pid}]: {qid}: to=<user@{domain}>, relay=mail.{domain}[private/dovecot-lmtp], delay=0.32, delays=0.11/0.01/0.01/0.2, dsn=2.0.0, status=sent (250 2.0.0 Saved)",  # noqa
+    "postfix/qmgr[{pid}]: {qid}: removed",
+    "postfix/anvil[{pid}]: statistics: max connection rate 1/60s for (smtp:192.0.2.1) at Oct 18 11:03:12",  # noqa
+]
+
+
+class Command(BaseCommand):
+    help = "Measure log parser throughput (lines per second)"
+
+    def add_arguments(self, parser):
+        """Add extra arguments to command line."""
+        parser.add_argument(
+            "--lines",
+            type=int,
+            default=1000000,
+            help="Number of lines of the synthetic corpus",
+        )
+        parser.add_argument(
+            "--logfile",
+            default=None,
+            help="Use this log file instead of a synthetic corpus",
+            metavar="FILE",
+        )
+        parser.add_argument(
+            "--no-prefilter",
+            default=False,
+            action="store_true",
+            help="Disable line prefiltering",
+        )
+
+    def generate_corpus(self, path, lines, domain):
+        """Write a synthetic log file."""
+        with open(path, "w") as fp:
+            for count in range(lines):
+                message, step = divmod(count, len(MESSAGE_TEMPLATE))
+                hours, minutes = divmod(count // 6000, 60)
+                seconds = count // 100 % 60
+                date = f"Oct 18 {hours % 24:02d}:{minutes:02d}:{seconds:02d}"
+                entry = MESSAGE_TEMPLATE[step].format(
+                    pid=1000 + message % 5000,
+                    qid=f"{message:010X}",
+                    size=1000 + message % 100000,
+                    domain=domain,
+                )
+                fp.write(f"{date} server {entry}\n")
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp()
+        logfile = options["logfile"]
+        domain = "example.test"
+        if logfile is None:
+            logfile = os.path.join(workdir, "mail.log")
+            self.generate_corpus(logfile, options["lines"], domain)
+        parser = LogParser(
+            {"logfile": logfile, "debug": False, "verbose": False}, workdir
+        )
+        parser.domains.add(domain)
+        parser.data[domain] = {}
+        if options["no_prefilter"]:
+            parser.prefilter = None
+        # We only measure parsing: records are not saved
+        parser._flush_maillogs = parser.maillogs.clear
+        start = time.perf_counter()
+        parser._parse_file(logfile)
+        duration = time.perf_counter() - start
+        if options["logfile"] is None:
+            os.remove(logfile)
+        os.rmdir(workdir)
+        self.stdout.write(
+            f"{parser.parsed_lines} lines parsed in {duration:.2f}s "
+            f"({parser.parsed_lines / duration:.0f} lines/s)"
+        )
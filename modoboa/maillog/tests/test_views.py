@@ -1,9 +1,13 @@
 """modoboa-stats tests."""
 
+import concurrent.futures
 import datetime
+import io
+import json
 import os
 import shutil
 import tempfile
+from unittest import mock
 
 from django.conf import settings
 from django.core.management import call_command
@@ -11,7 +15,7 @@ from django.test import override_settings
 
 from modoboa.admin import factories as admin_factories
 from modoboa.lib.tests import SimpleModoTestCase
-from modoboa.maillog import jobs
+from modoboa.maillog import jobs, models
 
 
 class RunCommandsMixin:
@@ -28,14 +32,19 @@ class RunCommandsMixin:
         if os.path.exists(pid_file):
             os.remove(pid_file)
 
-    def run_logparser(self, *args, **options):
-        """Run logparser command."""
+    def prepare_logfile(self):
+        """Copy test log file to workdir."""
         path = os.path.join(os.path.dirname(__file__), "mail.log")
         with open(path) as fp:
             content = fp.read() % {"day": datetime.date.today().strftime("%b %d")}
         path = os.path.join(self.workdir, "mail.log")
         with open(path, "w") as fp:
             fp.write(content)
+        return path
+
+    def run_logparser(self, *args, **options):
+        """Run logparser command."""
+        path = self.prepare_logfile()
         self.set_global_parameter("logfile", path)
         jobs.logparser(*args, **options)
 
@@ -47,6 +56,20 @@ class RunCommandsMixin:
             jobs.update_statistics()
 
 
+class InlineExecutor(concurrent.futures.Executor):
+    """Run tasks in the test process.
+
+    Records inserted by worker processes would be committed outside
+    the test transaction.
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def map(self, fn, *iterables, **kwargs):
+        return map(fn, *iterables)
+
+
 @override_settings(RRDTOOL_TEST_MODE=True)
 class ManagementCommandsTestCase(RunCommandsMixin, SimpleModoTestCase):
     """Management command test cases."""
@@ -87,7 +110,6 @@ class ManagementCommandsTestCase(RunCommandsMixin, SimpleModoTestCase):
             self.run_logparser()
         self.assertEqual(inst.exception.code, 2)
 
-
     def test_logparser_post_cmd(self):
         """Test logparser command."""
         path = os.path.join(os.path.dirname(__file__), ".post-cmd-has-run")
@@ -108,3 +130,152 @@ class ManagementCommandsTestCase(RunCommandsMixin, SimpleModoTestCase):
         for d in ["global", "test.com"]:
             path = os.path.join(self.workdir, f"{d}.rrd")
             self.assertTrue(os.path.exists(path))
+
+    def test_logparser_checkpoint(self):
+        """Check that only new lines are parsed."""
+        self.run_logparser()
+        pid_file = f"{settings.PID_FILE_STORAGE_PATH}/modoboa_logparser.pid"
+        logfile = os.path.join(self.workdir, "mail.log")
+        with open(os.path.join(self.workdir, "logparser.state")) as fp:
+            state = json.load(fp)[logfile]
+        self.assertEqual(state["offset"], os.path.getsize(logfile))
+        count = models.Maillog.objects.count()
+        self.assertGreater(count, 0)
+
+        # Nothing new
+        os.remove(pid_file)
+        jobs.logparser()
+        self.assertEqual(models.Maillog.objects.count(), count)
+
+        # Rotation: old file is renamed and a new one is created
+        with open(logfile, "a") as fp:
+            fp.write(
+                f"{datetime.date.today().strftime('%b %d')} 23:59:00 server "
+                "postfix/qmgr[26163]: 0AB1234567: "
+                "from=<sender@example.com>, size=100, nrcpt=1 (queue active)\n"
+            )
+        os.rename(logfile, f"{logfile}.1")
+        with open(logfile, "w") as fp:
+            fp.write(
+                f"{datetime.date.today().strftime('%b %d')} 23:59:01 server "
+                "postfix/lmtp[28946]: 0AB1234567: to=<user@test.com>, "
+                "relay=local, delay=0.32, dsn=2.0.0, status=sent (250 2.0.0 Saved)\n"
+            )
+        os.remove(pid_file)
+        jobs.logparser()
+        self.assertEqual(models.Maillog.objects.count(), count + 1)
+        self.assertTrue(
+            models.Maillog.objects.filter(
+                queue_id="0AB1234567", sender="sender@example.com"
+            ).exists()
+        )
+
+    def test_logparser_batch_size(self):
+        """Check that records are inserted whatever the batch size."""
+        self.run_logparser(batch_size=2)
+        self.assertEqual(models.Maillog.objects.count(), 20)
+        self.assertTrue(
+            models.Maillog.objects.filter(
+                status="received", to_domain__name="test.com"
+            ).exists()
+        )
+
+    def test_logparser_rrd_single_update(self):
+        """Check that each RRD file is updated using a single call."""
+        from modoboa.maillog.management.commands import logparser
+
+        with mock.patch.object(
+            logparser.rrdtool, "update", wraps=logparser.rrdtool.update
+        ) as update:
+            self.run_logparser()
+        fnames = [call.args[0] for call in update.call_args_list]
+        self.assertEqual(len(fnames), len(set(fnames)))
+        self.assertIn(os.path.join(self.workdir, "test.com.rrd"), fnames)
+
+    def test_logparser_follow(self):
+        """Test follow mode."""
+        from modoboa.maillog.management.commands.logparser import LogParser
+
+        path = self.prepare_logfile()
+        parser = LogParser(
+            {"logfile": path, "debug": False, "verbose": False}, self.workdir
+        )
+        with mock.patch("time.sleep", side_effect=lambda delay: parser.stop()):
+            parser.follow(flush_interval=3600, flush_lines=100)
+        self.assertEqual(models.Maillog.objects.count(), 20)
+        for d in ["global", "test.com"]:
+            self.assertTrue(os.path.exists(os.path.join(self.workdir, f"{d}.rrd")))
+        with open(os.path.join(self.workdir, "logparser.state")) as fp:
+            state = json.load(fp)[path]
+        self.assertEqual(state["offset"], os.path.getsize(path))
+
+    def test_logparser_workdict_expiry(self):
+        """Check that uncompleted messages are forgotten."""
+        from modoboa.maillog.management.commands import logparser
+
+        parser = logparser.LogParser(
+            {"logfile": self.prepare_logfile(), "debug": False, "verbose": False},
+            self.workdir,
+        )
+        parser.orig_ts = logparser.WORKDICT_TTL + 100
+        parser.workdict = {
+            "A": {"from": "a@test.com", "size": 1, "ts": 0},
+            "B": {"from": "b@test.com", "size": 1, "ts": 50},
+            "C": {"from": "c@test.com", "size": 1, "ts": 200},
+            "D": {"from": "d@test.com", "size": 1, "ts": 300},
+        }
+        with mock.patch.object(logparser, "WORKDICT_MAX_SIZE", 1):
+            parser._expire_workdict()
+        self.assertEqual(list(parser.workdict), ["D"])
+
+    def test_logparser_prefilter(self):
+        """Check lines dropped before parsing."""
+        from modoboa.maillog.management.commands import logparser
+
+        parser = logparser.LogParser(
+            {"logfile": self.prepare_logfile(), "debug": False, "verbose": False},
+            self.workdir,
+        )
+        prefix = "Oct 18 10:00:00 server"
+        for line, expected in [
+            (f"{prefix} postfix/qmgr[1]: 0AB: from=<a@test.com>", True),
+            (f"{prefix} postfix[1]: 0AB: from=<a@test.com>", True),
+            (f"{prefix} amavis[1]: (1-01) Passed CLEAN", True),
+            (f"{prefix} postfix/anvil[1]: statistics: max rate", False),
+            (f"{prefix} postfix/smtpd[1]: connect from mx[192.0.2.1]", False),
+            (f"{prefix} dovecot[1]: imap-login: Login", False),
+        ]:
+            with self.subTest(line=line):
+                self.assertEqual(parser.prefilter.search(line) is not None, expected)
+        with mock.patch.object(parser, "_parse_postfix") as parse_postfix:
+            parser._parsers["postfix"] = parse_postfix
+            parser._parse_line(f"{prefix} postfix[1]: 0AB: from=<a@test.com>")
+        parse_postfix.assert_called_once_with(
+            "0AB: from=<a@test.com>", "server", "1", ""
+        )
+
+    def test_logparser_several_files(self):
+        """Check parsing of several log files in parallel."""
+        from modoboa.maillog.management.commands import logparser
+
+        path = self.prepare_logfile()
+        shutil.copy(path, f"{path}-mx2")
+        with mock.patch.object(
+            logparser.concurrent.futures, "ProcessPoolExecutor", InlineExecutor
+        ):
+            self.run_logparser(
+                "--logfile", f"{path}*", "--jobs", "2", "--batch-size", "3"
+            )
+        self.assertEqual(models.Maillog.objects.count(), 40)
+        for d in ["global", "test.com"]:
+            self.assertTrue(os.path.exists(os.path.join(self.workdir, f"{d}.rrd")))
+        with open(os.path.join(self.workdir, "logparser.state")) as fp:
+            states = json.load(fp)
+        self.assertEqual(sorted(states), [path, f"{path}-mx2"])
+        self.assertIsNone(logparser._worker_parser)
+
+    def test_logparser_benchmark(self):
+        """Test logparser_benchmark command."""
+        stdout = io.StringIO()
+        call_command("logparser_benchmark", "--lines", "900", stdout=stdout)
+        self.assertIn("900 lines parsed", stdout.getvalue())
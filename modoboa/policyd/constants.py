@@ -1,3 +1,53 @@
 """App. related constants."""
 
 REDIS_HASHNAME = "messages_count"
+
+# Maximum number of connections opened to Redis by the policy daemon
+REDIS_MAX_CONNECTIONS = 50
+
+# Check given counters and decrement them only if none is exhausted.
+# KEYS[1] is the hash name, ARGV contains the counter names.
+# Returns {0, index, counter} if a limit is reached, {1, counter, ...}
+# with new values (or nil for unlimited items) otherwise.
+CHECK_AND_DECREMENT_SCRIPT = """
+local counters = {}
+for i, name in ipairs(ARGV) do
+    local counter = redis.call("HGET", KEYS[1], name)
+    if counter and tonumber(counter) <= 0 then
+        return {0, i, counter}
+    end
+    counters[i] = counter
+end
+local result = {1}
+for i, name in ipairs(ARGV) do
+    if counters[i] then
+        result[i + 1] = redis.call("HINCRBY", KEYS[1], name, -1)
+    else
+        result[i + 1] = false
+    end
+end
+return result
+"""
+
+# Seconds a connection can stay idle before being closed. Postfix
+# closes idle policy connections after 300s by default
+# (smtpd_policy_service_max_idle) so we wait a bit longer.
+DEFAULT_IDLE_TIMEOUT = 330
+
+# Maximum number of client connections handled simultaneously
+DEFAULT_MAX_CONNECTIONS = 500
+
+# Maximum time (in seconds) allowed to process a single request
+REQUEST_TIMEOUT = 5
+
+# Maximum number of threads used to run blocking tasks (DB access)
+EXECUTOR_MAX_WORKERS = 4
+
+# Seconds to wait before sending notifications, so that limits reached
+# simultaneously are notified together
+NOTIFICATION_BATCH_DELAY = 5
+
+ALARM_INTERNAL_NAME = "sending_limit"
+
+# Number of objects loaded at once when counters are reset
+RESET_CHUNK_SIZE = 5000
@@ -2,15 +2,20 @@
 
 from asgiref.sync import sync_to_async
 import asyncio
+import collections
 import concurrent.futures
+import contextlib
 from email.message import EmailMessage
+import functools
 import logging
+import weakref
 
 import aiosmtplib
 from dateutil.relativedelta import relativedelta
 from redis import asyncio as aioredis
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import connections
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -22,7 +27,7 @@ from modoboa.admin import models as admin_models
 from modoboa.core import models as core_models
 from modoboa.lib.email_utils import split_mailbox
 
-from . import constants
+from . import constants, utils
 
 logger = logging.getLogger("modoboa.policyd")
 
@@ -31,15 +36,31 @@ SUCCESS_ACTION = b"dunno"
 FAILURE_ACTION = b"defer_if_permit Daily limit reached, retry later"
 
 
+# One client (and thus one connection pool) per event loop
+_redis_clients = weakref.WeakKeyDictionary()
+
+
 def get_redis_client():
+    """Return the shared Redis client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    rclient = _redis_clients.get(loop)
+    if rclient is not None:
+        return rclient
     if not getattr(settings, "REDIS_SENTINEL", False):
-        return aioredis.from_url(
-            settings.REDIS_URL, encoding="utf-8", decode_responses=True
+        pool = aioredis.BlockingConnectionPool.from_url(
+            settings.REDIS_URL,
+            max_connections=constants.REDIS_MAX_CONNECTIONS,
+            encoding="utf-8",
+            decode_responses=True,
         )
-    sentinel = aioredis.sentinel.Sentinel(
-        settings.REDIS_SENTINELS, socket_timeout=0.1, db=settings.REDIS_QUOTA_DB
-    )
-    return sentinel.master_for(settings.REDIS_MASTER, socket_timeout=0.1)
+        rclient = aioredis.Redis(connection_pool=pool)
+    else:
+        sentinel = aioredis.sentinel.Sentinel(
+            settings.REDIS_SENTINELS, socket_timeout=0.1, db=settings.REDIS_QUOTA_DB
+        )
+        rclient = sentinel.master_for(settings.REDIS_MASTER, socket_timeout=0.1)
+    _redis_clients[loop] = rclient
+    return rclient
 
 
 def close_db_connections(func, *args, **kwargs):
@@ -81,73 +102,185 @@ async def run_at(dt, coro, *args):
     return await coro(*args)
 
 
-@close_db_connections
-def get_local_config():
-    """Return local configuration."""
-    return core_models.LocalConfig.objects.first()
+_executor = None
 
 
-@close_db_connections
-def get_notification_recipients():
-    """Return superadmins with a mailbox."""
-    return core_models.User.objects.filter(is_superuser=True, mailbox__isnull=False)
+def get_executor():
+    """Return the executor shared by all blocking tasks."""
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=constants.EXECUTOR_MAX_WORKERS,
+            thread_name_prefix="policyd",
+        )
+    return _executor
+
+
+def get_day_start():
+    """Return the datetime at which current day started."""
+    return timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
 
 
-@close_db_connections
 def create_alarm(ltype, name):
-    """Create a new alarm."""
+    """Create a new alarm, unless one has already been created today.
+
+    :return: True if an alarm has been created, False otherwise
+    """
     title = _("Daily sending limit reached")
-    internal_name = "sending_limit"
-    if ltype == "domain":
-        domain = admin_models.Domain.objects.get(name=name)
-        domain.alarms.create(title=title, internal_name=internal_name)
-    else:
-        localpart, domain = split_mailbox(name)
-        mailbox = admin_models.Mailbox.objects.get(
-            address=localpart, domain__name=domain
-        )
-        mailbox.alarms.create(
-            domain=mailbox.domain, title=title, internal_name=internal_name
-        )
+    try:
+        if ltype == "domain":
+            target = admin_models.Domain.objects.get(name=name)
+            alarms = target.alarms.filter(mailbox__isnull=True)
+            extra = {}
+        else:
+            localpart, domain = split_mailbox(name)
+            target = admin_models.Mailbox.objects.select_related("domain").get(
+                address=localpart, domain__name=domain
+            )
+            alarms = target.alarms.all()
+            extra = {"domain": target.domain}
+    except ObjectDoesNotExist:
+        logger.warning(f"Unknown {ltype} {name}, no alarm created")
+        return False
+    already_created = alarms.filter(
+        internal_name=constants.ALARM_INTERNAL_NAME, created__gte=get_day_start()
+    ).exists()
+    if already_created:
+        return False
+    target.alarms.create(
+        title=title, internal_name=constants.ALARM_INTERNAL_NAME, **extra
+    )
+    return True
 
 
-async def notify_limit_reached(ltype, name):
-    """Send a notification to super admins about item."""
+@close_db_connections
+def prepare_notifications(items):
+    """Create alarms and return what is needed to notify super admins.
+
+    :param list items: list of (limit type, name) tuples
+    :return: a (sender, recipients, items) tuple, items being reduced
+             to the ones not already notified today
+    """
+    lc = core_models.LocalConfig.objects.first()
+    sender = lc.parameters.get_value("sender_address", app="core")
+    recipients = list(
+        core_models.User.objects.filter(is_superuser=True, mailbox__isnull=False)
+    )
+    items = [item for item in items if create_alarm(*item)]
+    return sender, recipients, items
+
+
+def build_notification(sender, recipient, ltype, name):
+    """Build the notification sent to recipient about item."""
     ltype_translations = {
         "account": gettext_lazy("account"),
         "domain": gettext_lazy("domain"),
     }
-    # We're going to execute sync code so we need an executor
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
-    loop = asyncio.get_event_loop()
-    futures = [
-        loop.run_in_executor(executor, get_local_config),
-        loop.run_in_executor(executor, get_notification_recipients),
-        loop.run_in_executor(executor, create_alarm, ltype, name),
-    ]
-    lc, recipients, junk = await asyncio.gather(*futures)
-    sender = lc.parameters.get_value("sender_address", app="core")
-    for recipient in recipients:
-        with translation.override(recipient.language):
-            content = render_to_string(
-                "policyd/notifications/limit_reached.html",
-                {"ltype": ltype_translations[ltype], "name": name},
-            )
-            subject = _("[modoboa] Sending limit reached")
-        msg = EmailMessage()
-        msg["From"] = sender
-        msg["To"] = recipient.email
-        msg["Subject"] = subject
-        msg.set_content(content)
-        await aiosmtplib.send(msg)
+    with translation.override(recipient.language):
+        content = render_to_string(
+            "policyd/notifications/limit_reached.html",
+            {"ltype": ltype_translations[ltype], "name": name},
+        )
+        subject = _("[modoboa] Sending limit reached")
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = recipient.email
+    msg["Subject"] = subject
+    msg.set_content(content)
+    return msg
+
+
+class LimitNotifier:
+    """Notify super admins about reached limits.
+
+    An item is notified at most once a day. Notifications are grouped
+    and sent by batches over a single SMTP session.
+    """
+
+    def __init__(self):
+        self.notified = set()
+        self.pending = []
+        self.task = None
+
+    def notify(self, ltype, name):
+        """Queue a notification about item."""
+        item = (ltype, name)
+        if item in self.notified:
+            return
+        self.notified.add(item)
+        self.pending.append(item)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    def reset(self):
+        """Forget about already notified items."""
+        self.notified.clear()
+
+    async def run(self):
+        """Send pending notifications until there is none left."""
+        while self.pending:
+            # Give simultaneous events a chance to be sent together
+            await asyncio.sleep(constants.NOTIFICATION_BATCH_DELAY)
+            items, self.pending = self.pending, []
+            try:
+                await self.send(items)
+            except Exception:
+                logger.exception("Failed to send limit notifications")
+                # Items can be notified again
+                self.notified.difference_update(items)
+
+    async def send(self, items):
+        """Create alarms and send notifications for given items."""
+        loop = asyncio.get_running_loop()
+        sender, recipients, items = await loop.run_in_executor(
+            get_executor(), prepare_notifications, items
+        )
+        if not items or not recipients:
+            return
+        messages = [
+            build_notification(sender, recipient, ltype, name)
+            for ltype, name in items
+            for recipient in recipients
+        ]
+        async with aiosmtplib.SMTP() as smtp:
+            for msg in messages:
+                await smtp.send_message(msg)
+
+
+notifier = LimitNotifier()
+
+
+def notify_limit_reached(ltype, name):
+    """Send a notification to super admins about item."""
+    notifier.notify(ltype, name)
 
 
-async def decrement_limit(rclient, ltype, name):
-    """Decrement the given limit by one."""
-    new_counter = await rclient.hincrby(constants.REDIS_HASHNAME, name, -1)
-    if new_counter <= 0:
-        logger.info(f"Limit reached for {ltype} {name}")
-        asyncio.ensure_future(notify_limit_reached(ltype, name))
+async def check_and_decrement_limits(rclient, limits):
+    """Check limits and decrement them if none is reached.
+
+    Everything is done in a single atomic call to Redis so concurrent
+    requests can't both consume the last available unit.
+
+    :param rclient: Redis client
+    :param list limits: list of (limit type, name) tuples
+    :return: True if request can pass, False otherwise
+    """
+    script = rclient.register_script(constants.CHECK_AND_DECREMENT_SCRIPT)
+    # All items belong to the same domain so they share the same hash
+    hashname = utils.get_hash_name(limits[-1][1])
+    result = await script(keys=[hashname], args=[name for ltype, name in limits])
+    if not int(result[0]):
+        ltype, name = limits[int(result[1]) - 1]
+        logger.info(f"{ltype.capitalize()} {name} current counter: {result[2]}")
+        return False
+    for (ltype, name), counter in zip(limits, result[1:], strict=True):
+        if counter is None:
+            continue
+        logger.debug(f"{ltype.capitalize()} {name} new counter: {counter}")
+        if int(counter) <= 0:
+            logger.info(f"Limit reached for {ltype} {name}")
+            notify_limit_reached(ltype, name)
+    return True
 
 
 async def apply_policies(attributes):
@@ -155,68 +288,109 @@ async def apply_policies(attributes):
     sasl_username = attributes.get("sasl_username")
     if not sasl_username:
         return SUCCESS_ACTION
-    rclient = get_redis_client()
-    decr_domain = False
-    decr_user = False
     localpart, domain = split_mailbox(sasl_username)
-    if await rclient.hexists(constants.REDIS_HASHNAME, domain):
-        counter = await rclient.hget(constants.REDIS_HASHNAME, domain)
-        logger.info(f"Domain {domain} current counter: {counter}")
-        if int(counter) <= 0:
-            return FAILURE_ACTION
-        decr_domain = True
-    if await rclient.hexists(constants.REDIS_HASHNAME, sasl_username):
-        counter = await rclient.hget(constants.REDIS_HASHNAME, sasl_username)
-        logger.info(f"Account {sasl_username} current counter: {counter}")
-        if int(counter) <= 0:
-            return FAILURE_ACTION
-        decr_user = True
-    if decr_domain:
-        await decrement_limit(rclient, "domain", domain)
-    if decr_user:
-        await decrement_limit(rclient, "account", sasl_username)
-    await rclient.close()
+    limits = [("account", sasl_username)]
+    if domain:
+        limits.insert(0, ("domain", domain))
+    if not await check_and_decrement_limits(get_redis_client(), limits):
+        return FAILURE_ACTION
     logger.debug("Let it pass")
     return SUCCESS_ACTION
 
 
-async def handle_connection(reader, writer):
-    """Coroutine to handle a new connection to the server."""
+def parse_request(data):
+    """Parse a policy delegation request and return its attributes."""
+    attributes = {}
+    for line in data.decode().split("\n"):
+        if not line:
+            continue
+        try:
+            name, value = line.split("=", 1)
+        except ValueError:
+            continue
+        attributes[name] = value
+    return attributes
+
+
+async def handle_request(attributes):
+    """Return the action to send back for the given request."""
     action = SUCCESS_ACTION
-    try:
-        logger.debug("Reading data")
-        data = await reader.readuntil(b"\n\n")
-    except asyncio.IncompleteReadError:
-        pass
-    else:
-        attributes = {}
-        for line in data.decode().split("\n"):
-            if not line:
-                continue
-            try:
-                name, value = line.split("=")
-            except ValueError:
-                continue
-            attributes[name] = value
-        state = attributes.get("protocol_state")
-        if state == "RCPT":
-            logger.debug("Applying policies")
-            action = await apply_policies(attributes)
-            logger.debug("Done")
-    logger.debug("Sending action %s", action)
-    writer.write(b"action=" + action + b"\n\n")
-    await writer.drain()
-
-
-async def new_connection(reader, writer):
-    # try:
-    await asyncio.wait_for(handle_connection(reader, writer), timeout=5)
-    # except asyncio.TimeoutError as err:
-    #    logger.warning(f"Timeout received while handling connection: {err}")
-    # finally:
-    writer.close()
-    await writer.wait_closed()
-    logger.info("exit")
+    state = attributes.get("protocol_state")
+    if state == "RCPT":
+        logger.debug("Applying policies")
+        action = await apply_policies(attributes)
+        logger.debug("Done")
+    return action
+
+
+async def handle_connection(
+    reader, writer, idle_timeout=constants.DEFAULT_IDLE_TIMEOUT
+):
+    """Coroutine to handle a new connection to the server.
+
+    Postfix keeps policy connections open and sends several requests
+    over the same one, so we serve requests until the client closes
+    the connection or until it stays idle for too long.
+    """
+    while True:
+        try:
+            logger.debug("Reading data")
+            data = await asyncio.wait_for(
+                reader.readuntil(b"\n\n"), timeout=idle_timeout
+            )
+        except asyncio.IncompleteReadError:
+            # Connection closed by client
+            break
+        except asyncio.TimeoutError:
+            logger.debug("Closing idle connection")
+            break
+        except asyncio.LimitOverrunError:
+            logger.warning("Request too long, closing connection")
+            break
+        try:
+            action = await asyncio.wait_for(
+                handle_request(parse_request(data)),
+                timeout=constants.REQUEST_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timeout received while handling request")
+            break
+        logger.debug("Sending action %s", action)
+        writer.write(b"action=" + action + b"\n\n")
+        try:
+            await writer.drain()
+        except ConnectionError:
+            break
+
+
+async def new_connection(
+    reader, writer, idle_timeout=constants.DEFAULT_IDLE_TIMEOUT, semaphore=None
+):
+    """Serve a new connection, waiting for a free slot if needed."""
+    async with semaphore or contextlib.nullcontext():
+        try:
+            await handle_connection(reader, writer, idle_timeout)
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+    logger.debug("Connection closed")
+
+
+def get_connection_handler(
+    idle_timeout=constants.DEFAULT_IDLE_TIMEOUT,
+    max_connections=constants.DEFAULT_MAX_CONNECTIONS,
+):
+    """Return a connection handler to pass to asyncio servers.
+
+    :param int idle_timeout: seconds before an idle connection is closed
+    :param int max_connections: maximum number of connections served
+                                simultaneously (0 means no limit)
+    """
+    semaphore = asyncio.Semaphore(max_connections) if max_connections else None
+    return functools.partial(
+        new_connection, idle_timeout=idle_timeout, semaphore=semaphore
+    )
 
 
 def get_next_execution_dt():
@@ -226,49 +400,80 @@ def get_next_execution_dt():
 
 @sync_to_async
 @close_db_connections
-def get_domains_to_reset():
-    """
-    Return a list of domain to reset.
-
-    We also close all associated alarms.
-    """
-    qset = admin_models.Domain.objects.filter(message_limit__isnull=False)
+def close_limit_alarms():
+    """Close all opened sending limit alarms."""
     admin_models.Alarm.objects.filter(
-        internal_name="limit_reached",
-        domain__in=qset,
+        internal_name=constants.ALARM_INTERNAL_NAME,
         status=admin_constants.ALARM_OPENED,
     ).update(status=admin_constants.ALARM_CLOSED, closed=timezone.now())
-    return list(qset)
 
 
 @sync_to_async
 @close_db_connections
-def get_mailboxes_to_reset():
+def get_domains_to_reset(last_pk):
+    """
+    Return the next chunk of domain counters to reset.
+
+    :param int last_pk: primary key of the last domain already handled
+    :return: a list of (pk, name, limit) tuples
+    """
+    qset = admin_models.Domain.objects.filter(
+        message_limit__isnull=False, pk__gt=last_pk
+    ).order_by("pk")
+    return list(
+        qset.values_list("pk", "name", "message_limit")[: constants.RESET_CHUNK_SIZE]
+    )
+
+
+@sync_to_async
+@close_db_connections
+def get_mailboxes_to_reset(last_pk):
     """
-    Return a list of mailboxes to reset.
+    Return the next chunk of mailbox counters to reset.
 
-    We also close all associated alarms.
+    :param int last_pk: primary key of the last mailbox already handled
+    :return: a list of (pk, address, limit) tuples
     """
     qset = admin_models.Mailbox.objects.filter(
-        message_limit__isnull=False
-    ).select_related("domain")
-    admin_models.Alarm.objects.filter(
-        internal_name="limit_reached",
-        mailbox__in=qset,
-        status=admin_constants.ALARM_OPENED,
-    ).update(status=admin_constants.ALARM_CLOSED, closed=timezone.now())
-    return list(qset)
+        message_limit__isnull=False, pk__gt=last_pk
+    ).order_by("pk")
+    return [
+        (pk, f"{address}@{domain}", limit)
+        for pk, address, domain, limit in qset.values_list(
+            "pk", "address", "domain__name", "message_limit"
+        )[: constants.RESET_CHUNK_SIZE]
+    ]
+
+
+async def reset_chunked_counters(rclient, get_chunk):
+    """Reset counters returned chunk by chunk by get_chunk.
+
+    Each chunk is written using one HSET call per hash, sent in a
+    single pipeline.
+    """
+    last_pk = 0
+    while True:
+        chunk = await get_chunk(last_pk)
+        if not chunk:
+            break
+        mappings = collections.defaultdict(dict)
+        for _pk, name, limit in chunk:
+            mappings[utils.get_hash_name(name)][name] = limit
+        async with rclient.pipeline(transaction=False) as pipe:
+            for hashname, mapping in mappings.items():
+                pipe.hset(hashname, mapping=mapping)
+            await pipe.execute()
+        last_pk = chunk[-1][0]
 
 
 async def reset_counters():
     """Reset all counters."""
     rclient = get_redis_client()
     logger.info("Resetting all counters")
-    for domain in await get_domains_to_reset():
-        await rclient.hset(constants.REDIS_HASHNAME, domain.name, domain.message_limit)
-    for mb in await get_mailboxes_to_reset():
-        await rclient.hset(constants.REDIS_HASHNAME, mb.full_address, mb.message_limit)
-    await rclient.close()
+    notifier.reset()
+    await close_limit_alarms()
+    await reset_chunked_counters(rclient, get_domains_to_reset)
+    await reset_chunked_counters(rclient, get_mailboxes_to_reset)
     # reschedule
     asyncio.ensure_future(run_at(get_next_execution_dt(), reset_counters))
 
@@ -6,7 +6,7 @@ from django.dispatch import receiver
 from modoboa.admin import models as admin_models
 from modoboa.lib.redis import get_redis_connection
 
-from . import constants
+from . import utils
 
 
 def set_message_limit(instance, key):
@@ -15,16 +15,17 @@ def set_message_limit(instance, key):
     if old_message_limit == instance.message_limit:
         return
     rclient = get_redis_connection()
+    hashname = utils.get_hash_name(key)
     if instance.message_limit is None:
         # delete existing key
-        if rclient.hexists(constants.REDIS_HASHNAME, key):
-            rclient.hdel(constants.REDIS_HASHNAME, key)
+        if rclient.hexists(hashname, key):
+            rclient.hdel(hashname, key)
         return
     if old_message_limit is not None:
         diff = instance.message_limit - old_message_limit
     else:
         diff = instance.message_limit
-    rclient.hincrby(constants.REDIS_HASHNAME, key, diff)
+    rclient.hincrby(hashname, key, diff)
 
 
 @receiver(signals.post_save, sender=admin_models.Domain)
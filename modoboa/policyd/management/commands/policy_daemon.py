@@ -10,7 +10,7 @@ import os
 
 from django.core.management.base import BaseCommand
 
-from ... import core
+from ... import constants, core
 
 logger = logging.getLogger("modoboa.policyd")
 
@@ -30,6 +30,18 @@ class Command(BaseCommand):
         parser.add_argument("--host", type=str, default="localhost")
         parser.add_argument("--port", type=int, default=9999)
         parser.add_argument("--socket", type=str, default=None)
+        parser.add_argument(
+            "--idle-timeout",
+            type=int,
+            default=constants.DEFAULT_IDLE_TIMEOUT,
+            help="Close client connections idle for more than this number of seconds",
+        )
+        parser.add_argument(
+            "--max-connections",
+            type=int,
+            default=constants.DEFAULT_MAX_CONNECTIONS,
+            help="Maximum number of simultaneous client connections (0 = unlimited)",
+        )
         parser.add_argument("--debug", action="store_true", help="Enable debug mode")
 
     def handle(self, *args, **options):
@@ -42,6 +54,9 @@ class Command(BaseCommand):
         except RuntimeError:
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
+        handler = core.get_connection_handler(
+            options["idle_timeout"], options["max_connections"]
+        )
         if os.environ.get("LISTEN_PID", "") == str(os.getpid()) and os.environ.get("LISTEN_FDS", "").isnumeric():
             num_sockets = int(os.environ["LISTEN_FDS"])
 
@@ -54,16 +69,16 @@ class Command(BaseCommand):
                 listen_sock.set_inheritable(False)  # Mark as CLOEXEC
 
                 servers.append(asyncio.start_server(
-                    core.new_connection, sock=listen_sock
+                    handler, sock=listen_sock
                 ))
             coro = asyncio.gather(*servers)
         elif options["socket"] is None:
             coro = asyncio.start_server(
-                core.new_connection, options["host"], options["port"]
+                handler, options["host"], options["port"]
             )
         else:
             coro = asyncio.start_unix_server(
-                core.new_connection, options["socket"]
+                handler, options["socket"]
             )
         servers = loop.run_until_complete(coro)
         if not isinstance(servers, list):
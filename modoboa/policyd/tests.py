@@ -2,6 +2,7 @@
 
 import asyncio
 from aiosmtplib import send
+from unittest import mock
 from unittest.mock import AsyncMock
 import multiprocessing
 from multiprocessing import Process
@@ -13,7 +14,7 @@ import time
 
 from django import db
 from django.core.management import call_command
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
 
 from modoboa.admin import factories as admin_factories
 from modoboa.admin import models as admin_models
@@ -22,7 +23,7 @@ from modoboa.lib.redis import get_redis_connection
 from modoboa.lib.tests import ModoAPITestCase, ParametersMixin
 from modoboa.policyd import core as policyd_core
 
-from . import constants
+from . import constants, utils
 
 multiprocessing.set_start_method("fork")
 
@@ -37,7 +38,8 @@ class RedisTestCaseMixin:
     def setUp(self):
         super().setUp()
         self.rclient = get_redis_connection()
-        self.rclient.delete(constants.REDIS_HASHNAME)
+        for key in self.rclient.scan_iter(f"{constants.REDIS_HASHNAME}*"):
+            self.rclient.delete(key)
 
 
 class SocketActivationTestCase(TransactionTestCase):
@@ -150,7 +152,7 @@ class PolicyDaemonTestCase(RedisTestCaseMixin, ParametersMixin, TransactionTestC
         domain.message_limit = value
         domain.save()
         self.assertEqual(
-            self.rclient.hget(constants.REDIS_HASHNAME, domain.name),
+            self.rclient.hget(utils.get_hash_name(domain.name), domain.name),
             domain.message_limit,
         )
         return domain
@@ -162,7 +164,8 @@ class PolicyDaemonTestCase(RedisTestCaseMixin, ParametersMixin, TransactionTestC
         mb.message_limit = value
         mb.save()
         self.assertEqual(
-            self.rclient.hget(constants.REDIS_HASHNAME, account.email), mb.message_limit
+            self.rclient.hget(utils.get_hash_name(account.email), account.email),
+            mb.message_limit,
         )
         return account
 
@@ -182,6 +185,25 @@ class PolicyDaemonTestCase(RedisTestCaseMixin, ParametersMixin, TransactionTestC
         self.assertEqual(res, b"action=dunno\n\n")
         s.close()
 
+    def test_persistent_connection(self):
+        account = self.set_account_limit("user@test.com", 2)
+        s = self.connect_to_daemon()
+        request = b"""protocol_state=RCPT
+sasl_username=user@test.com
+
+"""
+        # Several requests can be sent over the same connection
+        for expected in [
+            b"action=dunno\n\n",
+            b"action=dunno\n\n",
+            b"action=defer_if_permit Daily limit reached, retry later\n\n",
+        ]:
+            s.send(request)
+            res = s.recv(1024)
+            self.assertEqual(res, expected)
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, account.email), 0)
+        s.close()
+
     def test_domain_limit(self):
         domain = self.set_domain_limit("test.com", 2)
         s = self.connect_to_daemon()
@@ -296,6 +318,131 @@ sasl_username=user@test.com
         self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, domain.name), 20)
         self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, account.email), 10)
 
+    @override_settings(POLICYD_REDIS_SHARDS=4)
+    def test_reset_counters_sharded(self):
+        domain = self.set_domain_limit("test.com", 20)
+        admin_models.Domain.objects.filter(name="test2.com").update(message_limit=30)
+        account = self.set_account_limit("user@test.com", 10)
+        hashname = utils.get_hash_name(domain.name)
+        self.assertEqual(hashname, utils.get_hash_name(account.email))
+        self.assertIn(
+            hashname, [f"{constants.REDIS_HASHNAME}:{shard}" for shard in range(4)]
+        )
+        self.assertEqual(self.rclient.hget(hashname, account.email), 10)
+        self.assertFalse(self.rclient.exists(constants.REDIS_HASHNAME))
+        self.rclient.hset(hashname, account.email, 0)
+
+        with mock.patch.object(constants, "RESET_CHUNK_SIZE", 1):
+            asyncio.run(policyd_core.reset_counters())
+
+        self.assertEqual(utils.get_message_counter(domain.name), 20)
+        self.assertEqual(utils.get_message_counter("test2.com"), 30)
+        self.assertEqual(utils.get_message_counter(account.email), 10)
+        self.assertFalse(self.rclient.exists(constants.REDIS_HASHNAME))
+
+
+class CheckAndDecrementTestCase(RedisTestCaseMixin, SimpleTestCase):
+    """Test cases for limit checking."""
+
+    def run_checks(self, *limits_list):
+        async def run_test():
+            rclient = policyd_core.get_redis_client()
+            return await asyncio.gather(
+                *[
+                    policyd_core.check_and_decrement_limits(rclient, limits)
+                    for limits in limits_list
+                ]
+            )
+
+        with mock.patch.object(policyd_core, "notify_limit_reached") as notify:
+            result = asyncio.run(run_test())
+        return result, notify
+
+    def test_no_limit(self):
+        limits = [("domain", "test.com"), ("account", "user@test.com")]
+        result, notify = self.run_checks(limits)
+        self.assertEqual(result, [True])
+        self.assertFalse(self.rclient.exists(constants.REDIS_HASHNAME))
+        notify.assert_not_called()
+
+    def test_concurrent_requests(self):
+        self.rclient.hset(constants.REDIS_HASHNAME, "test.com", 1)
+        self.rclient.hset(constants.REDIS_HASHNAME, "user@test.com", 5)
+        limits = [("domain", "test.com"), ("account", "user@test.com")]
+        result, notify = self.run_checks(limits, limits)
+        self.assertEqual(sorted(result), [False, True])
+        self.assertEqual(self.rclient.hget(constants.REDIS_HASHNAME, "test.com"), 0)
+        # Account counter is left untouched when request is denied
+        self.assertEqual(
+            self.rclient.hget(constants.REDIS_HASHNAME, "user@test.com"), 4
+        )
+        notify.assert_called_once_with("domain", "test.com")
+
+
+class LimitNotifierTestCase(SimpleTestCase):
+    """Test cases for limit notifications."""
+
+    def test_notifications_are_batched(self):
+        recipients = [
+            mock.Mock(language="en", email="admin1@test.com"),
+            mock.Mock(language="fr", email="admin2@test.com"),
+        ]
+        items = [("domain", "test.com"), ("account", "user@test.com")]
+
+        async def run_test():
+            notifier = policyd_core.LimitNotifier()
+            notifier.notify("domain", "test.com")
+            notifier.notify("account", "user@test.com")
+            notifier.notify("domain", "test.com")
+            await notifier.task
+            # Already notified today
+            notifier.notify("domain", "test.com")
+            self.assertTrue(notifier.task.done())
+
+        smtp_client = AsyncMock()
+        with (
+            mock.patch.object(constants, "NOTIFICATION_BATCH_DELAY", 0),
+            mock.patch.object(
+                policyd_core,
+                "prepare_notifications",
+                return_value=("sender@test.com", recipients, items),
+            ) as prepare,
+            mock.patch("aiosmtplib.SMTP") as smtp,
+        ):
+            smtp.return_value.__aenter__.return_value = smtp_client
+            asyncio.run(run_test())
+        prepare.assert_called_once_with(items)
+        smtp.assert_called_once()
+        self.assertEqual(smtp_client.send_message.await_count, 4)
+
+    def test_failed_notification(self):
+        recipients = [mock.Mock(language="en", email="admin1@test.com")]
+        items = [("domain", "test.com")]
+
+        async def run_test():
+            notifier = policyd_core.LimitNotifier()
+            notifier.notify("domain", "test.com")
+            await notifier.task
+            self.assertEqual(notifier.notified, set())
+            notifier.notify("domain", "test.com")
+            await notifier.task
+
+        smtp_client = AsyncMock()
+        smtp_client.send_message.side_effect = [OSError("Connection refused"), None]
+        with (
+            mock.patch.object(constants, "NOTIFICATION_BATCH_DELAY", 0),
+            mock.patch.object(
+                policyd_core,
+                "prepare_notifications",
+                return_value=("sender@test.com", recipients, items),
+            ),
+            mock.patch("aiosmtplib.SMTP") as smtp,
+            self.assertLogs("modoboa.policyd", "ERROR"),
+        ):
+            smtp.return_value.__aenter__.return_value = smtp_client
+            asyncio.run(run_test())
+        self.assertEqual(smtp_client.send_message.await_count, 2)
+
 
 class ModelsTestCase(RedisTestCaseMixin, ModoAPITestCase):
     """Admin models test cases."""
@@ -344,3 +491,16 @@ class ModelsTestCase(RedisTestCaseMixin, ModoAPITestCase):
         mb.save()
         self.rclient.delete(constants.REDIS_HASHNAME)
         self.assertEqual(mb.sent_messages, 0)
+
+    def test_create_alarm_once_a_day(self):
+        self.assertTrue(policyd_core.create_alarm("domain", "test.com"))
+        self.assertFalse(policyd_core.create_alarm("domain", "test.com"))
+        self.assertTrue(policyd_core.create_alarm("account", "user@test.com"))
+        self.assertFalse(policyd_core.create_alarm("account", "user@test.com"))
+        self.assertFalse(policyd_core.create_alarm("account", "unknown@test.com"))
+        self.assertEqual(
+            admin_models.Alarm.objects.filter(
+                internal_name=constants.ALARM_INTERNAL_NAME
+            ).count(),
+            2,
+        )
@@ -1,14 +1,32 @@
 """Tooling."""
 
+import zlib
+
+from django.conf import settings
+
 from modoboa.lib.redis import get_redis_connection
 
 from . import constants
 
 
+def get_hash_name(key):
+    """Return the name of the Redis hash storing counter for given key.
+
+    Counters can be spread over several hashes (see the
+    POLICYD_REDIS_SHARDS setting). Accounts are always stored in the
+    same hash as their domain.
+    """
+    shards = getattr(settings, "POLICYD_REDIS_SHARDS", 1)
+    if shards <= 1:
+        return constants.REDIS_HASHNAME
+    domain = key.rpartition("@")[2]
+    return f"{constants.REDIS_HASHNAME}:{zlib.crc32(domain.encode()) % shards}"
+
+
 def get_message_counter(key):
     """Return current counter for given key."""
     rclient = get_redis_connection(hget_return_type=None)
-    value = rclient.hget(constants.REDIS_HASHNAME, key)
+    value = rclient.hget(get_hash_name(key), key)
     if value is None:
         return None
     return int(value)
@@ -12,6 +12,7 @@ from modoboa.admin import factories as admin_factories
 from modoboa.core import models as core_models
 from modoboa.lib.tests import ModoAPITestCase
 from modoboa.sievefilters import mocks
+from modoboa.webmail.lib.imappool import pool
 from modoboa.webmail.mocks import IMAP4Mock
 
 Application = get_application_model()
@@ -32,6 +33,8 @@ class PatcherMixin:
         self.mock_imap4 = patcher.start()
         self.mock_imap4.return_value = IMAP4Mock()
         self.addCleanup(patcher.stop)
+        pool.clear()
+        self.addCleanup(pool.clear)
 
 
 class FilterSetViewSetTestCase(PatcherMixin, ModoAPITestCase):
@@ -50,3 +50,91 @@ DISPLAY_MODES = [
     (DisplayMode.PLAIN.value, "text"),
     (DisplayMode.HTML.value, "html"),
 ]
+
+# IMAP connection pool defaults (see imappool module)
+IMAP_POOL_SIZE = 4
+IMAP_POOL_MAX_CONNECTIONS = 100
+IMAP_POOL_IDLE_TIMEOUT = 300
+IMAP_POOL_CHECK_INTERVAL = 30
+
+# Sorted UID lists are kept in cache for this number of seconds
+UID_INDEX_CACHE_TIMEOUT = 3600
+
+# Mailbox counters (unseen messages) are kept in cache for this
+# number of seconds
+MAILBOX_COUNTERS_CACHE_TIMEOUT = 30
+
+# Inline images cache defaults (see inlines module)
+INLINE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# None (files sent by Django), "x-accel-redirect" (nginx) or
+# "x-sendfile" (apache)
+INLINE_CACHE_SENDFILE = None
+INLINE_CACHE_ACCEL_PREFIX = "/webmail-inlines/"
+# The file used for a message part is remembered for this number of
+# seconds
+INLINE_PART_CACHE_TIMEOUT = 86400
+# Only these types are cached (and served) as inline images
+INLINE_IMAGE_TYPES = [
+    "image/bmp",
+    "image/gif",
+    "image/jpeg",
+    "image/png",
+    "image/webp",
+]
+
+# Size of partial FETCH commands used to download message parts
+FETCH_CHUNK_SIZE = 512 * 1024
+
+# Search criteria available in the webmail (name -> IMAP search key)
+SEARCH_CRITERIA = {
+    "from_addr": "FROM",
+    "to_addr": "TO",
+    "subject": "SUBJECT",
+    "body": "BODY",
+}
+
+# Push notifications (see imapnotify module)
+# IDLE commands are restarted before the 29 minutes limit of RFC 2177
+IMAP_NOTIFY_IDLE_TIMEOUT = 25 * 60
+# Delay (in seconds) to wait for other changes once one is received
+IMAP_NOTIFY_DEBOUNCE_DELAY = 0.5
+# The IMAP session of a user is kept for this number of seconds after
+# the last event stream has been closed
+IMAP_NOTIFY_GRACE_PERIOD = 60
+# Maximum number of events waiting to be sent to a client
+EVENTS_QUEUE_SIZE = 100
+# Comments are sent at this interval (in seconds) to keep streams open
+EVENTS_KEEPALIVE_INTERVAL = 30
+# Delay (in seconds) before a client reconnects to a closed stream
+EVENTS_RETRY_DELAY = 5
+
+COMPOSE_SESSION_KEY_PREFIX = "webmail:compose"
+# Compose sessions expire after this number of seconds of inactivity
+COMPOSE_SESSION_TIMEOUT = 24 * 3600
+# Files of the attachments storage which are not used by a compose
+# session (or a scheduled message) are removed once they are older
+# than this number of seconds
+ORPHANED_ATTACHMENT_MIN_AGE = 3600
+
+# Append an attachment to a compose session, only if it still exists
+ADD_ATTACHMENT_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("RPUSH", KEYS[2], ARGV[1])
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+return 1
+"""
+
+# Remove an attachment (identified by its tmpname) from a compose
+# session and return its definition
+REMOVE_ATTACHMENT_SCRIPT = """
+for _, item in ipairs(redis.call("LRANGE", KEYS[1], 0, -1)) do
+    if cjson.decode(item)["tmpname"] == ARGV[1] then
+        redis.call("LREM", KEYS[1], 1, item)
+        return item
+    end
+end
+return false
+"""
@@ -5,7 +5,7 @@ from django.utils import timezone
 import django_rq
 
 from modoboa.webmail import constants, models
-from modoboa.webmail.lib import sendmail
+from modoboa.webmail.lib import attachments, sendmail
 
 
 def send_scheduled_message(message_id: int):
@@ -25,3 +25,8 @@ def send_scheduled_messages():
         message.status = constants.SchedulingState.SENDING.value
         message.save()
         queue.enqueue(send_scheduled_message, message_id=message.id)
+
+
+def clean_attachments():
+    """Remove attachments left behind by expired compose sessions."""
+    attachments.remove_orphaned_files()
@@ -6,7 +6,7 @@ from .attachments import (
 from .imapemail import ImapEmail, ReplyModifier, ForwardModifier
 from .imaputils import BodyStructure, IMAPconnector, get_imapconnector, separate_mailbox
 from .signature import EmailSignature
-from .utils import decode_payload
+from .utils import decode_payload, iter_decode_payload, iter_decode_text
 
 
 __all__ = [
@@ -20,6 +20,8 @@ __all__ = [
     "create_mail_attachment",
     "decode_payload",
     "get_imapconnector",
+    "iter_decode_payload",
+    "iter_decode_text",
     "save_attachment",
     "separate_mailbox",
 ]
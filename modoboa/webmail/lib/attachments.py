@@ -3,11 +3,13 @@ from email.mime.base import MIMEBase
 import json
 import os
 from tempfile import NamedTemporaryFile
+import time
 from typing import TypedDict
 import uuid
 
 
 from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
 from django.core.files.uploadhandler import FileUploadHandler, SkipFile
 from django.http import Http404
 from django.utils.translation import gettext as _
@@ -16,6 +18,7 @@ from modoboa.lib.exceptions import InternalError
 from modoboa.lib.redis import get_redis_connection
 from modoboa.lib.web_utils import size2integer
 from modoboa.parameters import tools as param_tools
+from modoboa.webmail import constants
 
 from .rfc6266 import build_header
 
@@ -26,11 +29,23 @@ Attachment = TypedDict(
 
 
 class ComposeSessionManager:
+    """Store "compose" sessions in redis.
+
+    Each session uses two keys: a marker and the list of its
+    attachments. Both expire after ``COMPOSE_SESSION_TIMEOUT``
+    seconds of inactivity.
+    """
 
     def __init__(self, username: str):
-        self.hash = f"webmail-{username}"
+        self.prefix = f"{constants.COMPOSE_SESSION_KEY_PREFIX}:{username}"
         self.rclient = get_redis_connection(bytes)
 
+    def get_key(self, uid: str) -> str:
+        return f"{self.prefix}:{uid}"
+
+    def get_attachments_key(self, uid: str) -> str:
+        return f"{self.prefix}:{uid}:attachments"
+
     def create(self) -> str:
         """
         Initialize a new "compose" session.
@@ -40,23 +55,56 @@ class ComposeSessionManager:
         order to avoid conflicts between users).
         """
         randid = str(uuid.uuid4()).replace("-", "")
-        self.rclient.hset(self.hash, randid, json.dumps({"attachments": []}))
+        self.rclient.set(self.get_key(randid), 1, ex=constants.COMPOSE_SESSION_TIMEOUT)
         return randid
 
     def delete(self, uid: str) -> None:
-        self.rclient.hdel(self.hash, uid)
+        self.rclient.delete(self.get_key(uid), self.get_attachments_key(uid))
 
     def exists(self, uid: str) -> bool:
-        return self.rclient.hexists(self.hash, uid)
-
-    def get_content(self, uid: str) -> dict:
-        if not self.exists(uid):
+        return bool(self.rclient.exists(self.get_key(uid)))
+
+    def get_attachments(self, uid: str) -> list[Attachment]:
+        """Return the attachments of a session and extend its lifetime."""
+        key = self.get_key(uid)
+        attachments_key = self.get_attachments_key(uid)
+        pipe = self.rclient.pipeline()
+        pipe.exists(key)
+        pipe.lrange(attachments_key, 0, -1)
+        pipe.expire(key, constants.COMPOSE_SESSION_TIMEOUT)
+        pipe.expire(attachments_key, constants.COMPOSE_SESSION_TIMEOUT)
+        exists, items = pipe.execute()[:2]
+        if not exists:
             raise Http404
-        content = self.rclient.hget(self.hash, uid)
-        return json.loads(content.decode())
+        return [json.loads(item) for item in items]
+
+    def add_attachment(self, uid: str, attachment: Attachment) -> bool:
+        """Append an attachment to a session, if it still exists."""
+        script = self.rclient.register_script(constants.ADD_ATTACHMENT_SCRIPT)
+        result = script(
+            keys=[self.get_key(uid), self.get_attachments_key(uid)],
+            args=[json.dumps(attachment), constants.COMPOSE_SESSION_TIMEOUT],
+        )
+        return bool(result)
+
+    def remove_attachment(self, uid: str, tmpname: str) -> Attachment | None:
+        """Remove an attachment from a session and return it."""
+        script = self.rclient.register_script(constants.REMOVE_ATTACHMENT_SCRIPT)
+        result = script(keys=[self.get_attachments_key(uid)], args=[tmpname])
+        if result is None:
+            return None
+        return json.loads(result)
+
 
-    def set_content(self, uid: str, content: dict):
-        return self.rclient.hset(self.hash, uid, json.dumps(content))
+def get_session_tmpnames() -> set[str]:
+    """Return the names of the files used by existing compose sessions."""
+    rclient = get_redis_connection(bytes)
+    pattern = f"{constants.COMPOSE_SESSION_KEY_PREFIX}:*:attachments"
+    result = set()
+    for key in rclient.scan_iter(match=pattern):
+        for item in rclient.lrange(key, 0, -1):
+            result.add(json.loads(item)["tmpname"])
+    return result
 
 
 def get_storage_path(filename):
@@ -67,37 +115,61 @@ def get_storage_path(filename):
     return os.path.join(storage_dir, filename)
 
 
+def create_storage_file():
+    """Create a new file with a random name inside the storage directory."""
+    try:
+        return NamedTemporaryFile(dir=get_storage_path(""), delete=False)
+    except Exception as e:
+        raise InternalError(str(e)) from None
+
+
+def register_attachment(
+    manager: ComposeSessionManager, session_uid: str, attachment: Attachment
+) -> Attachment:
+    """Add a stored file to a session, removing it if the session is gone."""
+    if not manager.add_attachment(session_uid, attachment):
+        remove_file(attachment["tmpname"])
+        raise Http404
+    return attachment
+
+
+def remove_file(tmpname: str) -> None:
+    try:
+        os.remove(get_storage_path(tmpname))
+    except OSError:
+        pass
+
+
 def save_attachment_from_upload(request, session_uid: str, f) -> Attachment:
     """
     Save a new attachment to the filesystem, directly from a Django upload.
 
     The attachment is not saved using its own name to the
     filesystem. To avoid conflicts, a random name is generated and
-    used instead.
+    used instead. Files received by ``AttachmentUploadHandler`` are
+    already stored and only need to be registered.
 
     :param f: an uploaded file object (see Django's documentation)
     """
     manager = ComposeSessionManager(request.user.username)
+    tmpname = getattr(f, "tmpname", None)
     if not manager.exists(session_uid):
+        if tmpname is not None:
+            remove_file(tmpname)
         raise Http404
-    try:
-        fp = NamedTemporaryFile(dir=get_storage_path(""), delete=False)
-    except Exception as e:
-        raise InternalError(str(e)) from None
-    for chunk in f.chunks():
-        fp.write(chunk)
-    fp.close()
-
-    session = manager.get_content(session_uid)
+    if tmpname is None:
+        fp = create_storage_file()
+        with fp:
+            for chunk in f.chunks():
+                fp.write(chunk)
+        tmpname = os.path.basename(fp.name)
     attachment: Attachment = {
         "fname": str(f),
         "content-type": f.content_type,
         "size": f.size,
-        "tmpname": os.path.basename(fp.name),
+        "tmpname": tmpname,
     }
-    session["attachments"].append(attachment)
-    manager.set_content(session_uid, session)
-    return attachment
+    return register_attachment(manager, session_uid, attachment)
 
 
 def save_attachment(
@@ -113,54 +185,77 @@ def save_attachment(
     manager = ComposeSessionManager(request.user.username)
     if not manager.exists(session_uid):
         raise Http404
-    try:
-        fp = NamedTemporaryFile(dir=get_storage_path(""), delete=False)
-    except Exception as e:
-        raise InternalError(str(e)) from None
-    fp.write(content.encode("utf-8"))
-    fp.close()
-
-    session = manager.get_content(session_uid)
+    fp = create_storage_file()
+    with fp:
+        fp.write(content.encode("utf-8"))
     attachment: Attachment = {
         "fname": filename,
         "content-type": content_type,
         "size": len(content),
         "tmpname": os.path.basename(fp.name),
     }
-    session["attachments"].append(attachment)
-    manager.set_content(session_uid, session)
-    return attachment
+    return register_attachment(manager, session_uid, attachment)
 
 
 def remove_attachment(request, session_uid: str, name: str) -> str | None:
     manager = ComposeSessionManager(request.user.username)
-    session = manager.get_content(session_uid)
-    for att in session["attachments"]:
-        if att["tmpname"] == name:
-            session["attachments"].remove(att)
-            fullpath = os.path.join(settings.MEDIA_ROOT, "webmail", att["tmpname"])
-            try:
-                os.remove(fullpath)
-            except OSError as e:
-                return _("Failed to remove attachment: ") + str(e)
-            manager.set_content(session_uid, session)
-            return None
-    raise Http404
+    if not manager.exists(session_uid):
+        raise Http404
+    att = manager.remove_attachment(session_uid, name)
+    if att is None:
+        raise Http404
+    try:
+        os.remove(get_storage_path(att["tmpname"]))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return _("Failed to remove attachment: ") + str(e)
+    return None
 
 
 def remove_attachments_and_session(
     manager: ComposeSessionManager, session_uid: str
 ) -> None:
-    content = manager.get_content(session_uid)
-    for att in content["attachments"]:
-        fullpath = get_storage_path(att["tmpname"])
-        try:
-            os.remove(fullpath)
-        except OSError:
-            pass
+    for att in manager.get_attachments(session_uid):
+        remove_file(att["tmpname"])
     manager.delete(session_uid)
 
 
+def remove_orphaned_files() -> int:
+    """Remove files not used by a compose session or a scheduled message.
+
+    Sessions expire in redis without notice so their files are
+    collected here. Recent files are kept since they might belong to
+    an upload still in progress.
+
+    :return: the number of removed files
+    """
+    from modoboa.webmail import models
+
+    storage_dir = get_storage_path("")
+    if not os.path.isdir(storage_dir):
+        return 0
+    used = get_session_tmpnames()
+    used.update(
+        os.path.basename(name)
+        for name in models.MessageAttachment.objects.values_list("file", flat=True)
+    )
+    limit = time.time() - constants.ORPHANED_ATTACHMENT_MIN_AGE
+    count = 0
+    with os.scandir(storage_dir) as it:
+        for entry in it:
+            if not entry.is_file(follow_symlinks=False) or entry.name in used:
+                continue
+            try:
+                if entry.stat().st_mtime > limit:
+                    continue
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            count += 1
+    return count
+
+
 def create_mail_attachment(attdef, payload=None):
     """Create the MIME part corresponding to the given attachment.
 
@@ -193,10 +288,19 @@ def create_mail_attachment(attdef, payload=None):
     return res
 
 
+class StoredUploadedFile(UploadedFile):
+    """A file uploaded directly to the attachments storage."""
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.tmpname = os.path.basename(file.name)
+
+
 class AttachmentUploadHandler(FileUploadHandler):
     """
-    Simple upload handler to limit the size of the attachments users
-    can upload.
+    Upload handler which writes attachments straight to the storage
+    directory, and limits the size of the attachments users can
+    upload.
     """
 
     def __init__(self, request=None):
@@ -206,13 +310,44 @@ class AttachmentUploadHandler(FileUploadHandler):
         self.maxsize = size2integer(
             param_tools.get_global_parameter("max_attachment_size")
         )
+        # Not named "file" since Django would try to close it on errors
+        self.destination = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.destination = create_storage_file()
+
+    def discard_file(self):
+        if self.destination is None:
+            return
+        self.destination.close()
+        remove_file(os.path.basename(self.destination.name))
+        self.destination = None
 
     def receive_data_chunk(self, raw_data, start):
         self.total_upload += len(raw_data)
         if self.total_upload >= self.maxsize:
             self.toobig = True
+            self.discard_file()
             raise SkipFile()
-        return raw_data
+        self.destination.write(raw_data)
+        return None
 
     def file_complete(self, file_size):
-        return None
+        if self.destination is None:
+            return None
+        self.destination.flush()
+        self.destination.seek(0)
+        result = StoredUploadedFile(
+            self.destination,
+            self.file_name,
+            self.content_type,
+            file_size,
+            self.charset,
+            self.content_type_extra,
+        )
+        self.destination = None
+        return result
+
+    def upload_interrupted(self):
+        self.discard_file()
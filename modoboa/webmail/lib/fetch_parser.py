@@ -4,12 +4,33 @@ The ``imaplib`` module doesn't parse IMAP responses, it returns raw
 values. Since Modoboa relies on BODYSTRUCTURE attributes to display
 messages (we don't want to overload the server), a parser is required.
 
-This module is Python 3 only; chunks may be ``str`` or ``bytes``.
+Responses are parsed in a single pass: each chunk returned by
+``imaplib`` is split into tokens by one regular expression and values
+are built while tokens are read. Literals are taken as is from the
+chunk that follows their marker, and text is only decoded value by
+value (charset detection is only used for values which are not valid
+UTF-8).
+
+Chunks may be ``str`` or ``bytes``.
 """
+
 import re
 
 from charset_normalizer import detect as charset_detect
 
+# One token per match: left parenthesis, right parenthesis, quoted
+# string, literal marker, atom (with an optional section and origin
+# octet, ie. BODY[HEADER.FIELDS (DATE)]<0>) or anything else (error)
+TOKEN_RE = re.compile(
+    r"\s*(?:(\()|(\))|(\"(?:[^\"\\]|\\.)*\")|\{(\d+)\}"
+    r"|([^\s()\"{\[\]]+(?:\[[^\]]*\](?:<\d+>)?)?)|(\S))"
+)
+
+# Containers (what we are parsing inside a message)
+BODYSTRUCTURE = 1
+FLAGS = 2
+LIST = 3
+
 
 class ParseError(Exception):
     """Generic parsing error."""
@@ -17,258 +38,192 @@ class ParseError(Exception):
     pass
 
 
-class Lexer:
-    """The lexical analysis part.
-
-    This class provides a simple way to define tokens (with patterns)
-    to be detected. Patterns are provided using a list of 2-uple. Each
-    2-uple consists of a token name and an associated pattern.
-
-    Example: [("left_bracket", r'\['),]
-    """
-
-    def __init__(self, definitions):
-        self.definitions = definitions
-        parts = []
-        for name, part in definitions:
-            parts.append(rf"(?P<{name}>{part})")
-        self.regexpString = "|".join(parts)
-        self.regexp = re.compile(self.regexpString, re.MULTILINE)
-        self.wsregexp = re.compile(r"\s+", re.M)
-
-    def curlineno(self):
-        """Return the current line number"""
-        return self.text[: self.pos].count("\n") + 1
-
-    def scan(self, text):
-        """Analyze some data.
-
-        Analyse the passed content. Each time a token is recognized, a
-        2-uple containing its name and the parsed value is raised
-        (using yield).
-
-        :param text: a string containing the data to parse
-        :raises: ParseError
-        """
-        self.pos = 0
-        self.text = text
-        while self.pos < len(text):
-            m = self.wsregexp.match(text, self.pos)
-            if m is not None:
-                self.pos = m.end()
-                continue
-
-            m = self.regexp.match(text, self.pos)
-            if m is None:
-                raise ParseError(f"unknown token {text[self.pos :]}")
-
-            self.pos = m.end()
-            yield (m.lastgroup, m.group(m.lastgroup))
+def decode_text(value: bytes | str) -> str:
+    """Decode a value sent by the server, guessing its encoding if needed."""
+    if isinstance(value, str):
+        return value
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    try:
+        result = charset_detect(value)
+    except UnicodeDecodeError:
+        raise RuntimeError("Can't find string encoding") from None
+    return value.decode(result["encoding"])
+
+
+def set_part_numbers(bs: list, prefix: str = "") -> None:
+    """Set part numbers of a parsed BODYSTRUCTURE."""
+    cpt = 1
+    for mp in bs:
+        if isinstance(mp, list):
+            set_part_numbers(mp, prefix)
+        elif isinstance(mp, dict):
+            if isinstance(mp["struct"][0], list):
+                set_part_numbers(mp["struct"][0], f"{prefix}{cpt}.")
+            mp["partnum"] = f"{prefix}{cpt}"
+            cpt += 1
 
 
 class FetchResponseParser:
-    """A token generator.
+    """Parse the result of a FETCH command.
 
-    By *token*, I mean: *literal*, *quoted* or anything else until the
-    next ' ' or ')' character (number, NIL and others should fall into
-    this last category).
+    The result is a dictionary indexed by message UID. Each value is
+    a dictionary containing the returned data items.
     """
 
-    rules = [
-        ("left_parenthesis", r"\("),
-        ("right_parenthesis", r"\)"),
-        ("string", r'"([^"\\]|\\.)*"'),
-        ("nil", r"NIL"),
-        (
-            "data_item",
-            r"(?P<name>[A-Z][A-Z\.0-9]+)"
-            r"(?P<section>\[.*\])?(?P<origin_octet>\<\d+\>)?",
-        ),
-        ("number", r"[0-9]+"),
-        ("literal_marker", r"{\d+}"),
-        ("flag", r"(\\|\$)?[a-zA-Z0-9\-_]+"),
-    ]
-
     def __init__(self):
         """Constructor."""
-        self.lexer = Lexer(self.rules)
         self.__reset_parser()
 
     def __reset_parser(self):
         """Reset parser states."""
         self.result = {}
-        self.__current_message = {}
-        self.__next_literal_len = 0
-        self.__cur_data_item = None
-        self.__args_parsing_func = None
-        self.__expected = None
-        self.__depth = 0
-        self.__bs_stack = []
-
-    def set_expected(self, *args):
-        """Indicate next expected token types."""
-        self.__expected = args
-
-    def __default_args_parser(self, ttype, tvalue):
-        """Default arguments parser."""
-        self.__current_message[self.__cur_data_item] = tvalue
-        self.__args_parsing_func = None
-
-    def __flags_args_parser(self, ttype, tvalue):
-        """FLAGS arguments parser."""
-        if ttype == "left_parenthesis":
-            self.__current_message[self.__cur_data_item] = []
-            self.__depth += 1
-        elif ttype == "flag":
-            self.__current_message[self.__cur_data_item].append(tvalue)
-            self.set_expected("flag", "right_parenthesis")
-        elif ttype == "right_parenthesis":
-            self.__args_parsing_func = None
-            self.__depth -= 1
+        self.__message = None
+        self.__data_item = None
+        # Lists being parsed inside the current data item
+        self.__stack = []
+        self.__container = None
+        self.__literal_len = None
+
+    def __store_literal(self, value):
+        """Store a literal value."""
+        if self.__stack:
+            self.__stack[-1].append(value)
+        elif self.__message is not None and self.__data_item is not None:
+            self.__message[self.__data_item] = value
+            self.__data_item = None
         else:
-            raise ParseError(f"Unexpected token found: {ttype}")
-
-    def __set_part_numbers(self, bs, prefix=""):
-        """Set part numbers."""
-        cpt = 1
-        for mp in bs:
-            if isinstance(mp, list):
-                self.__set_part_numbers(mp, prefix)
-            elif isinstance(mp, dict):
-                if isinstance(mp["struct"][0], list):
-                    nprefix = f"{prefix}{cpt}."
-                    self.__set_part_numbers(mp["struct"][0], nprefix)
-                mp["partnum"] = f"{prefix}{cpt}"
-                cpt += 1
-
-    def __bstruct_args_parser(self, ttype, tvalue):
-        """BODYSTRUCTURE arguments parser."""
-        if ttype == "left_parenthesis":
-            self.__bs_stack = [[]] + self.__bs_stack
-            return
-        if ttype == "right_parenthesis":
-            if len(self.__bs_stack) > 1:
-                part = self.__bs_stack.pop(0)
-                # Check if we are parsing a list of mime part or a
-                # list or arguments.
-                condition = len(self.__bs_stack[0]) > 0 and not isinstance(
-                    self.__bs_stack[0][0], dict
-                )
-                if condition:
-                    self.__bs_stack[0].append(part)
-                else:
-                    self.__bs_stack[0].append({"struct": part})
-            else:
-                # End of BODYSTRUCTURE
-                if not isinstance(self.__bs_stack[0][0], list):
-                    # Special case for non multipart structures
-                    self.__bs_stack[0] = {"struct": self.__bs_stack[0]}
-                self.__set_part_numbers(self.__bs_stack)
-                self.__current_message[self.__cur_data_item] = self.__bs_stack
-                self.__bs_stack = []
-                self.__args_parsing_func = None
-            return
-        if ttype == "string":
-            tvalue = tvalue.strip('"')
-            # Check if previous element was a mime part. If so, we are
-            # dealing with a 'multipart' mime part...
-            condition = len(self.__bs_stack[0]) and isinstance(
-                self.__bs_stack[0][-1], dict
-            )
-            if condition:
-                self.__bs_stack[0] = [self.__bs_stack[0]] + [tvalue]
-                return
-        elif ttype == "number":
-            tvalue = int(tvalue)
-        self.__bs_stack[0].append(tvalue)
-
-    def __parse_data_item(self, ttype, tvalue):
-        """Find next data item."""
-        if ttype == "data_item":
-            self.__cur_data_item = tvalue
-            if tvalue == "BODYSTRUCTURE":
-                self.set_expected("left_parenthesis")
-                self.__args_parsing_func = self.__bstruct_args_parser
-            elif tvalue == "FLAGS":
-                self.set_expected("left_parenthesis")
-                self.__args_parsing_func = self.__flags_args_parser
-            else:
-                self.__args_parsing_func = self.__default_args_parser
-            return
-        elif ttype == "right_parenthesis":
-            self.__depth -= 1
-            assert self.__depth == 0
-            # FIXME: sometimes, FLAGS are returned outside the UID
-            # scope (see sample 1 in tests). For now, we just ignore
-            # them but we need a better solution!
-            if "UID" in self.__current_message:
-                self.result[int(self.__current_message.pop("UID"))] = (
-                    self.__current_message
-                )
-            self.__current_message = {}
-            return
-        raise ParseError(
-            f"unexpected {ttype} found while looking for data_item near {tvalue}"
-        )
-
-    def __convert_to_str(self, chunk):
-        """Convert chunk to str and guess encoding.
-
-        On Python 3 we expect either ``str`` or ``bytes``.  ``bytes`` values
-        are decoded; ``str`` is returned unchanged.
-        """
-        if not isinstance(chunk, (bytes, str)):
-            return chunk
-        if isinstance(chunk, str):
-            return chunk
-        # chunk is bytes
-        try:
-            return chunk.decode("utf-8")
-        except UnicodeDecodeError:
-            pass
-        try:
-            result = charset_detect(chunk)
-        except UnicodeDecodeError:
-            raise RuntimeError("Can't find string encoding") from None
-        return chunk.decode(result["encoding"])
+            raise ParseError("unexpected literal found")
 
     def parse_chunk(self, chunk):
         """Parse chunk."""
+        if self.__literal_len is not None:
+            length = self.__literal_len
+            self.__literal_len = None
+            if chunk is None:
+                chunk = b""
+            if len(chunk) == length:
+                literal, chunk = chunk, None
+            else:
+                literal, chunk = chunk[:length], chunk[length:]
+            self.__store_literal(decode_text(literal))
         if not chunk:
             return
-        chunk = self.__convert_to_str(chunk)
-        if self.__next_literal_len:
-            literal = chunk[: self.__next_literal_len]
-            chunk = chunk[self.__next_literal_len :]
-            self.__next_literal_len = 0
-            if self.__cur_data_item != "BODYSTRUCTURE":
-                self.__current_message[self.__cur_data_item] = literal
-                self.__args_parsing_func = None
-            else:
-                self.__args_parsing_func("literal", literal)
-        for ttype, tvalue in self.lexer.scan(chunk):
-            if self.__expected is not None:
-                if ttype not in self.__expected:
-                    raise ParseError(
-                        "unexpected {} found while looking for {}".format(
-                            ttype, "|".join(self.__expected)
-                        )
-                    )
-                self.__expected = None
-            if ttype == "literal_marker":
-                self.__next_literal_len = int(tvalue[1:-1])
+        chunk = decode_text(chunk)
+        stack = self.__stack
+        message = self.__message
+        data_item = self.__data_item
+        container = self.__container
+        literal_len = None
+        for lpar, rpar, quoted, marker, atom, other in TOKEN_RE.findall(chunk):
+            if literal_len is not None:
+                raise ParseError("literal expected after literal marker")
+            if stack:
+                # Inside a list
+                if container == BODYSTRUCTURE:
+                    if quoted:
+                        value = quoted[1:-1]
+                        current = stack[-1]
+                        if current and type(current[-1]) is dict:
+                            # The previous element was a mime part so
+                            # we are dealing with a 'multipart' mime
+                            # part...
+                            stack[-1] = [current, value]
+                        else:
+                            current.append(value)
+                    elif atom:
+                        stack[-1].append(int(atom) if atom.isdigit() else atom)
+                    elif lpar:
+                        stack.append([])
+                    elif rpar:
+                        part = stack.pop()
+                        if stack:
+                            parent = stack[-1]
+                            if parent and type(parent[0]) is not dict:
+                                # List of arguments
+                                parent.append(part)
+                            else:
+                                parent.append({"struct": part})
+                            continue
+                        # End of BODYSTRUCTURE
+                        if part and type(part[0]) is not list:
+                            # Special case for non multipart structures
+                            part = {"struct": part}
+                        part = [part]
+                        set_part_numbers(part)
+                        message[data_item] = part
+                        data_item = container = None
+                    elif marker:
+                        literal_len = int(marker)
+                    else:
+                        raise ParseError(f"unknown token {other}")
+                    continue
+                if atom:
+                    stack[-1].append(atom)
+                elif quoted:
+                    stack[-1].append(quoted[1:-1])
+                elif lpar:
+                    stack.append([])
+                elif rpar:
+                    part = stack.pop()
+                    if stack:
+                        stack[-1].append(part)
+                    else:
+                        message[data_item] = part
+                        data_item = container = None
+                elif marker:
+                    literal_len = int(marker)
+                else:
+                    raise ParseError(f"unknown token {other}")
                 continue
-            elif self.__depth == 0:
-                if ttype == "number":
-                    # We should start here with a message ID
-                    self.set_expected("left_parenthesis")
-                if ttype == "left_parenthesis":
-                    self.__depth += 1
+            if message is None:
+                # We should start here with a message sequence number
+                # followed by a left parenthesis.
+                if lpar:
+                    message = {}
+                elif other:
+                    raise ParseError(f"unknown token {other}")
                 continue
-            elif self.__args_parsing_func is None:
-                self.__parse_data_item(ttype, tvalue)
+            if data_item is None:
+                if atom:
+                    data_item = atom
+                elif rpar:
+                    # FIXME: sometimes, FLAGS are returned outside the
+                    # UID scope (see sample 1 in tests). For now, we
+                    # just ignore them.
+                    if "UID" in message:
+                        self.result[int(message.pop("UID"))] = message
+                    message = None
+                else:
+                    raise ParseError(
+                        "unexpected token found while looking for data_item"
+                    )
                 continue
-            self.__args_parsing_func(ttype, tvalue)
+            # Value of the current data item
+            if atom:
+                message[data_item] = atom
+                data_item = None
+            elif quoted:
+                message[data_item] = quoted
+                data_item = None
+            elif lpar:
+                if data_item == "BODYSTRUCTURE":
+                    container = BODYSTRUCTURE
+                elif data_item == "FLAGS":
+                    container = FLAGS
+                else:
+                    container = LIST
+                stack.append([])
+            elif marker:
+                literal_len = int(marker)
+            else:
+                raise ParseError(f"unexpected token found while parsing {data_item}")
+        self.__message = message
+        self.__data_item = data_item
+        self.__container = container
+        self.__literal_len = literal_len
 
     def parse(self, data):
         """Parse received data."""
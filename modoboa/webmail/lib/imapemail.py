@@ -2,16 +2,14 @@
 Set of classes to manipulate/display emails inside the webmail.
 """
 
-import os
 import re
 import email
 
 from charset_normalizer import detect as charset_detect
 
 from django.apps import apps
-from django.conf import settings
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.urls import reverse
 from django.utils.encoding import smart_str
 from django.utils.html import conditional_escape
 from django.utils.translation import gettext as _
@@ -21,8 +19,8 @@ from modoboa.lib.email_utils import Email
 from modoboa.webmail import constants
 
 from . import imapheader
-from .attachments import get_storage_path
 from .imaputils import get_imapconnector, validate_imap_uid, BodyStructure
+from .inlines import get_part_cache_key, inline_cache
 from .utils import decode_payload
 
 
@@ -44,13 +42,24 @@ class ImapEmail(Email):
         self.request = request
         self.imapc = get_imapconnector(request)
         self.imapc = self.imapc.__enter__()
+        # Type of the last exception raised by an IMAP call
+        self.imap_error: type | None = None
         self.mbox, self.mailid = self.mailid.split(":")
         self.mailid = validate_imap_uid(self.mailid)
         self.attachments: dict[str, str] = {}
         self.To: list = []
 
     def __del__(self):
-        self.imapc.__exit__()
+        # A session which failed part-way is not given back to the pool
+        self.imapc.__exit__(self.imap_error)
+
+    def _imap_call(self, method, *args, **kwargs):
+        """Call a method of the IMAP connector, remembering failures."""
+        try:
+            return method(*args, **kwargs)
+        except Exception as exc:
+            self.imap_error = type(exc)
+            raise
 
     def fetch_headers(self, raw_addresses: bool = False) -> None:
         """Fetch message headers from server."""
@@ -58,8 +67,12 @@ class ImapEmail(Email):
         if self.mbox == constants.MAILBOX_NAME_SCHEDULED:
             requested_headers += [(constants.CUSTOM_HEADER_SCHEDULED_DATETIME, True)]
         header_names = [header[0].upper() for header in requested_headers]
-        msg = self.imapc.fetchmail(
-            self.mbox, self.mailid, readonly=False, what=" ".join(header_names)
+        msg = self._imap_call(
+            self.imapc.fetchmail,
+            self.mbox,
+            self.mailid,
+            readonly=False,
+            what=" ".join(header_names),
         )
         headers = msg[f"BODY[HEADER.FIELDS ({' '.join(header_names)})]"]
         self.fetch_body_structure(msg)
@@ -111,7 +124,9 @@ class ImapEmail(Email):
     def fetch_body_structure(self, msg=None):
         """Fetch BODYSTRUCTURE for email."""
         if msg is None:
-            msg = self.imapc.fetchmail(self.mbox, self.mailid, readonly=False)
+            msg = self._imap_call(
+                self.imapc.fetchmail, self.mbox, self.mailid, readonly=False
+            )
         self.bs = BodyStructure(msg["BODYSTRUCTURE"])
         self._find_attachments()
         if self.dformat not in ["plain", "html"]:
@@ -123,8 +138,14 @@ class ImapEmail(Email):
 
     def fetch_attachments(self):
         result = []
+        contents = self._imap_call(
+            self.imapc.fetchparts, self.mailid, self.mbox, list(self.attachments.keys())
+        )
         for partnum, filename in self.attachments.items():
-            attdef, content = self.imapc.fetchpart(self.mailid, self.mbox, partnum)
+            attdef = self.bs.find_attachment(partnum)
+            content = contents.get(partnum)
+            if attdef is None or content is None:
+                continue
             result.append(
                 {
                     "filename": filename,
@@ -147,17 +168,23 @@ class ImapEmail(Email):
         a communication with the IMAP server.
         """
         if self._body is None:
-            self.fetch_body_structure()
+            if not hasattr(self, "bs"):
+                self.fetch_body_structure()
             bodyc = ""
             parts = self.bs.contents.get(self.mformat, [])
+            inlines = self._get_missing_inlines()
+            # Text parts and inline images are fetched at once
+            contents = self._imap_call(
+                self.imapc.fetchparts,
+                self.mailid,
+                self.mbox,
+                [part["pnum"] for part in parts]
+                + [params["pnum"] for key, params in inlines],
+            )
             for part in parts:
-                pnum = part["pnum"]
-                data = self.imapc._cmd("FETCH", self.mailid, f"(BODY.PEEK[{pnum}])")
-                if not data or int(self.mailid) not in data:
+                if part["pnum"] not in contents:
                     continue
-                content = decode_payload(
-                    part["encoding"], data[int(self.mailid)][f"BODY[{pnum}]"]
-                )
+                content = decode_payload(part["encoding"], contents[part["pnum"]])
                 if not isinstance(content, str):
                     charset = self._find_content_charset(part)
                     if charset is not None:
@@ -167,7 +194,7 @@ class ImapEmail(Email):
                             result = charset_detect(content)
                             content = content.decode(result["encoding"])
                 bodyc += content
-            self._fetch_inlines()
+            self._store_inlines(inlines, contents)
             if len(bodyc) != 0:
                 bodyc = getattr(self, f"_post_process_{self.mformat}")(bodyc)
                 self._body = getattr(self, f"viewmail_{self.mformat}")(
@@ -182,8 +209,8 @@ class ImapEmail(Email):
     @property
     def source(self):
         """Retrieve email source."""
-        return self.imapc.fetchmail(
-            self.mbox, self.mailid, readonly=True, what="source"
+        return self._imap_call(
+            self.imapc.fetchmail, self.mbox, self.mailid, readonly=True, what="source"
         )["BODY[]"]
 
     def _find_content_charset(self, part):
@@ -218,33 +245,58 @@ class ImapEmail(Email):
                     break
             self.attachments[att["pnum"]] = smart_str(attname)
 
-    def _fetch_inlines(self):
-        """Store inline images on filesystem to display them."""
+    def _get_missing_inlines(self) -> list[tuple[str, dict]]:
+        """Return inline images which are not in cache.
+
+        The URL of cached images is set on their part definition.
+
+        :return: a list of (cache key, part definition)
+        """
+        result = []
+        if not self.bs.inlines:
+            return result
+        uidvalidity = self._imap_call(self.imapc.get_uidvalidity, self.mbox)
         for cid, params in list(self.bs.inlines.items()):
-            if re.search(r"\.\.", cid):
-                continue
-            fname = f"{self.mailid}_{cid}"
-            path = os.path.relpath(get_storage_path(fname), settings.MEDIA_ROOT)
-            params["fname"] = os.path.join(
-                settings.MEDIA_URL, os.path.basename(get_storage_path("")), fname
+            key = get_part_cache_key(
+                self.request.user.username, self.mbox, uidvalidity, self.mailid, cid
             )
-            if default_storage.exists(path):
+            name = cache.get(key)
+            if name is not None and inline_cache.get(name) is not None:
+                params["fname"] = reverse("v2:webmail-inline-image", args=[name])
+            else:
+                result.append((key, params))
+        return result
+
+    def _store_inlines(self, inlines: list[tuple[str, dict]], contents: dict) -> None:
+        """Store inline images in cache to display them."""
+        for key, params in inlines:
+            content = contents.get(params["pnum"])
+            if content is None:
                 continue
-            pdef, content = self.imapc.fetchpart(self.mailid, self.mbox, params["pnum"])
-            default_storage.save(
-                path, ContentFile(decode_payload(params["encoding"], content))
+            name = inline_cache.store(
+                decode_payload(params["encoding"], content), params["Content-Type"]
             )
+            if name is None:
+                continue
+            cache.set(key, name, constants.INLINE_PART_CACHE_TIMEOUT)
+            params["fname"] = reverse("v2:webmail-inline-image", args=[name])
 
     def _map_cid(self, url):
         m = re.match(".*cid:(.+)", url)
         if m:
             if m.group(1) in self.bs.inlines:
-                return self.bs.inlines[m.group(1)]["fname"]
+                return self.bs.inlines[m.group(1)].get("fname", url)
         return url
 
     def fetch_attachment(self, pnum):
         """Fetch an attachment from the IMAP server."""
-        return self.imapc.fetchpart(self.mailid, self.mbox, pnum)
+        if not hasattr(self, "bs"):
+            return self._imap_call(self.imapc.fetchpart, self.mailid, self.mbox, pnum)
+        contents = self._imap_call(
+            self.imapc.fetchparts, self.mailid, self.mbox, [pnum]
+        )
+        content = contents.get(pnum)
+        return self.bs.find_attachment(pnum), content
 
 
 class Modifier(ImapEmail):
@@ -0,0 +1,448 @@
+"""Push mailbox changes to webmail clients.
+
+Instead of polling mailbox counters, clients can open a stream of
+events (see ``views.events``). For each user, a single IMAP session
+per process watches mailboxes (using NOTIFY if the server supports
+it, IDLE on the INBOX otherwise) and the changes it reports are sent
+to all the open streams (ie. browser tabs) of this user.
+
+Everything here runs inside the event loop of an ASGI server, so
+the IMAP client is a minimal asyncio implementation (only the
+commands we need are supported).
+"""
+
+import asyncio
+import json
+import logging
+import re
+import ssl
+import weakref
+
+from django.conf import settings
+from django.utils import timezone
+
+from modoboa.lib import imap_utf7  # noqa
+from modoboa.lib import oauth2
+from modoboa.webmail import constants
+
+from ..exceptions import ImapError
+from .imaputils import STATUS_ITEM_RE
+
+logger = logging.getLogger("modoboa.webmail")
+
+LITERAL_RE = re.compile(rb"\{(\d+)\}\r\n$")
+UNTAGGED_RE = re.compile(rb"^\* (?:(\d+) )?([A-Z]+)\b ?(.*)$", re.DOTALL)
+STATUS_NAME_RE = re.compile(
+    rb'^(?:"((?:[^"\\]|\\.)*)"|\{\d+\}\r\n(.*?)|([^\s(]+)) \(([^)]*)\)', re.DOTALL
+)
+
+
+def parse_status(data: bytes) -> tuple[str, dict] | None:
+    """Parse the content of a STATUS response.
+
+    :param data: what follows the STATUS keyword
+    :return: (mailbox name, items) or None if the response is invalid
+    """
+    m = STATUS_NAME_RE.match(data)
+    if m is None:
+        return None
+    quoted, literal, atom, items = m.groups()
+    if quoted is not None:
+        name = re.sub(rb"\\(.)", rb"\1", quoted)
+    else:
+        name = literal if literal is not None else atom
+    name = name.decode("imap4-utf-7")
+    items = {
+        key.lower(): int(value) for key, value in STATUS_ITEM_RE.findall(items.decode())
+    }
+    return name, items
+
+
+def format_event(event: dict) -> bytes:
+    """Format an event for a text/event-stream response."""
+    return f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n".encode()
+
+
+class AsyncIMAPClient:
+    """Minimal asyncio IMAP client."""
+
+    def __init__(self, address: str, port: int, secured: bool) -> None:
+        self.address = address
+        self.port = port
+        self.secured = secured
+        self.capabilities: list[str] = []
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self._tag = 0
+
+    async def connect(self) -> None:
+        ssl_context = ssl.create_default_context() if self.secured else None
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.address, self.port, ssl=ssl_context
+            )
+        except OSError as error:
+            raise ImapError(f"Connection to IMAP server failed: {error}") from None
+        await self.read_response()
+
+    async def close(self) -> None:
+        """Close connection, ignoring errors."""
+        if self.writer is None:
+            return
+        try:
+            self.writer.close()
+            await self.writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+        self.writer = None
+
+    async def read_response(self) -> bytes:
+        """Read a complete response line (including literals)."""
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by IMAP server")
+        while True:
+            m = LITERAL_RE.search(line)
+            if m is None:
+                break
+            line += await self.reader.readexactly(int(m.group(1)))
+            line += await self.reader.readline()
+        return line.rstrip(b"\r\n")
+
+    async def send(self, data: bytes) -> None:
+        self.writer.write(data + b"\r\n")
+        await self.writer.drain()
+
+    async def start_command(self, *args: bytes | str) -> bytes:
+        """Send a command and return its tag."""
+        self._tag += 1
+        tag = f"W{self._tag}".encode()
+        args = [arg.encode() if isinstance(arg, str) else arg for arg in args]
+        await self.send(b" ".join([tag, *args]))
+        return tag
+
+    def is_completion(self, tag: bytes, line: bytes) -> bool:
+        """Tell if line completes the command, raise an error if it failed."""
+        if not line.startswith(tag + b" "):
+            return False
+        status, _, text = line[len(tag) + 1 :].partition(b" ")
+        if status != b"OK":
+            raise ImapError(text.decode(errors="replace"))
+        return True
+
+    async def read_until_tagged(self, tag: bytes) -> list[bytes]:
+        """Read responses until the completion of a command.
+
+        :return: the untagged responses received meanwhile
+        """
+        untagged = []
+        while True:
+            line = await self.read_response()
+            if self.is_completion(tag, line):
+                return untagged
+            if line.startswith(b"+"):
+                # Only happens when authentication fails (SASL error)
+                await self.send(b"\x01")
+                continue
+            untagged.append(line)
+
+    async def command(self, *args: bytes | str) -> list[bytes]:
+        """Run a command and return the untagged responses."""
+        return await self.read_until_tagged(await self.start_command(*args))
+
+    async def login(self, user: str, token: str) -> None:
+        """Authenticate and retrieve server capabilities."""
+        if not getattr(settings, "WEBMAIL_DEV_MODE", False):
+            responses = await self.command(
+                b"AUTHENTICATE",
+                b"OAUTHBEARER",
+                oauth2.build_oauthbearer_string(user, token),
+            )
+        else:
+            password = settings.WEBMAIL_DEV_PASSWORD.replace("\\", "\\\\")
+            password = password.replace('"', '\\"')
+            responses = await self.command(
+                b"LOGIN",
+                settings.WEBMAIL_DEV_USERNAME.encode(),
+                f'"{password}"'.encode(),
+            )
+        responses = [line for line in responses if line.startswith(b"* CAPABILITY ")]
+        if not responses:
+            responses = await self.command(b"CAPABILITY")
+        self.capabilities = responses[-1].decode().split()[2:]
+
+    async def idle(
+        self, timeout: float, interrupt: asyncio.Event | None = None
+    ) -> list[bytes]:
+        """Wait for changes using IDLE.
+
+        Reads are never cancelled (a response could be lost): the
+        pending read is completed after DONE is sent.
+
+        :param timeout: stop waiting after this delay (in seconds)
+        :param interrupt: stop waiting when this event is set
+        :return: the untagged responses received
+        """
+        tag = await self.start_command(b"IDLE")
+        responses = []
+        while True:
+            line = await self.read_response()
+            if line.startswith(b"+"):
+                break
+            if self.is_completion(tag, line):
+                raise ImapError("IDLE command refused")
+            responses.append(line)
+        pending = None
+        interrupted = asyncio.ensure_future(
+            interrupt.wait() if interrupt is not None else asyncio.Event().wait()
+        )
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(self.read_response())
+            await asyncio.wait(
+                {pending, interrupted},
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not pending.done():
+                break
+            line = pending.result()
+            pending = None
+            if self.is_completion(tag, line):
+                interrupted.cancel()
+                return responses
+            responses.append(line)
+            # Changes often come together (ie. EXISTS then RECENT)
+            timeout = constants.IMAP_NOTIFY_DEBOUNCE_DELAY
+        interrupted.cancel()
+        await self.send(b"DONE")
+        line = await pending
+        if self.is_completion(tag, line):
+            return responses
+        responses.append(line)
+        return responses + await self.read_until_tagged(tag)
+
+
+class MailboxWatcher:
+    """Watch the mailboxes of a user and notify subscribers."""
+
+    def __init__(self, key: tuple, user: str, conf: dict) -> None:
+        self.key = key
+        self.user = user
+        self.conf = conf
+        self.token: str | None = None
+        self.expires = None
+        self.counters: dict[str, dict] = {}
+        self.subscribers: set[asyncio.Queue] = set()
+        self.task: asyncio.Task | None = None
+        # Set when the last subscriber leaves
+        self.unused = asyncio.Event()
+
+    def set_credentials(self, token: str, expires) -> None:
+        """Remember the most recent access token."""
+        if self.token is None or (
+            self.expires is not None and (expires is None or expires > self.expires)
+        ):
+            self.token = token
+            self.expires = expires
+
+    def subscribe(self, token: str, expires) -> asyncio.Queue:
+        """Register a new subscriber.
+
+        Known counters are immediately queued.
+        """
+        self.set_credentials(token, expires)
+        queue = asyncio.Queue(maxsize=constants.EVENTS_QUEUE_SIZE)
+        for mailbox, counters in self.counters.items():
+            queue.put_nowait(
+                {"event": "status", "data": {"mailbox": mailbox, **counters}}
+            )
+        self.subscribers.add(queue)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+        if not self.subscribers:
+            self.unused.set()
+
+    def publish(self, event: dict | None) -> None:
+        """Send an event (None means end of stream) to subscribers.
+
+        Slow subscribers lose their oldest events.
+        """
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def update_counters(self, mailbox: str, items: dict) -> None:
+        """Publish the new counters of a mailbox."""
+        previous = self.counters.get(mailbox, {})
+        counters = {**previous, **items}
+        counters = {
+            key: value
+            for key, value in counters.items()
+            if key in ["messages", "unseen"]
+        }
+        if counters == previous:
+            return
+        self.counters[mailbox] = counters
+        self.publish({"event": "status", "data": {"mailbox": mailbox, **counters}})
+        if "messages" in previous and counters["messages"] > previous["messages"]:
+            self.publish({"event": "new_message", "data": {"mailbox": mailbox}})
+
+    async def refresh_counters(self, client: AsyncIMAPClient, mailbox: str) -> None:
+        name = mailbox.encode("imap4-utf-7").replace(b"\\", b"\\\\")
+        name = name.replace(b'"', b'\\"')
+        for line in await client.command(
+            b"STATUS", b'"' + name + b'"', b"(MESSAGES UNSEEN)"
+        ):
+            m = UNTAGGED_RE.match(line)
+            if m is None or m.group(2) != b"STATUS":
+                continue
+            result = parse_status(m.group(3))
+            if result is not None:
+                self.update_counters(*result)
+
+    async def handle_responses(
+        self, client: AsyncIMAPClient, responses: list[bytes]
+    ) -> None:
+        """Find changed mailboxes in untagged responses."""
+        changed = set()
+        for line in responses:
+            m = UNTAGGED_RE.match(line)
+            if m is None:
+                continue
+            if m.group(2) == b"STATUS":
+                result = parse_status(m.group(3))
+                if result is None:
+                    continue
+                mailbox, items = result
+                if "unseen" in items and "messages" in items:
+                    self.update_counters(mailbox, items)
+                else:
+                    changed.add(mailbox)
+            elif m.group(2) in [b"EXISTS", b"EXPUNGE", b"FETCH", b"VANISHED"]:
+                changed.add("INBOX")
+        for mailbox in changed:
+            await self.refresh_counters(client, mailbox)
+
+    def get_idle_timeout(self, expires) -> float:
+        """Return how long the next IDLE command can last.
+
+        :param expires: expiration date of the token used by the session
+        """
+        timeout = constants.IMAP_NOTIFY_IDLE_TIMEOUT
+        if expires is not None:
+            timeout = min(timeout, (expires - timezone.now()).total_seconds())
+        return timeout
+
+    async def watch(self) -> bool:
+        """Open an IMAP session and wait for changes.
+
+        Returns when nobody has been listening for a while or when
+        the token used to authenticate has expired.
+
+        :return: True if a new session must be opened (a more recent
+                 token is available)
+        """
+        client = AsyncIMAPClient(
+            self.conf["imap_server"], self.conf["imap_port"], self.conf["imap_secured"]
+        )
+        await client.connect()
+        try:
+            expires = self.expires
+            await client.login(self.user, self.token)
+            if "NOTIFY" in client.capabilities:
+                await client.command(
+                    b"NOTIFY",
+                    b"SET",
+                    b"(personal (MessageNew MessageExpunge FlagChange))",
+                )
+            else:
+                await client.command(b"EXAMINE", b"INBOX")
+            await self.refresh_counters(client, "INBOX")
+            loop = asyncio.get_running_loop()
+            unused_since = None
+            while True:
+                timeout = self.get_idle_timeout(expires)
+                if timeout <= 0:
+                    return self.expires != expires
+                if self.subscribers:
+                    unused_since = None
+                else:
+                    if unused_since is None:
+                        unused_since = loop.time()
+                    remaining = (
+                        constants.IMAP_NOTIFY_GRACE_PERIOD - loop.time() + unused_since
+                    )
+                    if remaining <= 0:
+                        break
+                    timeout = min(timeout, remaining)
+                self.unused.clear()
+                responses = await client.idle(
+                    timeout, self.unused if self.subscribers else None
+                )
+                await self.handle_responses(client, responses)
+            await client.command(b"LOGOUT")
+        finally:
+            await client.close()
+        return False
+
+    async def run(self) -> None:
+        try:
+            while await self.watch():
+                pass
+        except (ImapError, OSError, ConnectionError, asyncio.IncompleteReadError):
+            logger.exception("Mailbox watcher of %s failed", self.user)
+        finally:
+            unregister(self)
+            self.task = None
+            # Subscribers are told to reconnect (with a new token)
+            self.publish(None)
+
+
+# One registry of watchers per event loop
+_watchers = weakref.WeakKeyDictionary()
+
+
+def unregister(watcher: MailboxWatcher) -> None:
+    watchers = _watchers.get(asyncio.get_running_loop(), {})
+    if watchers.get(watcher.key) is watcher:
+        del watchers[watcher.key]
+
+
+def get_watcher(user: str, conf: dict) -> MailboxWatcher:
+    """Return the watcher of a user, creating it if needed."""
+    watchers = _watchers.setdefault(asyncio.get_running_loop(), {})
+    key = (user, conf["imap_server"], conf["imap_port"], conf["imap_secured"])
+    watcher = watchers.get(key)
+    if watcher is None:
+        watcher = watchers[key] = MailboxWatcher(key, user, conf)
+    return watcher
+
+
+async def iter_events(watcher: MailboxWatcher, token: str, expires):
+    """Yield the events of a watcher, formatted for an event stream.
+
+    A comment is sent at regular intervals to keep the connection
+    open.
+    """
+    queue = watcher.subscribe(token, expires)
+    try:
+        yield f"retry: {constants.EVENTS_RETRY_DELAY * 1000}\n\n".encode()
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    queue.get(), constants.EVENTS_KEEPALIVE_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if event is None:
+                break
+            yield format_event(event)
+    finally:
+        watcher.unsubscribe(queue)
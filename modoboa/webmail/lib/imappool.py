@@ -0,0 +1,175 @@
+"""Pool of authenticated IMAP sessions.
+
+Opening a webmail IMAP connection costs several round trips (TLS
+handshake, AUTHENTICATE, CAPABILITY, NAMESPACE). Sessions are kept
+open by the worker process once a request is done so that the next
+requests of the same user can reuse them.
+"""
+
+import imaplib
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from modoboa.webmail import constants
+
+# ssl.SSLError is a subclass of OSError
+SESSION_ERRORS = (OSError, imaplib.IMAP4.error)
+
+
+def get_setting(name: str) -> int:
+    """Return pool setting, falling back to default value."""
+    default = getattr(constants, f"IMAP_POOL_{name}")
+    return getattr(settings, f"WEBMAIL_IMAP_POOL_{name}", default)
+
+
+class IMAPSession:
+    """An authenticated IMAP session and what we know about it."""
+
+    def __init__(self, key: tuple, m, capabilities: list, expires=None) -> None:
+        self.key = key
+        self.m = m
+        self.capabilities = capabilities
+        self.expires = expires
+        self.hdelimiter: str | None = None
+        self.ns_prefixes: dict = {}
+        self.current_mailbox: str | None = None
+        self.enabled: set[str] = set()
+        self.last_used = self.last_checked = time.monotonic()
+
+    def is_expired(self) -> bool:
+        """Tell if the token used to authenticate has expired."""
+        return self.expires is not None and self.expires <= timezone.now()
+
+    def check(self) -> bool:
+        """Make sure the session is still alive using a NOOP command."""
+        try:
+            typ, data = self.m._simple_command("NOOP")
+        except SESSION_ERRORS:
+            return False
+        self.m.untagged_responses.clear()
+        self.last_checked = time.monotonic()
+        return typ == "OK"
+
+    def close(self) -> None:
+        """Close session, ignoring errors."""
+        try:
+            self.m.logout()
+        except SESSION_ERRORS:
+            pass
+
+
+class IMAPConnectionPool:
+    """Per-process pool of idle IMAP sessions, indexed by user."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle: dict[tuple, list[IMAPSession]] = {}
+
+    def _reset(self) -> None:
+        """Forget sessions inherited from the parent process."""
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _count(self) -> int:
+        return sum(len(sessions) for sessions in self._idle.values())
+
+    def _pop_stale_sessions(self, now: float) -> list[IMAPSession]:
+        """Remove sessions idle for too long or with an expired token."""
+        idle_timeout = get_setting("IDLE_TIMEOUT")
+        stale = []
+        for key in list(self._idle):
+            sessions = []
+            for session in self._idle[key]:
+                if now - session.last_used > idle_timeout or session.is_expired():
+                    stale.append(session)
+                else:
+                    sessions.append(session)
+            if sessions:
+                self._idle[key] = sessions
+            else:
+                del self._idle[key]
+        return stale
+
+    def _pop_oldest_session(self) -> IMAPSession | None:
+        """Remove the least recently used session, whatever its user."""
+        oldest = None
+        for sessions in self._idle.values():
+            if not sessions:
+                continue
+            if oldest is None or sessions[0].last_used < oldest.last_used:
+                oldest = sessions[0]
+        if oldest is None:
+            return None
+        sessions = self._idle[oldest.key]
+        sessions.remove(oldest)
+        if not sessions:
+            del self._idle[oldest.key]
+        return oldest
+
+    def acquire(self, key: tuple) -> IMAPSession | None:
+        """Return an idle and healthy session for key, if any.
+
+        Network operations (NOOP, LOGOUT) are done outside the lock.
+        """
+        if get_setting("SIZE") <= 0:
+            return None
+        check_interval = get_setting("CHECK_INTERVAL")
+        while True:
+            now = time.monotonic()
+            session = None
+            with self._lock:
+                stale = self._pop_stale_sessions(now)
+                sessions = self._idle.get(key)
+                if sessions:
+                    session = sessions.pop()
+                    if not sessions:
+                        del self._idle[key]
+            for item in stale:
+                item.close()
+            if session is None:
+                return None
+            if now - session.last_checked < check_interval or session.check():
+                return session
+            session.close()
+
+    def release(self, session: IMAPSession) -> bool:
+        """Put a session back in the pool.
+
+        :return: False if the session was not kept (caller must close it)
+        """
+        size = get_setting("SIZE")
+        if size <= 0 or session.is_expired():
+            return False
+        session.m.untagged_responses.clear()
+        # The session has just been used so we know it is alive
+        session.last_used = session.last_checked = time.monotonic()
+        evicted = None
+        with self._lock:
+            if len(self._idle.get(session.key, [])) >= size:
+                return False
+            if self._count() >= get_setting("MAX_CONNECTIONS"):
+                evicted = self._pop_oldest_session()
+                if evicted is None:
+                    return False
+            self._idle.setdefault(session.key, []).append(session)
+        if evicted is not None:
+            evicted.close()
+        return True
+
+    def clear(self) -> None:
+        """Close every idle session."""
+        with self._lock:
+            sessions = [s for sessions in self._idle.values() for s in sessions]
+            self._idle = {}
+        for session in sessions:
+            session.close()
+
+
+pool = IMAPConnectionPool()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=pool._reset)
@@ -1,12 +1,15 @@
 """Extra IMAPv4 utilities."""
 
+from collections.abc import Iterator
 import email
+import hashlib
 import imaplib
 import re
 import ssl
 import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import gettext as _
 
 from modoboa.lib import imap_utf7  # noqa
@@ -17,6 +20,7 @@ from modoboa.webmail import constants
 
 from ..exceptions import ImapError, WebmailInternalError
 from .fetch_parser import FetchResponseParser
+from .imappool import IMAPSession, pool
 
 # imaplib.Debug = 4
 
@@ -30,6 +34,16 @@ if hasattr(imaplib, "_MAXLINE") and imaplib._MAXLINE < MAXLINE:
 UID_RE = re.compile(r"^[0-9]+(?:,[0-9]+)*$")
 # A MIME part number: dot-separated positive integers (e.g. "1", "2.1").
 PARTNUM_RE = re.compile(r"^[0-9]+(?:\.[0-9]+)*$")
+# Items of STATUS, ESEARCH and FETCH (CHANGEDSINCE) responses
+STATUS_ITEM_RE = re.compile(r"([A-Z]+) (\d+)")
+ESEARCH_COUNT_RE = re.compile(r"\bCOUNT (\d+)")
+ESEARCH_PARTIAL_RE = re.compile(r"\bPARTIAL \(\S+ ([0-9:,]+|NIL)\)")
+ESEARCH_ALL_RE = re.compile(r"\bALL ([0-9:,]+)")
+FETCH_UID_RE = re.compile(r"\bUID (\d+)")
+FETCH_FLAGS_RE = re.compile(r"\bFLAGS \(([^)]*)\)")
+# STATUS response: mailbox name (quoted or not, missing for literals)
+# followed by the list of items
+STATUS_RESPONSE_RE = re.compile(r'^\s*(?:"((?:[^"\\]|\\.)*)"|([^\s(]+))?\s*\(([^)]*)\)')
 
 
 def validate_imap_uid(value):
@@ -64,6 +78,70 @@ def escape_search_pattern(pattern: str) -> str:
     return pattern.replace("\\", "\\\\").replace('"', '\\"')
 
 
+def parse_sequence_set(value: str) -> list[str]:
+    """Expand a sequence set (ex: 1:3,7) into a list of UIDs.
+
+    Order is preserved (ESORT results are ordered), so a range can be
+    descending.
+    """
+    result = []
+    for item in value.split(","):
+        if ":" not in item:
+            result.append(item)
+            continue
+        start, stop = (int(bound) for bound in item.split(":"))
+        step = 1 if start <= stop else -1
+        result += [str(uid) for uid in range(start, stop + step, step)]
+    return result
+
+
+def slice_sequence_set(value: str, first: int, last: int) -> list[str]:
+    """Return the UIDs found between two positions of a sequence set.
+
+    Only the requested part is expanded, so a large (compact) result
+    of a SORT or SEARCH command can be paginated cheaply.
+
+    :param first: position of the first UID (starting from 1)
+    :param last: position of the last UID (included)
+    """
+    result = []
+    position = 0
+    for item in value.split(","):
+        start, _, stop = item.partition(":")
+        start = int(start)
+        stop = int(stop) if stop else start
+        step = 1 if start <= stop else -1
+        size = abs(stop - start) + 1
+        if position + size >= first:
+            begin = max(first - position - 1, 0)
+            end = min(last - position, size)
+            result += [str(start + step * index) for index in range(begin, end)]
+        position += size
+        if position >= last:
+            break
+    return result
+
+
+def get_uid_index_cache_keys(user: str, mbox: str, query: list) -> tuple[str, str]:
+    """Return cache keys used to store sorted UID lists.
+
+    The first key stores a generation number shared by all the lists
+    of a mailbox, the second one the list matching query.
+    """
+    mbox_hash = hashlib.sha256(f"{user}\0{mbox or 'INBOX'}".encode()).hexdigest()
+    query_hash = hashlib.sha256(b"\0".join(bytes(item) for item in query)).hexdigest()
+    return (
+        f"webmail:uid_index_generation:{mbox_hash}",
+        f"webmail:uid_index:{mbox_hash}:{query_hash}",
+    )
+
+
+def get_mailbox_counters_cache_key(user: str) -> str:
+    """Return the cache key used to store mailbox counters of user."""
+    user_hash = hashlib.sha256(user.encode()).hexdigest()
+    return f"webmail:mailbox_counters:{user_hash}"
+
+
 class BodyStructure:
     """
     BODYSTRUCTURE response parser.
@@ -129,6 +207,7 @@ class BodyStructure:
                 self.contents[subtype].append(params)
             return
         elif multisubtype in ["related"]:
+            params["Content-Type"] = ftype
             self.inlines[params["cid"].strip("<>")] = params
             return
 
@@ -184,29 +263,66 @@ class IMAPconnector:
     )
     unseen_pattern = re.compile(r"[^\(]+\(UNSEEN (\d+)\)")
 
-    def __init__(self, user: str, password: str, with_namespaces: bool = True) -> None:
+    def __init__(
+        self,
+        user: str,
+        password: str,
+        with_namespaces: bool = True,
+        token_expires=None,
+    ) -> None:
         self.__hdelimiter: str | None = None
         self.__ns_prefixes: dict = {}
         self.quota_usage: int = -1
         self.quota_limit: int | None = None
         self.quota_current: int | None = None
         self.criterions: list = []
+        self.messages: list[str] = []
+        self.messages_offset: int = 0
+        self.enabled: set[str] = set()
         self.conf = dict(param_tools.get_global_parameters("webmail"))
         self.address = self.conf["imap_server"]
         self.port = self.conf["imap_port"]
         self.user = user
         self.password = password
         self.with_namespaces = with_namespaces
+        self.token_expires = token_expires
+        self.session: IMAPSession | None = None
+        self.pool_key = (user, self.address, self.port, self.conf["imap_secured"])
 
     def __enter__(self):
-        self.login(self.user, self.password)
-        if self.load_namespaces:
+        session = pool.acquire(self.pool_key)
+        if session is not None:
+            self._attach_session(session)
+        else:
+            self.login(self.user, self.password)
+        if self.__hdelimiter is None:
             self.load_namespaces()
         return self
 
-    def __exit__(self, *args):
+    def __exit__(self, exc_type=None, *args):
+        # Sessions are only given back to the pool when we know they
+        # are in a clean state
+        if self.session is not None and exc_type is None:
+            self.session.hdelimiter = self.__hdelimiter
+            self.session.ns_prefixes = self.__ns_prefixes
+            self.session.current_mailbox = getattr(self, "current_mailbox", None)
+            if pool.release(self.session):
+                self.session = None
+                self.m = None
+                return
         self.logout()
 
+    def _attach_session(self, session: IMAPSession) -> None:
+        """Reuse an already authenticated session."""
+        self.session = session
+        self.m = session.m
+        self.capabilities = session.capabilities
+        self.enabled = session.enabled
+        self.__hdelimiter = session.hdelimiter
+        self.__ns_prefixes = session.ns_prefixes
+        if session.current_mailbox is not None:
+            self.current_mailbox = session.current_mailbox
+
     def _cmd(self, name: str, *args, **kwargs) -> list | None:
         """IMAP command wrapper.
 
@@ -219,6 +335,7 @@ class IMAPconnector:
         parsed using the IMAPclient module before being returned.
 
         :param name: the command's name
+        :param raw: do not parse FETCH result
         :return: the command's result
         """
         if name in ["FETCH", "SORT", "STORE", "COPY", "SEARCH"]:
@@ -228,7 +345,7 @@ class IMAPconnector:
                 raise ImapError(e) from None
             if typ == "NO":
                 raise ImapError(data)
-            if name == "FETCH":
+            if name == "FETCH" and not kwargs.get("raw"):
                 return FetchResponseParser().parse(data)
             return data
 
@@ -293,6 +410,14 @@ class IMAPconnector:
         else:
             data = self._cmd("CAPABILITY")
             self.capabilities = data[0].decode().split()
+        if "QRESYNC" in self.capabilities:
+            # Needed to retrieve expunged messages (VANISHED)
+            self._cmd("ENABLE", "QRESYNC")
+            self.enabled.add("QRESYNC")
+        self.session = IMAPSession(
+            self.pool_key, self.m, self.capabilities, self.token_expires
+        )
+        self.session.enabled = self.enabled
 
     def logout(self) -> None:
         """Logout from server."""
@@ -303,6 +428,7 @@ class IMAPconnector:
         self._cmd("LOGOUT")
         del self.m
         self.m = None
+        self.session = None
         if hasattr(self, "current_mailbox"):
             del self.current_mailbox
 
@@ -338,11 +464,8 @@ class IMAPconnector:
             pattern = escape_search_pattern(pattern)
             criterions = ""
             for c in criterion.split(","):
-                if c == "from_addr":
-                    key = "FROM"
-                elif c == "subject":
-                    key = "SUBJECT"
-                else:
+                key = constants.SEARCH_CRITERIA.get(c)
+                if key is None:
                     continue
                 criterions = or_criterion(criterions, f'({key} "{pattern}")')
 
@@ -356,8 +479,14 @@ class IMAPconnector:
         multiplications, we sort messages in the same time. This will
         be usefull for other methods.
 
+        If the server supports ESORT and ``window`` is given, the
+        total is counted by the server and only the requested part of
+        the sorted list is retrieved. Otherwise, the whole sorted list
+        is kept in cache until the mailbox changes.
+
         :param order: sorting order
         :param folder: mailbox to scan
+        :param window: (first, last) indexes of the needed messages
         """
         if "order" in kwargs and kwargs["order"]:
             sign = kwargs["order"][:1]
@@ -372,17 +501,153 @@ class IMAPconnector:
         # EXAMINE plante mais je pense que c'est du à une mauvaise
         # lecture des réponses de ma part...
         self.select_mailbox(mbox, readonly=False)
-        cmdname = "SORT"
-        data = self._cmd(
-            cmdname,
+        query = [
             bytearray(f"({criterion})", "utf-8"),
             b"UTF-8",
             b"(NOT DELETED)",
             *self.criterions,
-        )
-        self.messages = data[0].decode().split()
+        ]
+        window = kwargs.get("window")
+        if window and "ESORT" in self.capabilities:
+            total = self._esort(query, *window)
+        else:
+            self.messages = self._sorted_uids(mbox, query)
+            self.messages_offset = 0
+            total = len(self.messages)
         self.getquota(mbox)
-        return len(self.messages)
+        return total
+
+    def has_partial_sort(self) -> bool:
+        """Tell if server can return a part of a sorted list."""
+        return "ESORT" in self.capabilities and (
+            "CONTEXT=SORT" in self.capabilities or "PARTIAL" in self.capabilities
+        )
+
+    def _esort(self, query: list, first: int, last: int) -> int:
+        """Retrieve a part of a sorted list of messages (ESORT).
+
+        With CONTEXT=SORT (or PARTIAL), only the requested part is
+        returned by the server. Otherwise, the whole list is returned
+        as a sequence set and only the requested part is expanded.
+
+        :return: the total number of messages
+        """
+        partial = self.has_partial_sort()
+        if partial:
+            items = f"COUNT PARTIAL {first}:{last}"
+        else:
+            items = "COUNT ALL"
+        self._cmd("SORT", b"RETURN", f"({items})".encode(), *query)
+        response = self.m.untagged_responses.pop("ESEARCH", [b""])[-1].decode()
+        m = ESEARCH_COUNT_RE.search(response)
+        total = int(m.group(1)) if m else 0
+        if partial:
+            m = ESEARCH_PARTIAL_RE.search(response)
+            if m is None or m.group(1) == "NIL":
+                self.messages = []
+            else:
+                self.messages = parse_sequence_set(m.group(1))
+        else:
+            m = ESEARCH_ALL_RE.search(response)
+            self.messages = slice_sequence_set(m.group(1), first, last) if m else []
+        self.messages_offset = first - 1
+        return total
+
+    def _get_mailbox_state(self, mbox: str) -> dict:
+        """Retrieve what's needed to know if a mailbox has changed."""
+        items = "MESSAGES UIDNEXT UIDVALIDITY"
+        if "CONDSTORE" in self.capabilities or "QRESYNC" in self.capabilities:
+            items += " HIGHESTMODSEQ"
+        data = self._cmd("STATUS", self._encode_mbox_name(mbox), f"({items})")
+        response = data[-1].decode()
+        response = response[response.rfind("(") :]
+        state = {name: int(value) for name, value in STATUS_ITEM_RE.findall(response)}
+        if not {"MESSAGES", "UIDNEXT", "UIDVALIDITY"}.issubset(state):
+            return {}
+        return state
+
+    def get_uidvalidity(self, mbox: str) -> int | None:
+        """Return the UIDVALIDITY value of a mailbox, if known."""
+        return self._get_mailbox_state(mbox).get("UIDVALIDITY")
+
+    def _sorted_uids(self, mbox: str, query: list) -> list[str]:
+        """Return the sorted list of UIDs matching query.
+
+        The list is kept in cache and is only retrieved again when
+        the mailbox has changed (according to UIDVALIDITY, UIDNEXT,
+        MESSAGES and HIGHESTMODSEQ). When QRESYNC is enabled, removed
+        messages are simply dropped from the cached list.
+        """
+        state = self._get_mailbox_state(mbox)
+        if not state:
+            return self._cmd("SORT", *query)[0].decode().split()
+        generation_key, key = get_uid_index_cache_keys(self.user, mbox, query)
+        generation = cache.get(generation_key)
+        entry = cache.get(key)
+        uids = None
+        if (
+            entry is not None
+            and entry["generation"] == generation
+            and entry["state"]["UIDVALIDITY"] == state["UIDVALIDITY"]
+        ):
+            if entry["state"] == state:
+                return entry["uids"]
+            uids = self._update_sorted_uids(entry, state)
+        if uids is None:
+            uids = self._cmd("SORT", *query)[0].decode().split()
+        cache.set(
+            key,
+            {"generation": generation, "state": state, "uids": uids},
+            constants.UID_INDEX_CACHE_TIMEOUT,
+        )
+        return uids
+
+    def _update_sorted_uids(self, entry: dict, state: dict) -> list[str] | None:
+        """Try to remove deleted messages from a cached list.
+
+        Only possible when no message was added.
+
+        :return: the updated list or None if a full sort is needed
+        """
+        modseq = entry["state"].get("HIGHESTMODSEQ")
+        if (
+            "QRESYNC" not in self.enabled
+            or modseq is None
+            or entry["state"]["UIDNEXT"] != state["UIDNEXT"]
+        ):
+            return None
+        data = self._cmd(
+            "FETCH", "1:*", "(FLAGS)", f"(CHANGEDSINCE {modseq} VANISHED)", raw=True
+        )
+        removed = set()
+        for response in self.m.untagged_responses.pop("VANISHED", []):
+            removed.update(parse_sequence_set(response.decode().split()[-1]))
+        known = set(entry["uids"])
+        for response in data:
+            if not isinstance(response, bytes):
+                continue
+            response = response.decode()
+            uid = FETCH_UID_RE.search(response)
+            flags = FETCH_FLAGS_RE.search(response)
+            if uid is None or flags is None:
+                continue
+            if "\\Deleted" in flags.group(1).split():
+                removed.add(uid.group(1))
+            elif uid.group(1) not in known:
+                # A message is back (undeleted), we can't know where
+                return None
+        return [uid for uid in entry["uids"] if uid not in removed]
+
+    def _invalidate_sorted_uids(self, mbox: str) -> None:
+        """Invalidate cached lists of UIDs after a local change.
+
+        Only required when the server does not support CONDSTORE
+        since setting the \\Deleted flag changes nothing else.
+        """
+        if "CONDSTORE" in self.capabilities or "QRESYNC" in self.capabilities:
+            return
+        generation_key = get_uid_index_cache_keys(self.user, mbox, [])[0]
+        cache.set(generation_key, time.time_ns(), constants.UID_INDEX_CACHE_TIMEOUT)
 
     def select_mailbox(
         self, name: str, readonly: bool = True, force: bool = False
@@ -396,27 +661,111 @@ class IMAPconnector:
         """
         if hasattr(self, "current_mailbox"):
             if self.current_mailbox == name and not force:
-                return
+                # A mailbox opened with EXAMINE must be selected again
+                # before any modification
+                if readonly or not getattr(self.m, "is_readonly", False):
+                    return
         self.current_mailbox = name
         name = self._encode_mbox_name(name)
         if readonly:
             self._cmd("EXAMINE", name)
-            self.m.is_readonly = True
         else:
             self._cmd("SELECT", name)
+        self.m.is_readonly = readonly
         self.m.state = "SELECTED"
 
+    def _parse_status_responses(self, data: list) -> dict:
+        """Parse untagged STATUS responses.
+
+        :return: a dict indexed by mailbox name
+        """
+        result = {}
+        name = None
+        for item in data:
+            if isinstance(item, tuple):
+                # Mailbox name sent as a literal
+                name = item[1].decode("imap4-utf-7")
+                continue
+            m = STATUS_RESPONSE_RE.match(item.decode())
+            if m is None:
+                continue
+            quoted, atom, items = m.groups()
+            if quoted is not None:
+                name = re.sub(r"\\(.)", r"\1", quoted)
+            elif atom is not None:
+                name = atom
+            if name is None:
+                continue
+            name = bytearray(name, "utf-8").decode("imap4-utf-7")
+            result[name] = {
+                key: int(value) for key, value in STATUS_ITEM_RE.findall(items)
+            }
+            name = None
+        return result
+
+    def _get_cached_counters(self) -> dict:
+        return cache.get(get_mailbox_counters_cache_key(self.user)) or {}
+
+    def _cache_counters(self, counters: dict) -> None:
+        """Store mailbox counters for a short time."""
+        if not counters:
+            return
+        key = get_mailbox_counters_cache_key(self.user)
+        cached = cache.get(key) or {}
+        cached.update(counters)
+        cache.set(key, cached, constants.MAILBOX_COUNTERS_CACHE_TIMEOUT)
+
+    def _invalidate_counters(self) -> None:
+        """Forget cached mailbox counters after a local change."""
+        cache.delete(get_mailbox_counters_cache_key(self.user))
+
     def unseen_messages(self, mailbox: str) -> int:
         """Return the number of unseen messages
 
         :param mailbox: the mailbox's name
         :return: an integer
         """
-        data = self._cmd("STATUS", self._encode_mbox_name(mailbox), "(UNSEEN)")
-        m = self.unseen_pattern.match(data[-1].decode())
-        if m is None:
-            return 0
-        return int(m.group(1))
+        return self.unseen_counters([mailbox])[mailbox]
+
+    def unseen_counters(self, mailboxes: list[str]) -> dict[str, int]:
+        """Return the number of unseen messages of several mailboxes.
+
+        Cached counters are used when possible. Otherwise, one LIST
+        command is issued if the server supports LIST-STATUS and
+        LIST-EXTENDED, or one STATUS command per mailbox.
+
+        :param mailboxes: a list of mailbox names
+        :return: a dict indexed by mailbox name
+        """
+        cached = self._get_cached_counters()
+        result = {}
+        missing = []
+        for mailbox in mailboxes:
+            if "UNSEEN" in cached.get(mailbox, {}):
+                result[mailbox] = cached[mailbox]["UNSEEN"]
+            elif mailbox not in missing:
+                missing.append(mailbox)
+        if not missing:
+            return result
+        counters = {}
+        if "LIST-STATUS" in self.capabilities and "LIST-EXTENDED" in self.capabilities:
+            patterns = b" ".join(self._encode_mbox_name(name) for name in missing)
+            self._cmd(
+                "LIST", '""', b"(" + patterns + b")", "RETURN", "(STATUS (UNSEEN))"
+            )
+            counters = self._parse_status_responses(
+                self.m.untagged_responses.pop("STATUS", [])
+            )
+        else:
+            for mailbox in missing:
+                data = self._cmd("STATUS", self._encode_mbox_name(mailbox), "(UNSEEN)")
+                m = self.unseen_pattern.match(data[-1].decode())
+                counters[mailbox] = {"UNSEEN": int(m.group(1)) if m else 0}
+        counters = {name: value for name, value in counters.items() if name in missing}
+        self._cache_counters(counters)
+        for mailbox in missing:
+            result[mailbox] = counters.get(mailbox, {}).get("UNSEEN", 0)
+        return result
 
     def _encode_mbox_name(self, folder):
         """Encode folder name (str) to imap4-utf-7 and quote it."""
@@ -440,16 +789,32 @@ class IMAPconnector:
             sdescr["class"] = "subfolders"
         return True
 
-    def _listmboxes(self, topmailbox: str, mailboxes: list, until_mailbox=None) -> None:
-        """Retrieve mailboxes list."""
+    def _listmboxes(
+        self,
+        topmailbox: str,
+        mailboxes: list,
+        until_mailbox=None,
+        counters: dict | None = None,
+    ) -> None:
+        """Retrieve mailboxes list.
+
+        If the server supports LIST-STATUS, counters (MESSAGES and
+        UNSEEN) of listed mailboxes are returned by the same command
+        and stored in ``counters``.
+        """
         pattern = (
             f'"{topmailbox.encode("imap4-utf-7").decode()}{self.hdelimiter}%"'
             if topmailbox
             else "%"
         )
-        resp = self._cmd(
-            "LIST", '""', pattern, "RETURN", "(CHILDREN STATUS (MESSAGES))"
-        )
+        if "LIST-STATUS" in self.capabilities:
+            options = "(CHILDREN STATUS (MESSAGES UNSEEN))"
+        else:
+            options = "(CHILDREN)"
+        resp = self._cmd("LIST", '""', pattern, "RETURN", options)
+        status = self.m.untagged_responses.pop("STATUS", [])
+        if counters is not None:
+            counters.update(self._parse_status_responses(status))
         newmboxes = []
         for mb in resp:
             if not mb:
@@ -458,7 +823,7 @@ class IMAPconnector:
                 flags, delimiter, namelen = self.list_response_pattern_literal.match(
                     mb[0].decode()
                 ).groups()
-                name = mb[1][0 : int(namelen)]
+                name = mb[1][0 : int(namelen)].decode()
             else:
                 flags, delimiter, name, childinfo = (
                     self.listextended_response_pattern.match(mb.decode()).groups()
@@ -484,7 +849,7 @@ class IMAPconnector:
                 descr["path"] = name
                 descr["sub"] = []
                 if until_mailbox and until_mailbox.startswith(name):
-                    self._listmboxes(name, descr["sub"], until_mailbox)
+                    self._listmboxes(name, descr["sub"], until_mailbox, counters)
 
         from operator import itemgetter
 
@@ -549,20 +914,25 @@ class IMAPconnector:
             name, parent = separate_mailbox(until_mailbox, self.hdelimiter)
             if parent:
                 until_mailbox = parent
-        self._listmboxes(topmailbox, md_mailboxes, until_mailbox)
+        counters = {}
+        self._listmboxes(topmailbox, md_mailboxes, until_mailbox, counters)
+        self._cache_counters(counters)
 
         if unseen_messages:
+            names = []
             for mb in md_mailboxes:
                 if "send_status" not in mb:
                     continue
                 del mb["send_status"]
-                key = "path" if "path" in mb else "name"
                 if mb.get("removed", False):
                     continue
-                count = self.unseen_messages(mb[key])
-                if count == 0:
-                    continue
-                mb["unseen"] = count
+                names.append(mb["path"] if "path" in mb else mb["name"])
+            # Only mailboxes missing from the LIST response are queried
+            unseen = self.unseen_counters(names)
+            for mb in md_mailboxes:
+                count = unseen.get(mb["path"] if "path" in mb else mb["name"], 0)
+                if count:
+                    mb["unseen"] = count
         return md_mailboxes
 
     def _add_flag(self, mbox: str, msgset: list[str], flag: str) -> None:
@@ -574,6 +944,7 @@ class IMAPconnector:
         """
         self.select_mailbox(mbox, False)
         self._cmd("STORE", ",".join(msgset), "+FLAGS", flag)
+        self._invalidate_counters()
 
     def _remove_flag(self, mbox: str, msgset: list[str], flag: str) -> None:
         """Remove flag from a message set.
@@ -584,6 +955,7 @@ class IMAPconnector:
         """
         self.select_mailbox(mbox, False)
         self._cmd("STORE", ",".join(msgset), "-FLAGS", flag)
+        self._invalidate_counters()
 
     def mark_messages_unread(self, mbox: str, msgset: list[str]) -> None:
         """Mark a set of messages as unread.
@@ -629,6 +1001,8 @@ class IMAPconnector:
         self.select_mailbox(oldmailbox, False)
         self._cmd("COPY", msgset, self._encode_mbox_name(newmailbox))
         self._cmd("STORE", msgset, "+FLAGS", r"(\Deleted \Seen)")
+        self._invalidate_sorted_uids(oldmailbox)
+        self._invalidate_counters()
 
     def push_mail(self, mbox: str, msg) -> int:
         """
@@ -639,6 +1013,7 @@ class IMAPconnector:
         now = imaplib.Time2Internaldate(time.time())
         msg = bytes(msg)
         typ, data = self.m.append(self._encode_mbox_name(mbox), r"(\Seen)", now, msg)
+        self._invalidate_counters()
         response = data[0].decode()
         m = re.match(r"\[APPENDUID \d+ (\d+)\].+", response)
         if m:
@@ -654,6 +1029,8 @@ class IMAPconnector:
         self.select_mailbox(mbox, False)
         self._cmd("STORE", f"{uid}".encode(), "+FLAGS", r"(\Deleted)")
         self._cmd("EXPUNGE")
+        self._invalidate_sorted_uids(mbox)
+        self._invalidate_counters()
 
     def empty(self, mbox: str):
         self.select_mailbox(mbox, False)
@@ -663,6 +1040,8 @@ class IMAPconnector:
             return
         self._cmd("STORE", seq, "+FLAGS", r"(\Deleted)")
         self._cmd("EXPUNGE")
+        self._invalidate_sorted_uids(mbox)
+        self._invalidate_counters()
 
     def compact(self, mbox: str):
         """Compact a specific mailbox.
@@ -673,6 +1052,7 @@ class IMAPconnector:
         """
         self.select_mailbox(mbox, False)
         self._cmd("EXPUNGE")
+        self._invalidate_counters()
 
     def create_folder(self, name: str, parent: str | None = None) -> bool:
         if parent is not None:
@@ -688,12 +1068,14 @@ class IMAPconnector:
         )
         if typ == "NO":
             raise WebmailInternalError(data[0], ajax=True)
+        self._invalidate_counters()
         return True
 
     def delete_folder(self, name: str) -> bool:
         typ, data = self.m.delete(self._encode_mbox_name(name))
         if typ == "NO":
             raise WebmailInternalError(data[0])
+        self._invalidate_counters()
         return True
 
     def getquota(self, mailbox: str) -> None:
@@ -746,10 +1128,133 @@ class IMAPconnector:
         partnum = validate_imap_partnum(partnum)
         self.select_mailbox(mbox, False)
         data = self._cmd("FETCH", uid, f"(BODYSTRUCTURE BODY[{partnum}])")
+        # Message is now marked as seen
+        self._invalidate_counters()
         bs = BodyStructure(data[int(uid)]["BODYSTRUCTURE"])
         attdef = bs.find_attachment(partnum)
         return attdef, data[int(uid)][f"BODY[{partnum}]"]
 
+    def fetchparts(self, uid: str, mbox: str, partnums: list[str]) -> dict:
+        """Retrieve several message parts with a single FETCH command.
+
+        Messages are not marked as seen.
+
+        :param uid: a message UID
+        :param mbox: the mailbox containing the message
+        :param partnums: a list of part numbers
+        :return: a dict indexed by part number
+        """
+        uid = validate_imap_uid(uid)
+        partnums = [validate_imap_partnum(pnum) for pnum in partnums]
+        if not partnums:
+            return {}
+        self.select_mailbox(mbox)
+        query = " ".join(f"BODY.PEEK[{pnum}]" for pnum in partnums)
+        data = self._cmd("FETCH", uid, f"({query})")
+        if not data or int(uid) not in data:
+            return {}
+        msg = data[int(uid)]
+        return {
+            pnum: msg[f"BODY[{pnum}]"] for pnum in partnums if f"BODY[{pnum}]" in msg
+        }
+
+    def fetchpart_definition(self, uid: str, mbox: str, partnum) -> dict | None:
+        """Retrieve the definition of a specific message part.
+
+        The part content is not fetched (see ``iter_section``). When
+        the server supports the BINARY extension (RFC 3516), the
+        decoded size of the part is also returned (``binary_size``
+        key).
+
+        :param uid: a message UID
+        :param mbox: the mailbox containing the message
+        :param partnum: the part number
+        :return: a dict or None if the part is not an attachment
+        """
+        uid = validate_imap_uid(uid)
+        partnum = validate_imap_partnum(partnum)
+        self.select_mailbox(mbox, False)
+        binary = "BINARY" in self.capabilities
+        if binary:
+            query = f"(BODYSTRUCTURE BINARY.SIZE[{partnum}])"
+        else:
+            query = "(BODYSTRUCTURE)"
+        data = self._cmd("FETCH", uid, query)
+        if int(uid) not in data:
+            raise ImapError(f"Message with UID {uid} not found in {mbox} folder")
+        attdef = BodyStructure(data[int(uid)]["BODYSTRUCTURE"]).find_attachment(partnum)
+        if attdef is not None and binary:
+            size = data[int(uid)].get(f"BINARY.SIZE[{partnum}]")
+            if size is not None and size.isdigit():
+                attdef["binary_size"] = int(size)
+        return attdef
+
+    def _fetch_literal(self, uid: str, query: str) -> bytes | None:
+        """Return the literal sent back by a FETCH command.
+
+        Responses are not parsed: we only look for the one containing
+        the literal of the given message.
+
+        :return: None if the message was not found
+        """
+        data = self._cmd("FETCH", uid, query, raw=True)
+        found = False
+        for item in data or []:
+            line = item[0] if isinstance(item, tuple) else item
+            if not isinstance(line, bytes):
+                continue
+            match = FETCH_UID_RE.search(line.decode(errors="replace"))
+            if match is None or match.group(1) != uid:
+                continue
+            if isinstance(item, tuple):
+                return item[1]
+            found = True
+        # An empty section may be returned as a quoted string
+        return b"" if found else None
+
+    def iter_section(
+        self,
+        uid: str,
+        mbox: str,
+        section: str = "",
+        readonly: bool = True,
+        binary: bool = False,
+    ) -> Iterator[bytes]:
+        """Retrieve a body section using partial FETCH commands.
+
+        The section is returned chunk by chunk so that its size does
+        not matter.
+
+        :param uid: a message UID
+        :param mbox: the mailbox containing the message
+        :param section: the section to retrieve (ie. a part number)
+        :param readonly: if False, the message will be marked as seen
+        :param binary: decode the section on server side (RFC 3516)
+        """
+        uid = validate_imap_uid(uid)
+        if section:
+            section = validate_imap_partnum(section)
+        chunk_size = constants.FETCH_CHUNK_SIZE
+        self.select_mailbox(mbox, readonly)
+        item = "BINARY" if binary else "BODY"
+        peek = ".PEEK" if readonly else ""
+        if not readonly:
+            self._invalidate_counters()
+        offset = 0
+        while True:
+            chunk = self._fetch_literal(
+                uid, f"({item}{peek}[{section}]<{offset}.{chunk_size}>)"
+            )
+            if chunk is None:
+                raise ImapError(f"Message with UID {uid} not found in {mbox} folder")
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            offset += chunk_size
+            # Message has been marked as seen by the first command
+            peek = ".PEEK"
+
     def fetch(
         self, start: int, stop: int | None = None, mbox: str | None = None
     ) -> list:
@@ -764,7 +1269,8 @@ class IMAPconnector:
         """
         self.select_mailbox(mbox, False)
         if start and stop:
-            submessages = self.messages[start - 1 : stop]
+            offset = self.messages_offset
+            submessages = self.messages[start - 1 - offset : stop - offset]
             mrange = ",".join(submessages)
         else:
             submessages = [start]
@@ -824,6 +1330,8 @@ class IMAPconnector:
             bcmd = "BODY.PEEK" if readonly else "BODY"
             to_fetch = f"(BODYSTRUCTURE {bcmd}[HEADER.FIELDS ({what})])"
         data = self._cmd("FETCH", mailid, to_fetch)
+        if not readonly:
+            self._invalidate_counters()
         if int(mailid) not in data:
             raise ImapError(f"Message with UID {mailid} not found in {mbox} folder")
         return data[int(mailid)]
@@ -846,6 +1354,14 @@ def separate_mailbox(fullname: str, sep: str = ".") -> tuple[str, str | None]:
 def get_imapconnector(request, **kwargs) -> IMAPconnector:
     """Shortcut to create an IMAP connector.
 
+    Connections are taken from (and given back to) the per-process
+    pool of IMAP sessions when possible.
+
     :param request: a ``Request`` object
     """
-    return IMAPconnector(request.user.username, str(request.auth), **kwargs)
+    return IMAPconnector(
+        request.user.username,
+        str(request.auth),
+        token_expires=getattr(request.auth, "expires", None),
+        **kwargs,
+    )
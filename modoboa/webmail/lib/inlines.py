@@ -0,0 +1,152 @@
+"""Cache of inline images.
+
+Inline images (parts of multipart/related messages referenced by a
+Content-ID) are extracted to display HTML messages. Files are named
+after the SHA-256 of their content so that an image shared by many
+messages (ie. a logo in newsletters) is only stored once. The total
+size of the cache is bounded: least recently used files are removed
+first.
+"""
+
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+
+from modoboa.webmail import constants
+
+from .attachments import get_storage_path
+
+NAME_RE = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+SIZE_CACHE_KEY = "webmail:inline_cache_size"
+
+
+def get_setting(name: str):
+    """Return cache setting, falling back to default value."""
+    if name == "DIR":
+        default = get_storage_path("inlines")
+    else:
+        default = getattr(constants, f"INLINE_CACHE_{name}")
+    return getattr(settings, f"WEBMAIL_INLINE_CACHE_{name}", default)
+
+
+def get_part_cache_key(
+    user: str, mbox: str, uidvalidity: int | None, uid: str, cid: str
+) -> str:
+    """Return the key used to remember the file of a message part.
+
+    UIDs are only unique for a given UIDVALIDITY value so it is part
+    of the key.
+    """
+    part_hash = hashlib.sha256(
+        f"{user}\0{mbox}\0{uidvalidity}\0{uid}\0{cid}".encode()
+    ).hexdigest()
+    return f"webmail:inline_part:{part_hash}"
+
+
+class InlineImageCache:
+    """Content-addressed and size-bounded cache of inline images."""
+
+    @property
+    def directory(self) -> str:
+        return get_setting("DIR")
+
+    def relative_path(self, name: str) -> str | None:
+        """Return the path of a file, relative to the cache directory."""
+        if not NAME_RE.match(name):
+            return None
+        return os.path.join(name[:2], name)
+
+    def get(self, name: str) -> str | None:
+        """Return the path of a cached file and mark it as used.
+
+        :param name: the file name (as returned by ``store``)
+        :return: an absolute path or None if the file is not in cache
+        """
+        path = self.relative_path(name)
+        if path is None:
+            return None
+        path = os.path.join(self.directory, path)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, content: bytes, content_type: str) -> str | None:
+        """Store a file in cache.
+
+        :param content: the decoded content of the image
+        :param content_type: the MIME type of the image
+        :return: the file name or None if this type can't be cached
+        """
+        content_type = content_type.lower()
+        if content_type not in constants.INLINE_IMAGE_TYPES:
+            return None
+        extension = mimetypes.guess_extension(content_type)
+        if extension is None:
+            return None
+        name = hashlib.sha256(content).hexdigest() + extension
+        if self.get(name) is not None:
+            return name
+        path = os.path.join(self.directory, self.relative_path(name))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(content)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, path)
+        self._add_to_size(len(content))
+        return name
+
+    def _iter_files(self):
+        """Yield (path, stat result) for each cached file."""
+        for dirpath, _dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not NAME_RE.match(filename):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+    def _add_to_size(self, size: int) -> None:
+        """Update the total size of the cache, evicting files if needed."""
+        if cache.get(SIZE_CACHE_KEY) is None:
+            total = sum(stat.st_size for path, stat in self._iter_files())
+            cache.set(SIZE_CACHE_KEY, total, None)
+        else:
+            try:
+                total = cache.incr(SIZE_CACHE_KEY, size)
+            except ValueError:
+                total = size
+                cache.set(SIZE_CACHE_KEY, total, None)
+        if total > get_setting("MAX_SIZE"):
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used files until enough room is made.
+
+        Files are removed until the cache uses less than 90% of its
+        maximum size, so that eviction does not run at every store.
+        """
+        files = sorted(self._iter_files(), key=lambda item: item[1].st_mtime)
+        total = sum(stat.st_size for path, stat in files)
+        limit = get_setting("MAX_SIZE") * 0.9
+        for path, stat in files:
+            if total <= limit:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+        cache.set(SIZE_CACHE_KEY, total, None)
+
+
+inline_cache = InlineImageCache()
@@ -1,5 +1,8 @@
 """Misc. utilities."""
 
+import binascii
+import codecs
+from collections.abc import Iterable, Iterator
 from email.header import Header
 from email.mime.image import MIMEImage
 from importlib.metadata import version
@@ -7,6 +10,7 @@ import os
 from pathlib import Path
 from urllib.parse import unquote, urlparse
 
+from charset_normalizer import detect as charset_detect
 import lxml
 
 from django.conf import settings
@@ -58,6 +62,84 @@ def decode_payload(encoding, payload):
     return payload
 
 
+def iter_decode_payload(encoding: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Decode a payload received in several chunks.
+
+    Same as ``decode_payload`` but only a small amount of data is
+    kept in memory, whatever the payload size.
+
+    :param encoding: the encoding's name
+    :param chunks: an iterable of encoded chunks
+    """
+    encoding = encoding.lower()
+    if encoding == "base64":
+        decode = binascii.a2b_base64
+    elif encoding == "quoted-printable":
+        decode = binascii.a2b_qp
+    else:
+        yield from chunks
+        return
+    pending = b""
+    for chunk in chunks:
+        if encoding == "base64":
+            # Only decode complete groups of 4 characters
+            pending += chunk.translate(None, b" \t\r\n")
+            end = len(pending) - len(pending) % 4
+        else:
+            # Only decode complete lines (soft line breaks included)
+            pending += chunk
+            end = pending.rfind(b"\n") + 1
+        if end:
+            yield decode(pending[:end])
+            pending = pending[end:]
+    if pending:
+        yield decode(pending)
+
+
+def _guess_decoder(value: bytes):
+    """Return an incremental decoder for the encoding of value."""
+    encoding = charset_detect(value)["encoding"] or "latin-1"
+    return codecs.getincrementaldecoder(encoding)(errors="replace")
+
+
+def iter_decode_text(
+    chunks: Iterable[bytes], sample_size: int = 64 * 1024
+) -> Iterator[str]:
+    """Decode text received in several chunks.
+
+    UTF-8 is tried first. If it fails, the encoding is guessed from
+    (at least) the next ``sample_size`` bytes.
+
+    :param chunks: an iterable of encoded chunks
+    :param sample_size: minimum size used to guess the encoding
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    undecoded = b""
+    for chunk in chunks:
+        if decoder is not None:
+            try:
+                text = decoder.decode(chunk)
+            except UnicodeDecodeError:
+                # Not UTF-8, wait for enough data to guess encoding
+                undecoded = decoder.getstate()[0] + chunk
+                decoder = None
+            else:
+                if text:
+                    yield text
+                continue
+        else:
+            undecoded += chunk
+        if len(undecoded) >= sample_size:
+            decoder = _guess_decoder(undecoded)
+            yield decoder.decode(undecoded)
+            undecoded = b""
+    if decoder is None:
+        decoder = _guess_decoder(undecoded)
+    text = decoder.decode(undecoded, final=True)
+    if text:
+        yield text
+
+
 def make_body_images_inline(body: str) -> tuple[str, list]:
     """Look for images inside the body and make them inline.
 
@@ -1,5 +1,8 @@
 """Mock objects."""
 
+import asyncio
+import re
+
 from modoboa.webmail import constants
 from modoboa.webmail.tests import data as tests_data
 
@@ -24,6 +27,9 @@ class IMAP4Mock:
             self.untagged_responses["STATUS"] = [b"STATUS INBOX (UNSEEN 10)"]
         return "OK", None
 
+    def logout(self):
+        return "BYE", [b"Logging out"]
+
     def append(self, *args, **kwargs):
         return "OK", [b"[APPENDUID 1234 11] ..."]  # noqa
 
@@ -39,6 +45,17 @@ class IMAP4Mock:
     def rename(self, oldname, newname):
         return "OK", None
 
+    def _partial_fetch(self, data, offset, length):
+        """Return the requested part of a literal."""
+        result = []
+        for item in data:
+            if isinstance(item, tuple):
+                literal = item[1][offset : offset + length]
+                prefix = re.sub(rb"\{\d+\}$", f"{{{len(literal)}}}".encode(), item[0])
+                item = (prefix, literal)
+            result.append(item)
+        return result
+
     def uid(self, command, *args):
         if command in ["SEARCH", "SORT"]:
             return "OK", [b"19"]
@@ -78,6 +95,77 @@ class IMAP4Mock:
                 data = tests_data.BODYSTRUCTURE_WITH_PDF
             elif uid == 133872:
                 data = tests_data.COMPLETE_MAIL
+            partial = re.search(r"<(\d+)\.(\d+)>", args[1])
+            if partial:
+                data = self._partial_fetch(data, *map(int, partial.groups()))
             return "OK", data
         elif command in ["COPY", "STORE"]:
             return "OK", []
+
+
+class FakeIMAPServer:
+    """Fake IMAP server supporting IDLE (and NOTIFY), for asyncio tests.
+
+    Changes are simulated with ``push``: the given responses are sent
+    to the clients currently idling.
+    """
+
+    def __init__(self, capabilities=b"IMAP4rev1 IDLE", counters=None):
+        self.capabilities = capabilities
+        self.counters = counters or {"INBOX": {"MESSAGES": 2, "UNSEEN": 1}}
+        self.commands = []
+        self.idling = set()
+        self.idle_started = asyncio.Event()
+        self.server = None
+
+    async def start(self) -> int:
+        """Start listening and return the port."""
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def push(self, *responses):
+        for writer in self.idling:
+            for response in responses:
+                writer.write(response + b"\r\n")
+
+    async def handle(self, reader, writer):
+        writer.write(b"* OK ready\r\n")
+        idle_tag = None
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            line = line.rstrip(b"\r\n")
+            if idle_tag is not None:
+                if line == b"DONE":
+                    self.idling.discard(writer)
+                    writer.write(idle_tag + b" OK Idle completed\r\n")
+                    idle_tag = None
+                continue
+            tag, command, *args = line.split(b" ", 2)
+            self.commands.append(command.decode())
+            if command in [b"AUTHENTICATE", b"LOGIN"]:
+                writer.write(b"* CAPABILITY " + self.capabilities + b"\r\n")
+            elif command == b"STATUS":
+                name = re.match(rb'"?([^"]+)"? \(', args[0]).group(1).decode()
+                items = " ".join(
+                    f"{key} {value}" for key, value in self.counters[name].items()
+                )
+                writer.write(f'* STATUS "{name}" ({items})\r\n'.encode())
+            elif command == b"IDLE":
+                idle_tag = tag
+                self.idling.add(writer)
+                writer.write(b"+ idling\r\n")
+                self.idle_started.set()
+                await writer.drain()
+                continue
+            writer.write(tag + b" OK done\r\n")
+            await writer.drain()
+            if command == b"LOGOUT":
+                break
+        self.idling.discard(writer)
+        writer.close()
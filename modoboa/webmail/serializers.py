@@ -82,6 +82,11 @@ class UserMailboxUnseenSerializer(serializers.Serializer):
     counter = serializers.IntegerField()
 
 
+class UserMailboxUnseenCountersSerializer(serializers.Serializer):
+
+    counters = serializers.DictField(child=serializers.IntegerField())
+
+
 class UserMailboxesSerializer(serializers.Serializer):
 
     mailboxes = UserMailboxSerializer(many=True)
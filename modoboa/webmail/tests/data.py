@@ -90,12 +90,11 @@ BODYSTRUCTURE_SAMPLE_9 = [
 
 BODYSTRUCTURE_SAMPLE_10 = [
     (
-        b"855 (UID 46932 " + BODYSTRUCTURE_4 + b" BODY[1.1] {10})",
+        b"855 (UID 46932 " + BODYSTRUCTURE_4 + b" BODY[1.1] {10}",
         b"XXXXXXXX\r\n",
-        b"BODY[2] {10}",
-        b"XXXXXXXX\r\n",
-        b")",
-    )
+    ),
+    (b" BODY[2] {10}", b"XXXXXXXX\r\n"),
+    b")",
 ]
 
 BODYSTRUCTURE_SAMPLE_WITH_FLAGS = [
@@ -1,11 +1,14 @@
 """FETCH parser tests."""
 
 import io
+import random
+import time
 import unittest
 
 from modoboa.webmail.lib.fetch_parser import FetchResponseParser
 
 from . import data
+from .legacy_fetch_parser import FetchResponseParser as LegacyFetchResponseParser
 
 
 def dump_bodystructure(fp, bs, depth=0):
@@ -110,3 +113,174 @@ class FetchParserTestCase(unittest.TestCase):
 """,
         )
         self._test_bodystructure_output(data.BODYSTRUCTURE_SAMPLE_8, "text/html\n")
+
+    def test_parse_empty_literal(self):
+        """Check that empty literals are returned."""
+        self.assertEqual(self.parser.parse(data.EMPTY_BODY), {33: {"BODY[1]": ""}})
+
+    def test_parse_list(self):
+        """Check that unknown data items containing a list are parsed."""
+        result = self.parser.parse([b"12 (UID 300 MODSEQ (1234) FLAGS (\\Seen))"])
+        self.assertEqual(result, {300: {"MODSEQ": ["1234"], "FLAGS": ["\\Seen"]}})
+
+
+class FetchResponseGenerator:
+    """Generate random FETCH responses, as returned by imaplib."""
+
+    chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJ0123456789 -_.@=?()[]{}<>/'"
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+
+    def text(self, maxlength=20):
+        length = self.random.randint(0, maxlength)
+        return "".join(self.random.choice(self.chars) for _i in range(length))
+
+    def string(self):
+        """Return a quoted string, a literal or NIL."""
+        choice = self.random.random()
+        if choice < 0.1:
+            return ["NIL"]
+        if choice < 0.2:
+            value = self.random.choice(
+                ["R\xe9ception".encode("latin-1"), "R\xe9ception".encode()]
+            )
+            return [value]
+        return [f'"{self.text()}"']
+
+    def params(self):
+        if self.random.random() < 0.2:
+            return ["NIL"]
+        result = ["("]
+        for _i in range(self.random.randint(1, 3)):
+            result += [f'"{self.text(8) or "name"}"', " "] + self.string() + [" "]
+        return result + [")"]
+
+    def part(self, depth=0):
+        """Return a (multi)part definition."""
+        if depth < 3 and self.random.random() < 0.3:
+            result = ["("]
+            for _i in range(self.random.randint(1, 3)):
+                result += self.part(depth + 1)
+            subtype = self.random.choice(["mixed", "alternative", "related"])
+            return result + [f' "{subtype}" '] + self.params() + [" NIL NIL NIL)"]
+        ctype = self.random.choice(
+            [("text", "plain"), ("text", "html"), ("application", "pdf")]
+        )
+        result = ['("{}" "{}" '.format(*ctype)] + self.params()
+        result += [" NIL "] + self.string() + [' "base64" ']
+        result += [str(self.random.randint(0, 100000)), " "]
+        if ctype[0] == "text":
+            result += [str(self.random.randint(0, 1000)), " "]
+        result += ["NIL ("] + self.string() + [" "] + self.params() + [") NIL NIL)"]
+        return result
+
+    def message(self, seqnum):
+        """Return a message definition."""
+        items = [
+            [f"UID {self.random.randint(1, 100000)}"],
+            [f"RFC822.SIZE {self.random.randint(1, 100000)}"],
+            ["FLAGS ("]
+            + [
+                " ".join(
+                    self.random.sample(
+                        ["\\Seen", "\\Answered", "$Forwarded", "\\Flagged"],
+                        self.random.randint(0, 3),
+                    )
+                )
+            ]
+            + [")"],
+            ['INTERNALDATE "17-Jul-1996 02:44:25 -0700"'],
+            ["BODYSTRUCTURE "] + self.part(),
+            ["BODY[HEADER.FIELDS (DATE FROM SUBJECT)] "]
+            + [f"Subject: {self.text()}\r\n\r\n".encode()],
+        ]
+        self.random.shuffle(items)
+        result = [f"{seqnum} ("]
+        for item in items:
+            result += item + [" "]
+        result[-1] = ")"
+        return result
+
+    def response(self):
+        """Return a list of chunks, as returned by imaplib."""
+        tokens = []
+        for seqnum in range(1, self.random.randint(1, 5)):
+            tokens += self.message(seqnum)
+        chunks = []
+        current = ""
+        for token in tokens:
+            if isinstance(token, bytes):
+                chunks.append(((current + f"{{{len(token)}}}").encode(), token))
+                current = ""
+            else:
+                current += token
+        if current:
+            chunks.append(current.encode())
+        return chunks
+
+
+# Responses to a message listing (FLAGS, BODYSTRUCTURE and headers)
+BENCHMARK_SAMPLES = [
+    data.BODYSTRUCTURE_SAMPLE_WITH_FLAGS,
+    data.BODYSTRUCTURE_SAMPLE_2,
+    data.BODYSTRUCTURE_SAMPLE_3,
+    data.BODYSTRUCTURE_SAMPLE_4,
+    data.BODYSTRUCTURE_SAMPLE_5,
+    data.BODYSTRUCTURE_SAMPLE_6,
+    data.BODYSTRUCTURE_SAMPLE_8,
+    data.BODYSTRUCTURE_EMPTY_MAIL_WITH_HEADERS,
+]
+
+
+def benchmark(messages=100, iterations=50):
+    """Measure the time needed by both parsers to parse responses.
+
+    Can be run from a Django shell::
+
+      from modoboa.webmail.tests.test_fetch_parser import benchmark
+      benchmark()
+
+    :param int messages: number of messages per FETCH response
+    :param int iterations: number of responses to parse
+    :return: a (legacy parser, current parser) tuple of durations
+    """
+    response = []
+    for count in range(messages):
+        response += BENCHMARK_SAMPLES[count % len(BENCHMARK_SAMPLES)]
+    result = []
+    for parser_class in [LegacyFetchResponseParser, FetchResponseParser]:
+        start = time.perf_counter()
+        for _i in range(iterations):
+            parser_class().parse(response)
+        result.append(time.perf_counter() - start)
+    return tuple(result)
+
+
+class FetchParserEquivalenceTestCase(unittest.TestCase):
+    """Compare results with the previous implementation."""
+
+    def test_recorded_responses(self):
+        for name in dir(data):
+            response = getattr(data, name)
+            if not isinstance(response, list) or response is data.EMPTY_BODY:
+                continue
+            with self.subTest(name=name):
+                self.assertEqual(
+                    FetchResponseParser().parse(response),
+                    LegacyFetchResponseParser().parse(response),
+                )
+
+    def test_random_responses(self):
+        for seed in range(200):
+            response = FetchResponseGenerator(seed).response()
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    FetchResponseParser().parse(response),
+                    LegacyFetchResponseParser().parse(response),
+                )
+
+    def test_benchmark(self):
+        legacy, current = benchmark(messages=5, iterations=1)
+        self.assertGreater(legacy, 0)
+        self.assertGreater(current, 0)
@@ -0,0 +1,152 @@
+"""Tests for push notifications."""
+
+import asyncio
+from datetime import timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from modoboa.webmail import constants
+from modoboa.webmail.lib import imapnotify
+from modoboa.webmail.mocks import FakeIMAPServer
+
+
+class ParseStatusTestCase(SimpleTestCase):
+
+    def test_parse_status(self):
+        self.assertEqual(
+            imapnotify.parse_status(b'"INBOX" (MESSAGES 3 UNSEEN 1)'),
+            ("INBOX", {"messages": 3, "unseen": 1}),
+        )
+        self.assertEqual(
+            imapnotify.parse_status(b"Sent (UIDNEXT 4)"), ("Sent", {"uidnext": 4})
+        )
+        self.assertEqual(
+            imapnotify.parse_status(b'"a \\"b\\"" (UNSEEN 0)'), ('a "b"', {"unseen": 0})
+        )
+        self.assertEqual(
+            imapnotify.parse_status(b"{12}\r\nEnvoy&AOk-s (MESSAGES 7)"),
+            ("Envoyés", {"messages": 7}),
+        )
+        self.assertIsNone(imapnotify.parse_status(b"INBOX"))
+
+
+@mock.patch.object(constants, "IMAP_NOTIFY_DEBOUNCE_DELAY", 0.01)
+@mock.patch.object(constants, "IMAP_NOTIFY_GRACE_PERIOD", 0)
+class MailboxWatcherTestCase(SimpleTestCase):
+
+    async def start_server(self, *args, **kwargs):
+        self.server = FakeIMAPServer(*args, **kwargs)
+        port = await self.server.start()
+        self.conf = {
+            "imap_server": "127.0.0.1",
+            "imap_port": port,
+            "imap_secured": False,
+        }
+
+    async def next_event(self, queue):
+        return await asyncio.wait_for(queue.get(), 5)
+
+    async def stop_watcher(self, watcher, *queues):
+        task = watcher.task
+        for queue in queues:
+            watcher.unsubscribe(queue)
+        if task is not None:
+            await asyncio.wait_for(task, 5)
+        await self.server.stop()
+
+    async def test_idle(self):
+        await self.start_server()
+        watcher = imapnotify.get_watcher("user@test.com", self.conf)
+        self.assertIs(imapnotify.get_watcher("user@test.com", self.conf), watcher)
+        first = watcher.subscribe("token", None)
+        self.assertEqual(
+            await self.next_event(first),
+            {
+                "event": "status",
+                "data": {"mailbox": "INBOX", "messages": 2, "unseen": 1},
+            },
+        )
+        # Known counters are sent to new subscribers
+        second = watcher.subscribe("token", None)
+        self.assertEqual((await self.next_event(second))["data"]["unseen"], 1)
+
+        await asyncio.wait_for(self.server.idle_started.wait(), 5)
+        self.server.counters["INBOX"] = {"MESSAGES": 3, "UNSEEN": 2}
+        self.server.push(b"* 3 EXISTS", b"* 1 RECENT")
+        for queue in [first, second]:
+            self.assertEqual(
+                await self.next_event(queue),
+                {
+                    "event": "status",
+                    "data": {"mailbox": "INBOX", "messages": 3, "unseen": 2},
+                },
+            )
+            self.assertEqual(
+                await self.next_event(queue),
+                {"event": "new_message", "data": {"mailbox": "INBOX"}},
+            )
+        # Only one session for all the subscribers
+        self.assertEqual(self.server.commands.count("AUTHENTICATE"), 1)
+        self.assertIn("EXAMINE", self.server.commands)
+
+        await self.stop_watcher(watcher, first, second)
+        self.assertEqual(self.server.commands[-1], "LOGOUT")
+        self.assertIsNot(imapnotify.get_watcher("user@test.com", self.conf), watcher)
+
+    async def test_notify(self):
+        await self.start_server(
+            b"IMAP4rev1 IDLE NOTIFY",
+            {
+                "INBOX": {"MESSAGES": 2, "UNSEEN": 1},
+                "Sent": {"MESSAGES": 5, "UNSEEN": 0},
+            },
+        )
+        watcher = imapnotify.get_watcher("user@test.com", self.conf)
+        queue = watcher.subscribe("token", None)
+        await self.next_event(queue)
+        await asyncio.wait_for(self.server.idle_started.wait(), 5)
+        # Counters are retrieved when missing from the notification
+        self.server.push(b'* STATUS "Sent" (MESSAGES 5 UIDNEXT 6)')
+        self.assertEqual(
+            (await self.next_event(queue))["data"],
+            {"mailbox": "Sent", "messages": 5, "unseen": 0},
+        )
+        self.server.push(b'* STATUS "Sent" (MESSAGES 5 UNSEEN 1)')
+        self.assertEqual((await self.next_event(queue))["data"]["unseen"], 1)
+        self.assertIn("NOTIFY", self.server.commands)
+        self.assertNotIn("EXAMINE", self.server.commands)
+        self.assertEqual(self.server.commands.count("STATUS"), 2)
+        await self.stop_watcher(watcher, queue)
+
+    async def test_token_expiration(self):
+        await self.start_server()
+        watcher = imapnotify.get_watcher("user@test.com", self.conf)
+        queue = watcher.subscribe("token", timezone.now() + timedelta(seconds=0.5))
+        await self.next_event(queue)
+        # A more recent token is used to open a new session
+        other = watcher.subscribe("token2", timezone.now() + timedelta(seconds=1))
+        self.assertEqual(watcher.token, "token2")
+        await self.next_event(other)
+        # Subscribers are told to reconnect once the last token expires
+        self.assertIsNone(await self.next_event(queue))
+        self.assertIsNone(await self.next_event(other))
+        self.assertEqual(self.server.commands.count("AUTHENTICATE"), 2)
+        await self.stop_watcher(watcher)
+
+    async def test_iter_events(self):
+        await self.start_server()
+        watcher = imapnotify.get_watcher("user@test.com", self.conf)
+        events = imapnotify.iter_events(watcher, "token", None)
+        self.assertEqual(await anext(events), b"retry: 5000\n\n")
+        self.assertEqual(
+            await anext(events),
+            b'event: status\ndata: {"mailbox": "INBOX", "messages": 2, "unseen": 1}'
+            b"\n\n",
+        )
+        task = watcher.task
+        await events.aclose()
+        self.assertEqual(watcher.subscribers, set())
+        await asyncio.wait_for(task, 5)
+        await self.server.stop()
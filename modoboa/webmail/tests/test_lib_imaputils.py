@@ -25,6 +25,13 @@ class ImapUtilsTestCase(unittest.TestCase):
         result = [bytearray('OR (FROM "bob") (SUBJECT "bob")', "utf8")]
         self.assertEqual(self.imap_connector.criterions, result)
 
+    def test_criterions_body_with_pattern(self):
+        """Test search in message body"""
+        self.imap_connector.criterions = []
+        self.imap_connector.parse_search_parameters("to_addr,body", "bob")
+        result = [bytearray('OR (TO "bob") (BODY "bob")', "utf8")]
+        self.assertEqual(self.imap_connector.criterions, result)
+
     def test_criterions_one_criterion_without_pattern(self):
         """Test with Criterion and empty pattern"""
         self.imap_connector.criterions = []
@@ -2,12 +2,14 @@
 
 import base64
 import os
+import quopri
 import tempfile
 
 from django.conf import settings
 from django.test import SimpleTestCase
 
 from modoboa.webmail.lib import utils
+from modoboa.webmail.lib.fetch_parser import decode_text
 
 # A minimal valid 1x1 PNG.
 PNG_BYTES = base64.b64decode(
@@ -84,3 +86,43 @@ class MakeBodyImagesInlineTestCase(SimpleTestCase):
         html, parts = utils.make_body_images_inline(body)
         self.assertEqual(parts, [])
         self.assertIn("https://example.test/x.png", html)
+
+
+class IterDecodeTestCase(SimpleTestCase):
+    """Tests for incremental decoding functions."""
+
+    def _split(self, value, size):
+        return [value[pos : pos + size] for pos in range(0, len(value), size)]
+
+    def test_iter_decode_payload(self):
+        content = bytes(range(256)) * 40 + "Réception à l'été\r\n".encode() * 50
+        encoded = {
+            "base64": base64.encodebytes(content),
+            "quoted-printable": quopri.encodestring(content),
+            "8bit": content,
+        }
+        for encoding, value in encoded.items():
+            for size in (1, 7, 76, 1000, len(value)):
+                with self.subTest(encoding=encoding, size=size):
+                    # Same result as when the whole value is decoded at once
+                    chunks = utils.iter_decode_payload(
+                        encoding.upper(), self._split(value, size)
+                    )
+                    self.assertEqual(
+                        b"".join(chunks), utils.decode_payload(encoding, value)
+                    )
+
+    def test_iter_decode_text(self):
+        text = "Réception à l'été\r\n" * 50
+        for encoding in ("utf-8", "latin-1"):
+            value = text.encode(encoding)
+            # Same result as when the whole value is decoded at once
+            expected = decode_text(value)
+            for size in (1, 7, 1000):
+                with self.subTest(encoding=encoding, size=size):
+                    chunks = utils.iter_decode_text(self._split(value, size))
+                    self.assertEqual("".join(chunks), expected)
+                    chunks = utils.iter_decode_text(
+                        self._split(value, size), sample_size=100
+                    )
+                    self.assertEqual(len("".join(chunks)), len(text))
@@ -1,16 +1,26 @@
+import asyncio
+import base64
 from datetime import timedelta
+import gc
 import getpass
+import hashlib
+import imaplib
 from io import BytesIO
+import json
 import os
+import re
 import shutil
 import tempfile
+import time
 from unittest import mock
 
+from asgiref.sync import sync_to_async
 from dateutil.relativedelta import relativedelta
 from freezegun import freeze_time
 from rq import SimpleWorker
 
 from django.core import mail
+from django.core.cache import cache
 from django.test import override_settings
 from django.urls import reverse
 from django.utils import timezone
@@ -22,9 +32,19 @@ from modoboa.core import models as core_models
 from modoboa.core.tests import utils
 from modoboa.admin import factories as admin_factories
 from modoboa.lib.tests import ModoAPITestCase
-from modoboa.webmail import factories, jobs, models
+from modoboa.webmail import constants, factories, jobs, models
+from modoboa.webmail.lib import imapnotify
 from modoboa.webmail.lib.attachments import ComposeSessionManager
-from modoboa.webmail.mocks import IMAP4Mock
+from modoboa.webmail.lib.imappool import IMAPSession, pool
+from modoboa.webmail.lib.inlines import inline_cache
+from modoboa.webmail.lib.imaputils import (
+    IMAPconnector,
+    get_mailbox_counters_cache_key,
+    parse_sequence_set,
+    slice_sequence_set,
+)
+from modoboa.webmail.mocks import FakeIMAPServer, IMAP4Mock
+from modoboa.webmail.tests import data as tests_data
 
 Application = get_application_model()
 AccessToken = get_access_token_model()
@@ -71,6 +91,9 @@ class WebmailTestCase(ModoAPITestCase):
         self.mock_imap4 = patcher.start()
         self.mock_imap4.return_value = IMAP4Mock()
         self.addCleanup(patcher.stop)
+        pool.clear()
+        self.addCleanup(pool.clear)
+        cache.delete(get_mailbox_counters_cache_key(self.user.username))
         self.set_global_parameter("imap_port", 1435)
         self.workdir = tempfile.mkdtemp()
         os.mkdir(f"{self.workdir}/webmail")
@@ -189,7 +212,35 @@ class UserEmailViewSetTestCase(WebmailTestCase):
         self.assertEqual(response.status_code, 404)
         response = self.client.get(f"{url}?mailbox=INBOX&mailid=133872")
         self.assertEqual(response.status_code, 200)
-        self.assertIn("Message-ID", response.json()["source"])
+        content = json.loads(b"".join(response.streaming_content))
+        self.assertIn("Message-ID", content["source"])
+        self.assertEqual(content["source"], tests_data.COMPLETE_MAIL[0][1].decode())
+
+    @mock.patch("modoboa.webmail.constants.FETCH_CHUNK_SIZE", 100)
+    def test_getmailsource_imap_error(self):
+        """An IMAP error during streaming must not truncate the JSON."""
+        imap4 = self.mock_imap4.return_value
+        uid = imap4.uid
+
+        def failing_uid(command, *args):
+            if command == "FETCH" and "<100.100>" in args[1]:
+                raise imaplib.IMAP4_SSL.abort("connection lost")
+            return uid(command, *args)
+
+        # IMAP4 is mocked but not IMAP4_SSL
+        self.mock_imap4.error = imaplib.IMAP4_SSL.error
+        self.authenticate()
+        url = reverse("v2:webmail-email-source")
+        with mock.patch.object(imap4, "uid", side_effect=failing_uid):
+            response = self.client.get(f"{url}?mailbox=INBOX&mailid=133872")
+            self.assertEqual(response.status_code, 200)
+            content = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(
+            content["source"], tests_data.COMPLETE_MAIL[0][1].decode()[:100]
+        )
+        self.assertEqual(content["error"], "connection lost")
+        # The failed session is not given back to the pool
+        self.assertEqual(pool._count(), 0)
 
     def test_imap_injection_rejected(self):
         """CRLF / malformed identifiers in GET params must be rejected.
@@ -228,6 +279,15 @@ class UserEmailViewSetTestCase(WebmailTestCase):
         # Request succeeds (no injection): the quote is escaped, not rejected.
         self.assertEqual(response.status_code, 200)
 
+    def test_search_in(self):
+        self.authenticate()
+        url = reverse("v2:webmail-email-list")
+        response = self.client.get(f"{url}?search=test&search_in=subject,body")
+        self.assertEqual(response.status_code, 200)
+        for value in ["", "subject,unknown", "BODY"]:
+            response = self.client.get(f"{url}?search=test&search_in={value}")
+            self.assertEqual(response.status_code, 400)
+
     def test_move(self):
         self.authenticate()
         url = reverse("v2:webmail-email-move")
@@ -313,6 +373,54 @@ class UserEmailViewSetTestCase(WebmailTestCase):
         self.assertEqual(
             response.headers["Content-Disposition"], "attachment; filename=attachment"
         )
+        self.assertEqual(
+            b"".join(response.streaming_content),
+            base64.b64decode(tests_data.BODYSTRUCTURE_WITH_PDF[0][1]),
+        )
+        # Decoded size is unknown
+        self.assertNotIn("Content-Length", response.headers)
+        # Not an attachment
+        response = self.client.get(f"{url}?mailbox=INBOX&mailid=3444&partnum=3")
+        self.assertEqual(response.status_code, 404)
+
+    @mock.patch("modoboa.webmail.constants.FETCH_CHUNK_SIZE", 100)
+    def test_attachment_partial_fetch(self):
+        imap4 = StreamingIMAP4Mock()
+        self.mock_imap4.return_value = imap4
+        self.authenticate()
+        url = reverse("v2:webmail-email-attachment")
+        response = self.client.get(f"{url}?mailbox=INBOX&mailid=3444&partnum=2")
+        self.assertEqual(response.status_code, 200)
+        payload = tests_data.BODYSTRUCTURE_WITH_PDF[0][1]
+        self.assertEqual(
+            b"".join(response.streaming_content), base64.b64decode(payload)
+        )
+        self.assertEqual(
+            imap4.fetch_queries[1:],
+            ["(BODY[2]<0.100>)"]
+            + [
+                f"(BODY.PEEK[2]<{offset}.100>)"
+                for offset in range(100, len(payload) + 1, 100)
+            ],
+        )
+        # The IMAP session is given back once the content is sent
+        self.assertEqual(pool._count(), 1)
+
+    @mock.patch("modoboa.webmail.constants.FETCH_CHUNK_SIZE", 100)
+    def test_attachment_binary(self):
+        imap4 = StreamingIMAP4Mock(b"QUOTA BINARY")
+        self.mock_imap4.return_value = imap4
+        self.authenticate()
+        url = reverse("v2:webmail-email-attachment")
+        response = self.client.get(f"{url}?mailbox=INBOX&mailid=3444&partnum=2")
+        self.assertEqual(response.status_code, 200)
+        content = base64.b64decode(tests_data.BODYSTRUCTURE_WITH_PDF[0][1])
+        self.assertEqual(b"".join(response.streaming_content), content)
+        self.assertEqual(response.headers["Content-Length"], str(len(content)))
+        self.assertEqual(
+            imap4.fetch_queries[:2],
+            ["(BODYSTRUCTURE BINARY.SIZE[2])", "(BINARY[2]<0.100>)"],
+        )
 
 
 class ComposeSessionViewSetTestCase(WebmailTestCase):
@@ -337,8 +445,8 @@ class ComposeSessionViewSetTestCase(WebmailTestCase):
         self.assertEqual(response.status_code, 201)
         uid = response.json()["uid"]
         manager = ComposeSessionManager(self.user.username)
-        content = manager.get_content(uid)
-        self.assertEqual(len(content["attachments"]), 1)
+        attachments = manager.get_attachments(uid)
+        self.assertEqual(len(attachments), 1)
 
     def test_get(self):
         self.authenticate()
@@ -390,9 +498,9 @@ class ComposeSessionViewSetTestCase(WebmailTestCase):
         with self.settings(MEDIA_ROOT=self.workdir):
             response = self.client.post(url, {"attachment": get_gif()})
         self.assertEqual(response.status_code, 200)
-        content = manager.get_content(uid)
-        self.assertEqual(len(content["attachments"]), 1)
-        name = content["attachments"][0]["tmpname"]
+        attachments = manager.get_attachments(uid)
+        self.assertEqual(len(attachments), 1)
+        name = attachments[0]["tmpname"]
         path = f"{self.workdir}/webmail/{name}"
         self.assertTrue(os.path.exists(path))
 
@@ -402,6 +510,76 @@ class ComposeSessionViewSetTestCase(WebmailTestCase):
         self.assertEqual(response.status_code, 204)
         self.assertFalse(os.path.exists(path))
 
+    def test_attachments_storage(self):
+        self.authenticate()
+        uid = self._create_compose_session()
+        manager = ComposeSessionManager(self.user.username)
+        ttl = manager.rclient.ttl(manager.get_key(uid))
+        self.assertTrue(0 < ttl <= constants.COMPOSE_SESSION_TIMEOUT)
+
+        # Rejected uploads leave nothing behind
+        self.set_global_parameters({"max_attachment_size": "10"})
+        url = reverse("v2:webmail-compose-session-attachments", args=[uid])
+        with self.settings(MEDIA_ROOT=self.workdir):
+            response = self.client.post(url, {"attachment": get_gif()})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(f"{self.workdir}/webmail"), [])
+
+        # Accepted uploads are written once, to their final location
+        self.set_global_parameters({"max_attachment_size": "10K"})
+        with self.settings(MEDIA_ROOT=self.workdir):
+            response = self.client.post(url, {"attachment": get_gif()})
+        self.assertEqual(response.status_code, 200)
+        name = response.json()["tmpname"]
+        self.assertEqual(os.listdir(f"{self.workdir}/webmail"), [name])
+        self.assertEqual(
+            manager.rclient.ttl(manager.get_attachments_key(uid)),
+            manager.rclient.ttl(manager.get_key(uid)),
+        )
+
+        # Uploads to an expired session are discarded
+        manager.rclient.delete(manager.get_key(uid))
+        with self.settings(MEDIA_ROOT=self.workdir):
+            response = self.client.post(url, {"attachment": get_gif()})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(os.listdir(f"{self.workdir}/webmail"), [name])
+
+    def test_clean_attachments(self):
+        self.authenticate()
+        uid = self._create_compose_session()
+        url = reverse("v2:webmail-compose-session-attachments", args=[uid])
+        with self.settings(MEDIA_ROOT=self.workdir):
+            response = self.client.post(url, {"attachment": get_gif()})
+        used = response.json()["tmpname"]
+        message = factories.ScheduledMessageFactory(
+            account=self.user, scheduled_datetime=timezone.now()
+        )
+        models.MessageAttachment.objects.create(
+            message=message, file="scheduled", content_type="image/gif"
+        )
+        old = time.time() - constants.ORPHANED_ATTACHMENT_MIN_AGE - 1
+        for name in ["scheduled", "orphan", used]:
+            path = f"{self.workdir}/webmail/{name}"
+            with open(path, "ab"):
+                pass
+            os.utime(path, (old, old))
+        with open(f"{self.workdir}/webmail/recent", "wb"):
+            pass
+        os.mkdir(f"{self.workdir}/webmail/inlines")
+
+        with self.settings(MEDIA_ROOT=self.workdir):
+            jobs.clean_attachments()
+        self.assertEqual(
+            sorted(os.listdir(f"{self.workdir}/webmail")),
+            sorted(["inlines", "recent", "scheduled", used]),
+        )
+
+        # Files of deleted sessions are collected too
+        ComposeSessionManager(self.user.username).delete(uid)
+        with self.settings(MEDIA_ROOT=self.workdir):
+            jobs.clean_attachments()
+        self.assertFalse(os.path.exists(f"{self.workdir}/webmail/{used}"))
+
     def test_delete_attachment(self):
         self.authenticate()
         uid = self._create_compose_session()
@@ -761,3 +939,574 @@ class ScheduledMessageViewSetTestCase(WebmailTestCase):
         self.assertEqual(response.status_code, 200)
         self.message.refresh_from_db()
         self.assertEqual(self.message.imap_uid, 11)
+
+
+class IMAPConnectionPoolTestCase(WebmailTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.authenticate()
+        self.url = reverse("v2:webmail-mailbox-list")
+
+    def get_pooled_session(self):
+        return next(iter(pool._idle.values()))[0]
+
+    def test_session_reused(self):
+        for _i in range(3):
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.mock_imap4.call_count, 1)
+
+    @override_settings(WEBMAIL_IMAP_POOL_SIZE=0)
+    def test_pool_disabled(self):
+        self.client.get(self.url)
+        self.client.get(self.url)
+        self.assertEqual(self.mock_imap4.call_count, 2)
+
+    @override_settings(WEBMAIL_IMAP_POOL_CHECK_INTERVAL=0)
+    def test_dead_session_replaced(self):
+        self.client.get(self.url)
+        imap4 = self.get_pooled_session().m
+        simple_command = imap4._simple_command
+
+        def failing_noop(name, *args, **kwargs):
+            if name == "NOOP":
+                raise OSError("Connection reset by peer")
+            return simple_command(name, *args, **kwargs)
+
+        imap4._simple_command = failing_noop
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.mock_imap4.call_count, 2)
+
+    def test_expired_token(self):
+        self.client.get(self.url)
+        session = self.get_pooled_session()
+        self.assertEqual(session.expires, self.access_token.expires)
+        session.expires = timezone.now() - timedelta(seconds=1)
+        self.client.get(self.url)
+        self.assertEqual(self.mock_imap4.call_count, 2)
+
+    def test_failed_session_not_pooled(self):
+        url = reverse("v2:webmail-email-content") + "?mailbox=INBOX&mailid=33"
+
+        def get_content():
+            status_code = self.client.get(url).status_code
+            # Sessions are released when emails are collected (the
+            # response data references the serializer)
+            gc.collect()
+            return status_code
+
+        self.assertEqual(get_content(), 200)
+        self.assertEqual(pool._count(), 1)
+        imap4 = self.get_pooled_session().m
+        # IMAP4 is mocked but not IMAP4_SSL
+        self.mock_imap4.error = imaplib.IMAP4_SSL.error
+        with mock.patch.object(imap4, "uid", side_effect=imaplib.IMAP4_SSL.abort):
+            self.assertEqual(get_content(), 500)
+        self.assertEqual(pool._count(), 0)
+        self.assertEqual(get_content(), 200)
+        self.assertEqual(self.mock_imap4.call_count, 2)
+
+    @override_settings(WEBMAIL_IMAP_POOL_MAX_CONNECTIONS=1)
+    def test_max_connections(self):
+        self.client.get(self.url)
+        session = self.get_pooled_session()
+        user_key = session.key
+        other = IMAPSession(("admin@test.com",) + user_key[1:], IMAP4Mock(), [])
+        self.assertTrue(pool.release(other))
+        # Least recently used session has been evicted
+        self.assertIsNone(pool.acquire(user_key))
+        self.assertEqual(pool.acquire(other.key), other)
+
+
+class SortingIMAP4Mock(IMAP4Mock):
+    """IMAP4 mock which keeps track of SORT commands."""
+
+    def __init__(self, capabilities=b"QUOTA"):
+        super().__init__()
+        self.capabilities = capabilities
+        self.status = {
+            "MESSAGES": 2,
+            "UIDNEXT": 21,
+            "UIDVALIDITY": 1,
+            "HIGHESTMODSEQ": 10,
+        }
+        self.uids = [b"19", b"20"]
+        self.all_uids = b"19:20"
+        self.sort_commands = 0
+        self.sort_queries = []
+        self.changes = []
+        self.vanished = []
+
+    def _simple_command(self, name, *args, **kwargs):
+        if name == "CAPABILITY":
+            self.untagged_responses["CAPABILITY"] = [self.capabilities]
+            return "OK", None
+        if name == "STATUS":
+            items = " ".join(f"{key} {value}" for key, value in self.status.items())
+            self.untagged_responses["STATUS"] = [f'"INBOX" ({items})'.encode()]
+            return "OK", None
+        return super()._simple_command(name, *args, **kwargs)
+
+    def uid(self, command, *args):
+        if command == "SORT":
+            self.sort_commands += 1
+            if args[0] == b"RETURN":
+                self.sort_queries.append(args)
+                if args[1] == b"(COUNT ALL)":
+                    response = b"COUNT %d ALL %s" % (len(self.uids), self.all_uids)
+                else:
+                    response = b"COUNT 2 PARTIAL (2:2 19)"
+                self.untagged_responses["ESEARCH"] = [b'(TAG "A4") UID ' + response]
+                return "OK", [None]
+            return "OK", [b" ".join(self.uids)]
+        if command == "FETCH" and "CHANGEDSINCE" in args[-1]:
+            self.untagged_responses["VANISHED"] = self.vanished
+            return "OK", self.changes
+        return super().uid(command, *args)
+
+
+class StreamingIMAP4Mock(IMAP4Mock):
+    """IMAP4 mock recording FETCH commands, with BINARY support."""
+
+    def __init__(self, capabilities=b"QUOTA"):
+        super().__init__()
+        self.capabilities = capabilities
+        self.fetch_queries = []
+
+    def _simple_command(self, name, *args, **kwargs):
+        result = super()._simple_command(name, *args, **kwargs)
+        if name == "CAPABILITY":
+            self.untagged_responses["CAPABILITY"] = [self.capabilities]
+        return result
+
+    def uid(self, command, *args):
+        if command != "FETCH":
+            return super().uid(command, *args)
+        self.fetch_queries.append(args[1])
+        if "BINARY" not in args[1]:
+            return super().uid(command, *args)
+        header, payload = tests_data.BODYSTRUCTURE_WITH_PDF[0]
+        content = base64.b64decode(payload)
+        if "BINARY.SIZE" in args[1]:
+            header = re.sub(rb"BODY\[2\] \{\d+\}$", b"", header)
+            return "OK", [header + f"BINARY.SIZE[2] {len(content)})".encode()]
+        offset, length = map(int, re.search(r"<(\d+)\.(\d+)>", args[1]).groups())
+        literal = content[offset : offset + length]
+        return "OK", [
+            (f"1 (UID 3444 BINARY[2]<{offset}> ~{{{len(literal)}}}".encode(), literal),
+            b")",
+        ]
+
+
+class InlineImagesIMAP4Mock(IMAP4Mock):
+    """IMAP4 mock returning a HTML message with inline images."""
+
+    html = (
+        '<p>Logo: <img src="cid:image005.png@01CC6CAA.4FADC490">'
+        '<img src="cid:image006.jpg@01CC6CAA.4FADC490"></p>'
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.fetch_queries = []
+        self.uidvalidity = 1
+
+    def _simple_command(self, name, *args, **kwargs):
+        if name == "STATUS":
+            self.untagged_responses["STATUS"] = [
+                f'"INBOX" (MESSAGES 1 UIDNEXT 4 UIDVALIDITY {self.uidvalidity})'.encode()
+            ]
+            return "OK", None
+        return super()._simple_command(name, *args, **kwargs)
+
+    def uid(self, command, *args):
+        if command != "FETCH" or args[0] != "3":
+            return super().uid(command, *args)
+        self.fetch_queries.append(args[1])
+        header = tests_data.BODYSTRUCTURE_SAMPLE_6[0][0]
+        if args[1] == "(BODYSTRUCTURE)":
+            return "OK", tests_data.BODYSTRUCTURE_SAMPLE_6
+        if "HEADER.FIELDS" in args[1]:
+            headers = (
+                b"From: user@test.com\r\nTo: admin@test.com\r\n"
+                b"Date: Tue, 06 Sep 2011 13:33:49 +0200\r\n"
+                b"Subject: Inline images\r\n\r\n"
+            )
+            fields = re.search(r"BODY\[HEADER\.FIELDS \([^)]+\)\]", args[1])
+            return "OK", [
+                (header + f" {fields.group(0)} {{{len(headers)}}}".encode(), headers),
+                b")",
+            ]
+        result = []
+        prefix = b"123 (UID 3"
+        for pnum in re.findall(r"BODY\.PEEK\[([\d.]+)\]", args[1]):
+            if pnum in ("1.2", "1.3"):
+                literal = base64.encodebytes(b"image")
+            else:
+                literal = self.html.encode()
+            result.append(
+                (prefix + f" BODY[{pnum}] {{{len(literal)}}}".encode(), literal)
+            )
+            prefix = b""
+        return "OK", result + [b")"]
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class InlineImagesTestCase(WebmailTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        settings = self.settings(MEDIA_ROOT=self.workdir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_content_single_fetch(self):
+        imap4 = InlineImagesIMAP4Mock()
+        self.mock_imap4.return_value = imap4
+        self.authenticate()
+        url = reverse("v2:webmail-email-content")
+        response = self.client.get(f"{url}?mailbox=INBOX&mailid=3&dformat=html&links=1")
+        self.assertEqual(response.status_code, 200)
+        body = response.json()["body"]
+        digest = hashlib.sha256(b"image").hexdigest()
+        png_url = reverse("v2:webmail-inline-image", args=[f"{digest}.png"])
+        jpg_url = reverse("v2:webmail-inline-image", args=[f"{digest}.jpg"])
+        self.assertIn(f'src="{png_url}"', body)
+        self.assertIn(f'src="{jpg_url}"', body)
+        body_queries = [q for q in imap4.fetch_queries if "BODY.PEEK" in q]
+        self.assertEqual(
+            body_queries,
+            ["(BODY.PEEK[1.1.2] BODY.PEEK[3.2] BODY.PEEK[1.2] BODY.PEEK[1.3])"],
+        )
+        # BODYSTRUCTURE is only fetched once
+        self.assertEqual(
+            len([q for q in imap4.fetch_queries if "BODYSTRUCTURE" in q]), 1
+        )
+        # Inline images are stored once
+        imap4.fetch_queries = []
+        response = self.client.get(f"{url}?mailbox=INBOX&mailid=3&dformat=html&links=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'src="{png_url}"', response.json()["body"])
+        body_queries = [q for q in imap4.fetch_queries if "BODY.PEEK" in q]
+        self.assertEqual(body_queries, ["(BODY.PEEK[1.1.2] BODY.PEEK[3.2])"])
+        # UIDs have been reassigned: the message may not be the same
+        imap4.fetch_queries = []
+        imap4.uidvalidity = 2
+        response = self.client.get(f"{url}?mailbox=INBOX&mailid=3&dformat=html&links=1")
+        self.assertEqual(response.status_code, 200)
+        body_queries = [q for q in imap4.fetch_queries if "BODY.PEEK" in q]
+        self.assertEqual(
+            body_queries,
+            ["(BODY.PEEK[1.1.2] BODY.PEEK[3.2] BODY.PEEK[1.2] BODY.PEEK[1.3])"],
+        )
+        # Same images in another folder
+        response = self.client.get(
+            f"{url}?mailbox=Archives&mailid=3&dformat=html&links=1"
+        )
+        self.assertIn(f'src="{png_url}"', response.json()["body"])
+        self.assertEqual(
+            sorted(
+                os.listdir(os.path.join(self.workdir, "webmail", "inlines", digest[:2]))
+            ),
+            [f"{digest}.jpg", f"{digest}.png"],
+        )
+
+    def test_inline_image(self):
+        name = inline_cache.store(b"image", "image/png")
+        url = reverse("v2:webmail-inline-image", args=[name])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertEqual(b"".join(response.streaming_content), b"image")
+        with self.settings(WEBMAIL_INLINE_CACHE_SENDFILE="x-accel-redirect"):
+            response = self.client.get(url)
+        self.assertEqual(
+            response.headers["X-Accel-Redirect"],
+            f"/webmail-inlines/{name[:2]}/{name}",
+        )
+        self.assertEqual(response.content, b"")
+        with self.settings(WEBMAIL_INLINE_CACHE_SENDFILE="x-sendfile"):
+            response = self.client.get(url)
+        self.assertEqual(response.headers["X-Sendfile"], inline_cache.get(name))
+        # Unknown files
+        for name in ["..%2F..%2Fsettings.py", f"{'0' * 64}.png", "test.png"]:
+            response = self.client.get(f"/api/v2/webmail/inlines/{name}")
+            self.assertEqual(response.status_code, 404)
+        # Only images are stored
+        self.assertIsNone(inline_cache.store(b"<script>", "text/html"))
+        self.assertIsNone(inline_cache.store(b"<svg/>", "image/svg+xml"))
+
+    @override_settings(WEBMAIL_INLINE_CACHE_MAX_SIZE=100)
+    def test_eviction(self):
+        names = []
+        for index in range(3):
+            name = inline_cache.store(f"{index}".encode() * 40, "image/png")
+            names.append(name)
+            path = inline_cache.get(name)
+            # Least recently used first
+            os.utime(path, (index, index))
+        self.assertIsNone(inline_cache.get(names[0]))
+        self.assertIsNotNone(inline_cache.get(names[1]))
+        self.assertIsNotNone(inline_cache.get(names[2]))
+        self.assertEqual(cache.get("webmail:inline_cache_size"), 80)
+
+
+class ListStatusIMAP4Mock(IMAP4Mock):
+    """IMAP4 mock supporting LIST-STATUS."""
+
+    def __init__(self, capabilities=b"QUOTA LIST-EXTENDED LIST-STATUS"):
+        super().__init__()
+        self.capabilities = capabilities
+        self.commands = []
+
+    def _simple_command(self, name, *args, **kwargs):
+        if name in ("LIST", "STATUS"):
+            self.commands.append((name, *args))
+        if name == "CAPABILITY":
+            self.untagged_responses["CAPABILITY"] = [self.capabilities]
+            return "OK", None
+        if name == "LIST" and "STATUS" in args[-1]:
+            self.untagged_responses["LIST"] = [
+                b'(\\HasNoChildren) "." "INBOX"',
+                b'(\\HasNoChildren) "." "Sent"',
+                (b'(\\HasNoChildren) "." {8}', b"Archives"),
+                b"",
+            ]
+            self.untagged_responses["STATUS"] = [
+                b'"INBOX" (MESSAGES 12 UNSEEN 3)',
+                b"Sent (MESSAGES 4 UNSEEN 0)",
+                (b"{8}", b"Archives"),
+                b" (MESSAGES 4 UNSEEN 2)",
+            ]
+            return "OK", None
+        return super()._simple_command(name, *args, **kwargs)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class MailboxCountersTestCase(WebmailTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.imap4 = ListStatusIMAP4Mock()
+        self.mock_imap4.return_value = self.imap4
+        self.authenticate()
+
+    def test_list_status(self):
+        response = self.client.get(reverse("v2:webmail-mailbox-list"))
+        self.assertEqual(response.status_code, 200)
+        mailboxes = {mb["name"]: mb for mb in response.json()["mailboxes"]}
+        self.assertEqual(mailboxes["INBOX"]["unseen"], 3)
+        self.assertEqual(mailboxes["Sent"].get("unseen", 0), 0)
+        self.assertIn("Archives", mailboxes)
+        self.assertEqual(
+            self.imap4.commands,
+            [("LIST", '""', "%", "RETURN", "(CHILDREN STATUS (MESSAGES UNSEEN))")],
+        )
+        # Counters are now in cache
+        self.imap4.commands = []
+        url = reverse("v2:webmail-mailbox-unseen")
+        response = self.client.get(f"{url}?mailbox=INBOX")
+        self.assertEqual(response.json()["counter"], 3)
+        self.assertEqual(self.imap4.commands, [])
+        # Until a flag is changed
+        body = {"mailbox": "INBOX", "selection": [1], "status": "read"}
+        response = self.client.post(
+            reverse("v2:webmail-email-flag"), body, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.imap4.commands = []
+        response = self.client.get(f"{url}?mailbox=INBOX")
+        self.assertEqual(len(self.imap4.commands), 1)
+
+    def test_list_without_list_status(self):
+        self.imap4.capabilities = b"QUOTA"
+        response = self.client.get(reverse("v2:webmail-mailbox-list"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.imap4.commands[0], ("LIST", '""', "%", "RETURN", "(CHILDREN)")
+        )
+        self.assertEqual(
+            [command[0] for command in self.imap4.commands[1:]],
+            ["STATUS"] * (len(self.imap4.commands) - 1),
+        )
+
+    def test_unseen_counters(self):
+        url = reverse("v2:webmail-mailbox-unseen-counters")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(f"{url}?mailbox=INBOX&mailbox=Archives")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["counters"], {"INBOX": 3, "Archives": 2})
+        self.assertEqual(
+            self.imap4.commands,
+            [("LIST", '""', b'("INBOX" "Archives")', "RETURN", "(STATUS (UNSEEN))")],
+        )
+        # Same request, from cache
+        response = self.client.get(f"{url}?mailbox=Archives&mailbox=INBOX")
+        self.assertEqual(response.json()["counters"], {"INBOX": 3, "Archives": 2})
+        self.assertEqual(len(self.imap4.commands), 1)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class UIDIndexTestCase(WebmailTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def set_imap4_mock(self, capabilities=b"QUOTA"):
+        self.imap4 = SortingIMAP4Mock(capabilities)
+        self.mock_imap4.return_value = self.imap4
+
+    def messages_count(self, **kwargs):
+        with IMAPconnector("user@test.com", "token") as imapc:
+            total = imapc.messages_count(mbox="INBOX", **kwargs)
+        return total, imapc.messages
+
+    def test_parse_sequence_set(self):
+        self.assertEqual(parse_sequence_set("4"), ["4"])
+        self.assertEqual(parse_sequence_set("1:3,7"), ["1", "2", "3", "7"])
+        self.assertEqual(parse_sequence_set("9:7,2"), ["9", "8", "7", "2"])
+
+    def test_slice_sequence_set(self):
+        value = "100000:1,200000"
+        self.assertEqual(slice_sequence_set(value, 1, 3), ["100000", "99999", "99998"])
+        self.assertEqual(slice_sequence_set(value, 99999, 100001), ["2", "1", "200000"])
+        self.assertEqual(slice_sequence_set("4,9:11", 2, 3), ["9", "10"])
+        self.assertEqual(slice_sequence_set("4,9:11", 5, 10), [])
+
+    def test_cached_list(self):
+        self.set_imap4_mock()
+        self.assertEqual(self.messages_count(), (2, ["19", "20"]))
+        self.assertEqual(self.messages_count(), (2, ["19", "20"]))
+        self.assertEqual(self.imap4.sort_commands, 1)
+        # New message
+        self.imap4.status.update(MESSAGES=3, UIDNEXT=22)
+        self.imap4.uids.insert(0, b"21")
+        self.assertEqual(self.messages_count(), (3, ["21", "19", "20"]))
+        self.assertEqual(self.imap4.sort_commands, 2)
+
+    def test_local_change(self):
+        self.set_imap4_mock()
+        self.messages_count()
+        with IMAPconnector("user@test.com", "token") as imapc:
+            imapc.move("19", "INBOX", "Trash")
+        self.imap4.uids = [b"20"]
+        self.assertEqual(self.messages_count(), (1, ["20"]))
+        self.assertEqual(self.imap4.sort_commands, 2)
+
+    def test_qresync(self):
+        self.set_imap4_mock(b"QUOTA CONDSTORE QRESYNC")
+        self.imap4.uids.append(b"17")
+        self.messages_count()
+        self.imap4.status["HIGHESTMODSEQ"] = 12
+        self.imap4.changes = [b"1 (UID 19 MODSEQ (12) FLAGS (\\Seen \\Deleted))"]
+        self.imap4.vanished = [b"(EARLIER) 17"]
+        self.assertEqual(self.messages_count(), (1, ["20"]))
+        self.assertEqual(self.imap4.sort_commands, 1)
+        # A message has been undeleted: we need to sort again
+        self.imap4.status["HIGHESTMODSEQ"] = 13
+        self.imap4.changes = [b"1 (UID 19 MODSEQ (13) FLAGS (\\Seen))"]
+        self.imap4.vanished = []
+        self.imap4.uids = [b"19", b"20"]
+        self.assertEqual(self.messages_count(), (2, ["19", "20"]))
+        self.assertEqual(self.imap4.sort_commands, 2)
+
+    def test_esort_all(self):
+        self.set_imap4_mock(b"QUOTA ESORT")
+        self.imap4.uids = [str(uid).encode() for uid in range(5000, 0, -1)]
+        self.imap4.all_uids = b"5000:1"
+        with IMAPconnector("user@test.com", "token") as imapc:
+            self.assertEqual(imapc.messages_count(mbox="INBOX", window=(41, 60)), 5000)
+            self.assertEqual(
+                imapc.messages, [str(uid) for uid in range(4960, 4940, -1)]
+            )
+            self.assertEqual(imapc.messages_offset, 40)
+        self.assertEqual(self.imap4.sort_queries[0][:2], (b"RETURN", b"(COUNT ALL)"))
+
+    def test_search_with_esort(self):
+        self.set_imap4_mock(b"QUOTA ESORT CONTEXT=SORT")
+        with IMAPconnector("user@test.com", "token") as imapc:
+            imapc.parse_search_parameters("subject,body", "invoice")
+            imapc.messages_count(mbox="INBOX", window=(1, 40))
+        query = self.imap4.sort_queries[0]
+        self.assertEqual(query[1], b"(COUNT PARTIAL 1:40)")
+        self.assertEqual(bytes(query[-1]), b'OR (SUBJECT "invoice") (BODY "invoice")')
+        # The whole list has not been retrieved nor cached
+        self.assertEqual(len(self.imap4.sort_queries), self.imap4.sort_commands)
+
+    def test_partial_sort(self):
+        self.set_imap4_mock(b"QUOTA ESORT CONTEXT=SORT")
+        with IMAPconnector("user@test.com", "token") as imapc:
+            self.assertEqual(imapc.messages_count(mbox="INBOX", window=(2, 2)), 2)
+            self.assertEqual(imapc.messages, ["19"])
+            self.assertEqual(imapc.messages_offset, 1)
+            messages = imapc.fetch(2, 2, mbox="INBOX")
+        self.assertEqual(messages[0]["imapid"], "19")
+
+
+@mock.patch.object(constants, "IMAP_NOTIFY_GRACE_PERIOD", 0)
+class EventsTestCase(WebmailTestCase):
+
+    async def test_authentication_required(self):
+        url = reverse("v2:webmail-events")
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.post(
+            url, headers={"Authorization": f"Bearer {self.access_token.token}"}
+        )
+        self.assertEqual(response.status_code, 405)
+
+    def test_wsgi(self):
+        """The stream is refused under WSGI."""
+        response = self.client.get(reverse("v2:webmail-events"))
+        self.assertEqual(response.status_code, 401)
+        self.client.credentials(Authorization="Bearer " + self.access_token.token)
+        with mock.patch.object(imapnotify, "get_watcher") as get_watcher:
+            response = self.client.get(reverse("v2:webmail-events"))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(response.streaming)
+        get_watcher.assert_not_called()
+
+    async def test_events(self):
+        server = FakeIMAPServer()
+        port = await server.start()
+        await sync_to_async(self.set_global_parameter)("imap_port", port, app="webmail")
+        response = await self.async_client.get(
+            reverse("v2:webmail-events"),
+            headers={"Authorization": f"Bearer {self.access_token.token}"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = []
+
+        async def consume():
+            async for event in response.streaming_content:
+                events.append(event)
+
+        # The ASGI handler cancels the response when the client leaves
+        consumer = asyncio.create_task(consume())
+        for _i in range(50):
+            if len(events) >= 2:
+                break
+            await asyncio.sleep(0.1)
+        watcher = imapnotify.get_watcher(
+            "user@test.com",
+            {"imap_server": "127.0.0.1", "imap_port": port, "imap_secured": False},
+        )
+        task = watcher.task
+        consumer.cancel()
+        await asyncio.wait_for(task, 5)
+        self.assertEqual(events[0], b"retry: 5000\n\n")
+        self.assertIn(b'"mailbox": "INBOX", "messages": 2, "unseen": 1', events[1])
+        await server.stop()
@@ -1,8 +1,10 @@
 """Webmail API urls."""
 
+from django.urls import path
+
 from rest_framework import routers
 
-from modoboa.webmail import viewsets
+from modoboa.webmail import views, viewsets
 
 
 router = routers.SimpleRouter()
@@ -19,4 +21,7 @@ router.register(
     basename="webmail-scheduled-message",
 )
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path("inlines/<str:name>", views.inline_image, name="webmail-inline-image"),
+    path("events/", views.events, name="webmail-events"),
+]
@@ -0,0 +1,114 @@
+"""Webmail views."""
+
+import mimetypes
+import os
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from modoboa.parameters import tools as param_tools
+from modoboa.webmail.lib import imapnotify
+from modoboa.webmail.lib.inlines import get_setting, inline_cache
+
+
+@require_GET
+def inline_image(request, name: str):
+    """Send an inline image from the cache.
+
+    This view is public on purpose: images are loaded by the browser
+    through <img> tags, which can't send the API token. File names
+    are SHA-256 hashes of the content, so a file can only be
+    requested by someone who already knows what it contains, and
+    only images are stored. When possible, the file is sent by the
+    web server itself (X-Accel-Redirect or X-Sendfile).
+    """
+    path = inline_cache.get(name)
+    if path is None:
+        raise Http404
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    sendfile = get_setting("SENDFILE")
+    if sendfile == "x-accel-redirect":
+        resp = HttpResponse(content_type=content_type)
+        resp["X-Accel-Redirect"] = get_setting("ACCEL_PREFIX") + (
+            inline_cache.relative_path(name).replace(os.sep, "/")
+        )
+    elif sendfile == "x-sendfile":
+        resp = HttpResponse(content_type=content_type)
+        resp["X-Sendfile"] = path
+    else:
+        resp = FileResponse(open(path, "rb"), content_type=content_type)
+    resp["X-Content-Type-Options"] = "nosniff"
+    # Content never changes for a given name
+    resp["Cache-Control"] = "private, max-age=31536000, immutable"
+    return resp
+
+
+def _authenticate(request) -> tuple[int, tuple | None]:
+    """Authenticate request like API views do.
+
+    :return: (HTTP status, (user, token, webmail parameters))
+    """
+    drf_request = Request(
+        request,
+        authenticators=[
+            authenticator()
+            for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+        ],
+    )
+    try:
+        user = drf_request.user
+    except exceptions.APIException:
+        return 401, None
+    if not user.is_authenticated:
+        return 401, None
+    if not hasattr(user, "mailbox"):
+        return 403, None
+    conf = dict(param_tools.get_global_parameters("webmail"))
+    return 200, (user, drf_request.auth, conf)
+
+
+def non_atomic_requests(view):
+    """Disable ATOMIC_REQUESTS for a view, whatever the database.
+
+    Required by async views.
+    """
+    for alias in settings.DATABASES:
+        view = transaction.non_atomic_requests(using=alias)(view)
+    return view
+
+
+@non_atomic_requests
+@require_GET
+async def events(request):
+    """Stream mailbox changes (text/event-stream).
+
+    Requires an ASGI server: the stream stays open and all the
+    streams of a user share the same IMAP session. Under WSGI, the
+    whole stream would be consumed before being sent (and a worker
+    would be blocked until the token expires), so 204 is returned
+    to tell the client to keep polling.
+    """
+    status, result = await sync_to_async(_authenticate)(request)
+    if result is None:
+        return HttpResponse(status=status)
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    user, token, conf = result
+    watcher = imapnotify.get_watcher(user.username, conf)
+    resp = StreamingHttpResponse(
+        imapnotify.iter_events(watcher, str(token), getattr(token, "expires", None)),
+        content_type="text/event-stream",
+    )
+    resp["Cache-Control"] = "no-cache"
+    # Tell nginx not to buffer the stream
+    resp["X-Accel-Buffering"] = "no"
+    return resp
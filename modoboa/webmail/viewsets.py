@@ -1,8 +1,11 @@
 """Webmail viewsets."""
 
+import itertools
+import json
+
 from django import forms
 from django.core.validators import validate_email
-from django.http import Http404, HttpResponse
+from django.http import Http404, StreamingHttpResponse
 from django.utils.translation import gettext as _
 
 from rest_framework import mixins, parsers, response, viewsets
@@ -12,7 +15,8 @@ from rest_framework.permissions import IsAuthenticated
 from modoboa.lib import exceptions
 from modoboa.lib.paginator import Paginator
 from modoboa.lib.viewsets import HasMailbox
-from modoboa.webmail import lib, models, serializers
+from modoboa.webmail import constants, lib, models, serializers
+from modoboa.webmail.exceptions import ImapError
 from modoboa.webmail.lib import attachments
 from modoboa.webmail.lib.imaputils import UID_RE, PARTNUM_RE
 from modoboa.webmail.lib.sendmail import send_mail, schedule_email
@@ -39,6 +43,17 @@ def _validate_search(value):
     return value
 
 
+def _validate_search_criteria(value):
+    """Only accept known search criteria."""
+    if value == "both":
+        return value
+    if not value or any(
+        criterion not in constants.SEARCH_CRITERIA for criterion in value.split(",")
+    ):
+        raise exceptions.BadRequest(_("Invalid search criteria"))
+    return value
+
+
 class UserMailboxViewSet(viewsets.GenericViewSet):
 
     permission_classes = (IsAuthenticated, HasMailbox)
@@ -48,6 +63,8 @@ class UserMailboxViewSet(viewsets.GenericViewSet):
             return serializers.UserMailboxQuotaSerializer
         if self.action == "unseen":
             return serializers.UserMailboxUnseenSerializer
+        if self.action == "unseen_counters":
+            return serializers.UserMailboxUnseenCountersSerializer
         if self.action in ["create", "compress", "empty", "delete"]:
             return serializers.UserMailboxInputSerializer
         if self.action == "rename":
@@ -85,6 +102,18 @@ class UserMailboxViewSet(viewsets.GenericViewSet):
             )
         return response.Response(serializer.data)
 
+    @action(methods=["get"], detail=False)
+    def unseen_counters(self, request):
+        """Get unseen messages counters for several mailboxes."""
+        mailboxes = request.GET.getlist("mailbox")
+        if not mailboxes:
+            raise Http404
+        with lib.get_imapconnector(request) as imapc:
+            serializer = self.get_serializer(
+                {"counters": imapc.unseen_counters(mailboxes)}
+            )
+        return response.Response(serializer.data)
+
     def create(self, request):
         serializer = serializers.UserMailboxInputSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -156,14 +185,22 @@ class UserEmailViewSet(viewsets.GenericViewSet):
     def list(self, request):
         mailbox = request.GET.get("mailbox", "INBOX")
         search = _validate_search(request.GET.get("search"))
+        search_in = _validate_search_criteria(request.GET.get("search_in", "both"))
         with lib.get_imapconnector(request) as imapc:
             if search:
-                imapc.parse_search_parameters("both", search)
-            total = imapc.messages_count(mbox=mailbox)
+                imapc.parse_search_parameters(search_in, search)
             messages_per_page = request.user.parameters.get_value("messages_per_page")
-            paginator = Paginator(total, messages_per_page)
             page_num = int(request.GET.get("page", 1))
-            page = paginator.getpage(int(request.GET.get("page", 1)))
+            # Only the messages of the requested page are needed
+            window = None
+            if page_num > 0:
+                window = (
+                    (page_num - 1) * messages_per_page + 1,
+                    page_num * messages_per_page,
+                )
+            total = imapc.messages_count(mbox=mailbox, window=window)
+            paginator = Paginator(total, messages_per_page)
+            page = paginator.getpage(page_num)
             if not page:
                 serializer = self.get_serializer(
                     {
@@ -293,6 +330,30 @@ class UserEmailViewSet(viewsets.GenericViewSet):
         serializer = serializers.EmailSerializer(email)
         return response.Response(serializer.data)
 
+    def _stream_source(self, mailbox: str, mailid: str):
+        """Yield None once the message is found, then its source as JSON.
+
+        Once the response has started, it's too late to change its
+        status: if the IMAP server fails, the source string is closed
+        and an ``error`` field is added so the document stays valid.
+        """
+        started = False
+        try:
+            with lib.get_imapconnector(self.request) as imapc:
+                chunks = imapc.iter_section(mailid, mailbox)
+                first = next(chunks, b"")
+                yield None
+                started = True
+                yield '{"source": "'
+                for text in lib.iter_decode_text(itertools.chain([first], chunks)):
+                    yield json.dumps(text)[1:-1]
+        except (ImapError, OSError) as err:
+            if not started:
+                raise
+            yield f'", "error": {json.dumps(str(err))}}}'
+            return
+        yield '"}'
+
     @action(methods=["get"], detail=False)
     def source(self, request):
         mailbox = request.GET.get("mailbox", "INBOX")
@@ -300,11 +361,27 @@ class UserEmailViewSet(viewsets.GenericViewSet):
         if not mailbox or not mailid:
             raise Http404
         _validate_mailid(mailid)
-        email = lib.ImapEmail(
-            request,
-            f"{mailbox}:{mailid}",
-        )
-        return response.Response({"source": email.source})
+        content = self._stream_source(mailbox, mailid)
+        next(content)
+        return StreamingHttpResponse(content, content_type="application/json")
+
+    def _stream_attachment(self, mailbox: str, mailid: str, partnum: str):
+        """Yield the part definition first, then its decoded content."""
+        with lib.get_imapconnector(self.request) as imapc:
+            partdef = imapc.fetchpart_definition(mailid, mailbox, partnum)
+            yield partdef
+            if partdef is None:
+                return
+            if "binary_size" in partdef:
+                # Content is decoded by the server
+                yield from imapc.iter_section(
+                    mailid, mailbox, partnum, readonly=False, binary=True
+                )
+                return
+            yield from lib.iter_decode_payload(
+                partdef["encoding"],
+                imapc.iter_section(mailid, mailbox, partnum, readonly=False),
+            )
 
     @action(methods=["get"], detail=False)
     def attachment(self, request):
@@ -315,14 +392,24 @@ class UserEmailViewSet(viewsets.GenericViewSet):
             raise Http404
         _validate_mailid(mailid)
         _validate_partnum(partnum)
-        with lib.get_imapconnector(request) as imapc:
-            partdef, payload = imapc.fetchpart(mailid, mailbox, partnum)
-        resp = HttpResponse(lib.decode_payload(partdef["encoding"], payload))
+        content = self._stream_attachment(mailbox, mailid, partnum)
+        partdef = next(content)
+        if partdef is None:
+            content.close()
+            raise Http404
+        resp = StreamingHttpResponse(content)
         resp["Content-Type"] = partdef["Content-Type"]
         resp["Content-Transfer-Encoding"] = partdef["encoding"]
         resp["Content-Disposition"] = lib.rfc6266.build_header("attachment")
-        if int(partdef["size"]) < 200:
-            resp["Content-Length"] = partdef["size"]
+        size = partdef.get("binary_size")
+        if size is None and partdef["encoding"].lower() not in (
+            "base64",
+            "quoted-printable",
+        ):
+            # Content is sent as is
+            size = partdef["size"]
+        if size is not None:
+            resp["Content-Length"] = size
         return resp
 
 
@@ -350,9 +437,8 @@ class ComposeSessionViewSet(viewsets.GenericViewSet):
 
     def retrieve(self, request, pk=None):
         manager = attachments.ComposeSessionManager(request.user.username)
-        session = manager.get_content(pk)
         serializer = self.get_serializer(
-            {"uid": pk, "attachments": session["attachments"]}
+            {"uid": pk, "attachments": manager.get_attachments(pk)}
         )
         return response.Response(serializer.data)
 
@@ -372,7 +458,7 @@ class ComposeSessionViewSet(viewsets.GenericViewSet):
             email.fetch_body_structure()
             for attachment in email.fetch_attachments():
                 attachments.save_attachment(request, uid, **attachment)
-            response_attrs["attachments"] = manager.get_content(uid)["attachments"]
+            response_attrs["attachments"] = manager.get_attachments(uid)
 
         serializer = serializers.ComposeSessionSerializer(
             response_attrs, context=self.get_serializer_context()
@@ -383,7 +469,7 @@ class ComposeSessionViewSet(viewsets.GenericViewSet):
     def save(self, request, pk):
         manager = attachments.ComposeSessionManager(request.user.username)
         context = self.get_serializer_context()
-        context["attachments"] = manager.get_content(pk)["attachments"]
+        context["attachments"] = manager.get_attachments(pk)
         serializer = self.get_serializer(data=request.data, context=context)
         serializer.is_valid(raise_exception=True)
         mailid = serializer.save()
@@ -441,14 +527,14 @@ class ComposeSessionViewSet(viewsets.GenericViewSet):
             schedule_email(
                 request,
                 serializer.validated_data,
-                manager.get_content(pk)["attachments"],
+                manager.get_attachments(pk),
             )
             return response.Response(status=204)
 
         status, error = send_mail(
             request,
             serializer.validated_data,
-            manager.get_content(pk)["attachments"],
+            manager.get_attachments(pk),
         )
         if status:
             attachments.remove_attachments_and_session(manager, pk)
@@ -28,7 +28,13 @@ register(maillog_jobs.update_statistics, queue_name="modoboa", cron="0 * * * *")
 register(calendars_jobs.generate_rights, queue_name="modoboa", cron="*/2 * * * *")
 
 register(webmail_jobs.send_scheduled_messages, queue_name="modoboa", cron="* * * * *")
+register(webmail_jobs.clean_attachments, queue_name="modoboa", cron="30 * * * *")
 
 if "modoboa.amavis" in settings.MODOBOA_APPS:
     register(amavis_jobs.qcleanup, queue_name="modoboa", cron="0 0 * * *")
     register(amavis_jobs.amnotify, queue_name="modoboa", cron="0 12 * * *")
+    register(
+        amavis_jobs.update_quarantine_counters,
+        queue_name="modoboa",
+        cron="*/5 * * * *",
+    )